@@ -0,0 +1,263 @@
+# fixed_point.py
+#
+# A bit-accurate NumPy model of the fixed-point systolic_n_body_3D_cell
+# generated with --fixed, for choosing its word lengths by the error of the
+# forces before synthesis.
+
+import argparse
+
+import numpy as np
+
+
+class FixedPoint():
+    """The word lengths of the fixed-point cell, and the arithmetic it does.
+
+    Positions are signed words of q_width bits with q_frac fractional bits,
+    masses unsigned words of m_width bits with m_frac fractional bits and the
+    partial forces signed words of p_width bits with p_frac fractional bits.
+
+    1 / sqrt(r^2) is found by normalizing r^2 to m * 4^e with m in [1, 4),
+    looking up 1 / sqrt(m) from the top lut_bits bits of m with rsqrt_frac
+    fractional bits and refining it with newton Newton-Raphson steps. Then
+    1 / r^3 = (1 / sqrt(m))^3 / 8^e, where the shift by 8^e is folded into
+    the final shift of the force into the partial force format.
+
+    Every product is truncated (rounded towards minus infinity) and the
+    forces and partial sums saturate at the range of the partial forces.
+    The methods work on int64 arrays, so every intermediate product must fit
+    in 63 bits.
+    """
+    def __init__(self, q=(20, 16), m=(16, 12), p=(40, 16), rsqrt=(16, 8),
+                 newton=1):
+        self.q_width, self.q_frac = q
+        self.m_width, self.m_frac = m
+        self.p_width, self.p_frac = p
+        self.rsqrt_frac, self.lut_bits = rsqrt
+        self.newton = newton
+
+        if self.lut_bits < 3 or self.lut_bits > self.rsqrt_frac + 2:
+            raise ValueError('The table needs 3 to rsqrt_frac + 2 index bits')
+        if 2 * self.q_width + 2 > 62 or self.p_width > 62 or \
+                2 * self.rsqrt_frac + 4 > 62 or \
+                2 * self.m_width - self.m_frac + self.rsqrt_frac + \
+                self.q_width + 5 > 62:
+            raise ValueError('The products of these words do not fit in '
+                             '63 bits')
+
+        self.p_max = (1 << (self.p_width - 1)) - 1
+        self.p_min = -(1 << (self.p_width - 1))
+
+    def lut(self):
+        """The 1 / sqrt(m) table for m in [1, 4), indexed by the top
+        lut_bits bits of m (2 of them integer bits) and taken at the middle
+        of each interval. Indices below 1 are never used and are 0.
+        """
+        one = 1 << (self.lut_bits - 2)
+        index = np.arange(one, 1 << self.lut_bits)
+        table = np.zeros((1 << self.lut_bits), dtype=np.int64)
+        table[one:] = np.floor(((index + 0.5) / one) ** -0.5 *
+                               (1 << self.rsqrt_frac) + 0.5)
+        return table
+
+    def quantize(self, q, m):
+        """Rounds positions and masses to the nearest words, saturating
+        """
+        q = np.clip(np.round(np.asarray(q) * (1 << self.q_frac)),
+                    -(1 << (self.q_width - 1)), (1 << (self.q_width - 1)) - 1)
+        m = np.clip(np.round(np.asarray(m) * (1 << self.m_frac)),
+                    0, (1 << self.m_width) - 1)
+        return q.astype(np.int64), m.astype(np.int64)
+
+    def saturate(self, x):
+        return np.clip(x, self.p_min, self.p_max)
+
+    def interact(self, q_i, m_i, q_j, m_j):
+        """The f_ij of cells given broadcastable (..., 3) positions and (...)
+        masses, as (..., 3) partial force words
+        """
+        rf = self.rsqrt_frac
+        diff = np.asarray(q_j, dtype=np.int64) - np.asarray(q_i, np.int64)
+        r2 = diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1] + \
+             diff[..., 2] * diff[..., 2]
+
+        # the leading one of r^2, rounded down to an even bit
+        _, lead = np.frexp(r2.astype(np.float64))
+        lead = np.maximum(lead.astype(np.int64) - 1, 0)
+        lead -= (np.left_shift(1, lead) > r2)
+        e2 = lead & ~1
+
+        # r^2 / 4^(e2 / 2) in [1, 4) with rsqrt_frac fractional bits
+        mn = np.where(e2 >= rf, r2 >> np.maximum(e2 - rf, 0),
+                      r2 << np.maximum(rf - e2, 0))
+        y = self.lut()[mn >> (rf + 2 - self.lut_bits)]
+        for _ in range(self.newton):
+            t = (mn * ((y * y) >> rf)) >> rf
+            y = (y * ((3 << rf) - t)) >> (rf + 1)
+        y3 = (((y * y) >> rf) * y) >> rf
+
+        mm = (np.asarray(m_i, np.int64) * np.asarray(m_j, np.int64)) >> \
+             self.m_frac
+        f_wide = (mm * y3)[..., None] * diff
+
+        # f_wide has m_frac + rsqrt_frac + q_frac fractional bits and is
+        # missing the 1 / 8^e of 1 / r^3, with e = e2 / 2 - q_frac
+        shift = (self.m_frac + rf + self.q_frac - self.p_frac +
+                 3 * ((e2 - 2 * self.q_frac) // 2))[..., None]
+        right = self.saturate(f_wide >> np.minimum(np.maximum(shift, 0), 63))
+        left = np.minimum(np.maximum(-shift, 0), self.p_width)
+        f_ij = np.where(f_wide > (self.p_max >> left), self.p_max,
+                        np.where(f_wide < -((-self.p_min) >> left), self.p_min,
+                                 f_wide << left))
+        f_ij = np.where(shift >= 0, right, f_ij)
+
+        return np.where((r2 == 0)[..., None], 0, f_ij)
+
+    def forces(self, q, m, N, fold=False):
+        """The force words on each body as the data testbench accumulates
+        them from the NxN array, given the position and mass words.
+
+        The partial sums saturate as they pass through the cells, while the
+        sums leaving the array are added with 64 bit words, in which the
+        order does not matter. A block row of the upper triangle is computed
+        at a time.
+
+        With fold the even block rows start with the folded block of their
+        diagonal block and the next row's, whose diagonal cells swap the
+        row and the column, see systolic_n_body_codegen.folded_forces. The
+        f_ij of a pair of particles are not exactly opposite in fixed point,
+        so its sums differ from those of the diagonal blocks.
+        """
+        n = len(m)
+        b = n // N
+        forces = np.zeros((n, 3), dtype=np.int64)
+        upper = np.triu(np.ones((N, N), dtype=bool), 1)[:, :, None]
+        lower = upper.transpose(1, 0, 2)
+        for i in range(b):
+            rows = slice(i * N, (i + 1) * N)
+            start = (i + 1) * N if fold else i * N
+            if fold and i % 2 == 0:
+                a = slice(min(i + 1, b - 1) * N, min(i + 2, b) * N)
+                f_c = self.interact(q[rows, None, :], m[rows, None],
+                                    q[None, rows, :], m[None, rows])
+                f_a = self.interact(q[a, None, :], m[a, None],
+                                    q[None, a, :], m[None, a])
+                f_right = (np.where(upper, f_c, 0) -
+                           np.where(lower, f_c.transpose(1, 0, 2), 0))
+                f_down = (np.where(lower, f_a, 0) -
+                          np.where(upper, f_a.transpose(1, 0, 2), 0))
+                right = np.zeros((N, 3), dtype=np.int64)
+                down = np.zeros((N, 3), dtype=np.int64)
+                for v in range(N):
+                    right = self.saturate(right + f_right[:, v])
+                    down = self.saturate(down + f_down[:, v])
+                forces[rows] += right
+                # the bottom of (i, i) repeats its right
+                if i + 1 < b:
+                    forces[a] += down
+
+            f_ij = self.interact(q[rows, None, :], m[rows, None],
+                                 q[None, start:, :], m[None, start:])
+
+            # partial sums out of the right of the rows of each block (i, j)
+            f_ij = f_ij.reshape(N, (n - start) // N, N, 3)
+            right = np.zeros((N, (n - start) // N, 3), dtype=np.int64)
+            for v in range(N):
+                right = self.saturate(right + f_ij[:, :, v])
+            forces[rows] += np.sum(right, axis=1)
+
+            # and out of the bottom, dropped for the diagonal block
+            f_ij = f_ij.reshape(N, -1, 3)
+            down = np.zeros((f_ij.shape[1], 3), dtype=np.int64)
+            for u in range(N):
+                down = self.saturate(down - f_ij[u])
+            forces[(i + 1) * N:] += down[(i + 1) * N - start:]
+
+        return forces
+
+    def error(self, q, m, N):
+        """The error of the forces against doubles for positions q (n, 3)
+        and masses m. Returns the largest and the root mean square error
+        relative to the largest force, and the fraction of the force
+        components that differ by more than 1% of their own magnitude
+        """
+        q_fix, m_fix = self.quantize(q, m)
+        fixed = self.forces(q_fix, m_fix, N) / (1 << self.p_frac)
+        exact = reference_forces(q, m)
+
+        scale = np.max(np.abs(exact))
+        error = np.abs(fixed - exact)
+        return {
+            'max_error': np.max(error) / scale,
+            'rms_error': np.sqrt(np.mean(error ** 2)) / scale,
+            'off_by_1%': np.mean(error > 0.01 * np.abs(exact)),
+        }
+
+
+def reference_forces(q, m):
+    """The forces with doubles, m_i m_j (q_j - q_i) / r^3 summed over j
+    """
+    n = len(m)
+    forces = np.zeros((n, 3))
+    chunk = max(1, 2**22 // n)
+    for start in range(0, n, chunk):
+        rows = slice(start, start + chunk)
+        diff = q[None, :, :] - q[rows, None, :]
+        r = np.sqrt(np.sum(diff * diff, axis=-1))
+        r[r == 0] = np.inf
+        scale = m[rows, None] * m[None, :] / r ** 3
+        forces[rows] = np.sum(scale[..., None] * diff, axis=1)
+    return forces
+
+
+def add_arguments(parser):
+    """Adds the word length options of FixedPoint to an argparse parser
+    """
+    parser.add_argument('--q', type=int, nargs=2, default=(20, 16),
+                        metavar=('WIDTH', 'FRAC'),
+                        help='The bits and fractional bits of positions.')
+    parser.add_argument('--m', type=int, nargs=2, default=(16, 12),
+                        metavar=('WIDTH', 'FRAC'),
+                        help='The bits and fractional bits of masses.')
+    parser.add_argument('--p', type=int, nargs=2, default=(40, 16),
+                        metavar=('WIDTH', 'FRAC'),
+                        help='The bits and fractional bits of the partial '
+                             'forces.')
+    parser.add_argument('--rsqrt', type=int, nargs=2, default=(16, 8),
+                        metavar=('FRAC', 'LUT_BITS'),
+                        help='The fractional bits of 1 / sqrt(r^2) and the '
+                             'index bits of its table.')
+    parser.add_argument('--newton', type=int, default=1,
+                        help='The Newton-Raphson steps refining the table.')
+
+
+def from_args(args):
+    return FixedPoint(tuple(args.q), tuple(args.m), tuple(args.p),
+                      tuple(args.rsqrt), args.newton)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measures the error of the forces of the fixed-point '
+                    'cell against doubles.')
+    parser.add_argument('n', type=int,
+                        help='The number of bodies.')
+    parser.add_argument('N', type=int,
+                        help='The size of the systolic array.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the random bodies.')
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # the same bodies as the data testbenches
+    rng = np.random.default_rng(args.seed)
+    q, m = rng.uniform(-1, 1, (args.n, 3)), rng.uniform(0.5, 1.5, args.n)
+
+    for key, value in from_args(args).error(q, m, args.N).items():
+        print('{:>10}: {:.3e}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,674 @@
+# netlist_sim.py
+#
+# A cycle accurate NumPy simulation of the systolic array generated by
+# systolic_n_body_codegen.py, driven with the stimulus of its data file
+# testbench, so designs can be checked without a SystemVerilog simulator.
+# The cells and their connections are read from the generated design, so
+# wrong wires, ports or cells in it make the forces differ.
+
+import argparse
+import re
+import time
+
+import numpy as np
+
+import fixed_point
+import systolic_n_body_codegen as codegen
+
+
+class NetlistError(ValueError):
+    """The array module of a design can not be simulated: it does not parse,
+    or a net is undeclared, undriven, driven twice or driven by a signal of
+    another kind.
+    """
+
+
+class Netlist():
+    """The array module of a design written by generate_design_code, read
+    from its text: the cells it instantiates, which of them fold, the
+    latency of the cells, and where every input of every cell and every
+    output of the array comes from.
+
+    The unrolled systolic_NxN_3D (with N a number) is read as it is, and the
+    generate loops of the parameterized systolic_NxN_3D are elaborated for
+    the default of N. Every input of a cell is followed, a component at a
+    time, through the wires and assigns to the output of the cell driving
+    it or to a port of the array, which are named like the testbench drives
+    them (q_{u}i, fold_{u}, ... or q_i[u], fold[u], ...). The latency is the
+    L of the cell modules, 1 without one.
+
+    The sources are indices into the table of values of their kind (q, m,
+    p or fold) that ArraySimulator builds every cycle: the q_i then q_j
+    outputs of the cells (3 words each), then the row and column ports, and
+    likewise for the masses and the right and down partial sums, each
+    followed by a zero. The fold table is the fold port and a zero, which
+    the cells that do not fold read.
+    """
+    cell = 'systolic_n_body_3D_cell'
+    fold_cell = 'systolic_n_body_3D_fold_cell'
+    # The kind of each port of a cell, and of each port of the array
+    inputs = {'in_q_i': 'q', 'in_q_j': 'q', 'in_m_i': 'm', 'in_m_j': 'm',
+              'in_p_right': 'p', 'in_p_down': 'p'}
+    outputs = {'out_q_i': 'q', 'out_q_j': 'q', 'out_m_i': 'm',
+               'out_m_j': 'm', 'out_p_right': 'p', 'out_p_down': 'p'}
+    ports = {'q_i': 'q', 'q_j': 'q', 'm_i': 'm', 'm_j': 'm', 'pr': 'p',
+             'pd': 'p', 'fold': 'fold', 'out_pr': 'p', 'out_pd': 'p'}
+
+    _array = re.compile(r'module\s+systolic_(\d+|N)x\1_3D\b(.*?)\bendmodule',
+                        re.S)
+    _declaration = re.compile(r'(?:wire|real|logic|reg|genvar|integer)\b'
+                              r'([^;]*);')
+    _keyword = re.compile(r'(?:generate|endgenerate)\b')
+    _for = re.compile(r'for\s*\(\s*(\w+)\s*=\s*([^;]+);\s*\w+\s*<\s*([^;]+);'
+                      r'[^)]*\)\s*begin\b(?:\s*:\s*\w+)?')
+    _if = re.compile(r'if\s*\(([^)]*)\)\s*begin\b(?:\s*:\s*\w+)?')
+    _else = re.compile(r'\s*else\s+begin\b(?:\s*:\s*\w+)?')
+    _assign = re.compile(r'assign\s+([^=;]+?)\s*=\s*([^;]+?)\s*;')
+    _instance = re.compile(r'(\w+)\s*(?:#\s*\((?:[^()]|\([^()]*\))*\)\s*)?'
+                           r'(\w+)\s*\(((?:[^()]|\([^()]*\))*)\)\s*;')
+    _block = re.compile(r'\b(begin|end)\b')
+    _unrolled_port = re.compile(r'(?:(q|m)_(\d+)(i|j)|'
+                                r'(pr|pd|fold|out_pr|out_pd)_(\d+))'
+                                r'(?:\[(\d+)\])?')
+    _generic_port = re.compile(r'(q_i|q_j|m_i|m_j|pr|pd|fold|out_pr|out_pd)'
+                               r'\[(\d+)\](?:\[(\d+)\])?')
+
+    def __init__(self, text):
+        text = re.sub(r'//[^\n]*', '', text)
+        array = self._array.search(text)
+        if array is None:
+            raise NetlistError('The design has no systolic_NxN_3D module')
+        header, body = array.group(2).split(';', 1)
+        self.generic = array.group(1) == 'N'
+        if self.generic:
+            N = re.search(r'\bparameter\s+N\s*=\s*(\d+)', header)
+            if N is None:
+                raise NetlistError('systolic_NxN_3D has no default N')
+            self.N = int(N.group(1))
+        else:
+            self.N = int(array.group(1))
+
+        self.declared = {name: direction for direction, name in re.findall(
+            r'\b(input|output)\b[^,()]*?(\w+)\s*(?:\[[^\]]*\]\s*)*(?=[,)])',
+            header)}
+        self.instances = []
+        self.aliases = {}
+        self._elaborate(body, {'N': self.N})
+
+        self.latency = self._latency(text, self.cell)
+        self.folding = np.array([module == self.fold_cell
+                                 for module, _, _ in self.instances])
+        if self.folding.any() and \
+           self._latency(text, self.fold_cell) != self.latency:
+            raise NetlistError('The fold cells and the cells have different '
+                               'latencies')
+        self._connect()
+
+    def _latency(self, text, module):
+        """The L of the given cell module, 1 if it has none
+        """
+        cell = re.search(r'module\s+{}\b(.*?)\bendmodule'.format(module), text,
+                         re.S)
+        if cell is None:
+            raise NetlistError('The design has no {} module'.format(module))
+        latency = re.search(r'\blocalparam\s+L\s*=\s*(\d+)', cell.group(1))
+        return 1 if latency is None else int(latency.group(1))
+
+    def _evaluate(self, expression, env):
+        """The value of an index or condition of the generate loops
+        """
+        expression = expression.replace('&&', ' and ').replace('||', ' or ')
+        try:
+            return eval(expression, {'__builtins__': {}}, dict(env))
+        except Exception:
+            raise NetlistError('Can not evaluate {}'.format(expression))
+
+    def _substitute(self, net, env):
+        """The net with the genvars of its indices replaced by their values
+        """
+        return re.sub(r'\[([^\[\]]+)\]',
+                      lambda index: '[{}]'.format(
+                          self._evaluate(index.group(1), env)),
+                      net.strip())
+
+    def _block_end(self, text, pos):
+        """The span of the end closing the block starting at pos
+        """
+        depth = 1
+        for keyword in self._block.finditer(text, pos):
+            depth += 1 if keyword.group(1) == 'begin' else -1
+            if depth == 0:
+                return keyword.span()
+        raise NetlistError('A begin has no end')
+
+    def _elaborate(self, text, env):
+        """Walks the statements of the module body, unrolling the generate
+        loops, and collects the declarations, assigns and cell instances
+        """
+        pos = 0
+        while True:
+            pos = re.compile(r'\s*').match(text, pos).end()
+            if pos == len(text):
+                return
+
+            declaration = self._declaration.match(text, pos)
+            keyword = self._keyword.match(text, pos)
+            loop = self._for.match(text, pos)
+            branch = self._if.match(text, pos)
+            assign = self._assign.match(text, pos)
+            instance = self._instance.match(text, pos)
+            if declaration:
+                for name in re.findall(r'(\w+)\s*(?:\[[^\]]*\]\s*)*(?=,|$)',
+                                       declaration.group(1)):
+                    self.declared.setdefault(name, 'wire')
+                pos = declaration.end()
+            elif keyword:
+                pos = keyword.end()
+            elif loop:
+                start, end = self._block_end(text, loop.end())
+                first = self._evaluate(loop.group(2), env)
+                last = self._evaluate(loop.group(3), env)
+                for value in range(first, last):
+                    self._elaborate(text[loop.end():start],
+                                    dict(env, **{loop.group(1): value}))
+                pos = end
+            elif branch:
+                start, end = self._block_end(text, branch.end())
+                body = text[branch.end():start]
+                otherwise = self._else.match(text, end)
+                if otherwise:
+                    start, end = self._block_end(text, otherwise.end())
+                    if not self._evaluate(branch.group(1), env):
+                        body = text[otherwise.end():start]
+                elif not self._evaluate(branch.group(1), env):
+                    body = ''
+                self._elaborate(body, env)
+                pos = end
+            elif assign:
+                net = self._substitute(assign.group(1), env)
+                if net in self.aliases:
+                    raise NetlistError('{} is assigned twice'.format(net))
+                self.aliases[net] = self._substitute(assign.group(2), env)
+                pos = assign.end()
+            elif instance:
+                module, name, connections = instance.groups()
+                if module not in (self.cell, self.fold_cell):
+                    raise NetlistError('Unknown module {}'.format(module))
+                connections = {port: self._substitute(net, env)
+                               for port, net in re.findall(
+                                   r'\.(\w+)\s*\(([^()]*)\)', connections)}
+                where = ', '.join('{}={}'.format(var, value)
+                                  for var, value in env.items() if var != 'N')
+                name = '{} ({})'.format(name, where) if where else name
+                self.instances.append((module, name, connections))
+                pos = instance.end()
+            else:
+                raise NetlistError('Can not read {!r}'.format(
+                    text[pos:pos + 40]))
+
+    def _port_name(self, port, lane):
+        """The name of a port of the array for the given row or column
+        """
+        if self.generic:
+            return '{}[{}]'.format(port, lane)
+        if port in ('q_i', 'q_j', 'm_i', 'm_j'):
+            return '{}_{}{}'.format(port[0], lane, port[2])
+        return '{}_{}'.format(port, lane)
+
+    def _direction(self, port, lane):
+        """Whether the port of the array for the row or column is an input
+        or an output, None if it is not one
+        """
+        name = port if self.generic else self._port_name(port, lane)
+        return self.declared.get(name)
+
+    def _port(self, net):
+        """The (port, lane, component) of a net of a port of the array, or
+        None. The component is None for masses and fold bits
+        """
+        if self.generic:
+            match = self._generic_port.fullmatch(net)
+            if match is None:
+                return None
+            port, lane, component = match.groups()
+        else:
+            match = self._unrolled_port.fullmatch(net)
+            if match is None:
+                return None
+            kind, lane, side, other, other_lane, component = match.groups()
+            port = '{}_{}'.format(kind, side) if kind else other
+            lane = lane if kind else other_lane
+        return (port, int(lane),
+                None if component is None else int(component))
+
+    def _index(self, kind, table, position, component):
+        """The index of an entry of a table of the given kind: table 0 and 1
+        are the two outputs of the cells of that kind, 2 and 3 the two ports
+        """
+        C, N = len(self.instances), self.N
+        width = 1 if kind == 'm' else 3
+        sizes = [C, C, N, N]
+        return width * (sum(sizes[:table]) + position) + (component or 0)
+
+    def _resolve(self, net, kind, where):
+        """The index in the table of kind of the value on the net
+        """
+        seen = set()
+        while True:
+            base = net.split('[')[0]
+            port = self._port(net)
+            if port is None and base not in self.declared:
+                raise NetlistError('{} of {} is not declared'.format(net,
+                                                                     where))
+            if net in self.drivers:
+                output, k, component = self.drivers[net]
+                if self.outputs[output] != kind:
+                    raise NetlistError('{} of {} is driven by {}'.format(
+                        net, where, output))
+                table = list(output for output in self.outputs
+                             if self.outputs[output] == kind).index(output)
+                return self._index(kind, table, k, component)
+            if net not in self.aliases:
+                break
+            if net in seen:
+                raise NetlistError('{} is assigned in a loop'.format(net))
+            seen.add(net)
+            net = self.aliases[net]
+
+        if port is None or self._direction(*port[:2]) != 'input':
+            raise NetlistError('{} of {} is not driven'.format(net, where))
+        name, lane, component = port
+        if self.ports[name] != kind or lane >= self.N or \
+           (component is None) != (kind in ('m', 'fold')) or \
+           (component is not None and component >= 3):
+            raise NetlistError('{} of {} is driven by {}'.format(
+                net, where, self._port_name(name, lane)))
+        if kind == 'fold':
+            return lane
+        table = 2 + [port for port in self.ports
+                     if self.ports[port] == kind].index(name)
+        return self._index(kind, table, lane, component)
+
+    def _components(self, net, kind):
+        """The nets of the components of a net of the given kind
+        """
+        if kind in ('m', 'fold'):
+            return [net]
+        return ['{}[{}]'.format(net, c) for c in range(3)]
+
+    def _connect(self):
+        """Finds the sources of the inputs of the cells and of the outputs
+        of the array
+        """
+        self.drivers = {}
+        for k, (_, _, connections) in enumerate(self.instances):
+            for output, kind in self.outputs.items():
+                net = connections.get(output, '')
+                for c, component in enumerate(self._components(net, kind)
+                                              if net else []):
+                    if component in self.drivers:
+                        raise NetlistError('{} is driven twice'.format(
+                            component))
+                    self.drivers[component] = (output, k,
+                                               None if kind == 'm' else c)
+
+        C = len(self.instances)
+        self.sources = {}
+        for port, kind in self.inputs.items():
+            self.sources[port] = np.zeros((C,) if kind == 'm' else (C, 3),
+                                          dtype=np.int64)
+        self.sources['fold'] = np.full((C), self.N, dtype=np.int64)
+        for k, (module, name, connections) in enumerate(self.instances):
+            ports = dict(self.inputs)
+            if module == self.fold_cell:
+                ports['fold'] = 'fold'
+            for port, kind in ports.items():
+                net = connections.get(port, '')
+                if not net:
+                    raise NetlistError('{} of {} is not connected'.format(
+                        port, name))
+                self.sources[port][k] = [
+                    self._resolve(component, kind, name)
+                    for component in self._components(net, kind)
+                ] if kind not in ('m', 'fold') else \
+                    self._resolve(net, kind, name)
+
+        self.results = {}
+        for port in ('out_pr', 'out_pd'):
+            self.results[port] = np.zeros((self.N, 3), dtype=np.int64)
+            for lane in range(self.N):
+                name = self._port_name(port, lane)
+                if self._direction(port, lane) != 'output':
+                    raise NetlistError('{} is not an output'.format(name))
+                self.results[port][lane] = [
+                    self._resolve(component, 'p', name)
+                    for component in self._components(name, 'p')
+                ]
+
+
+class ArraySimulator():
+    """The registers of the cells of a Netlist, with every cell updated at
+    once on each rising edge of the clock.
+
+    Cell k, in the order the netlist instantiates them, holds its output
+    registers at [k] of (C, 3) positions and partial sums and (C,) masses.
+    Its inputs are gathered every cycle from the outputs of the cells and
+    the ports driving them in the netlist, so out_pr and out_pd are what the
+    netlist connects to the outputs of the array.
+
+    The cells compute with reals like the design generated without --fixed,
+    or with the words and arithmetic of a fixed_point.FixedPoint. With the
+    latency L of the netlist's cells the force and the inputs of every cell
+    wait in L - 1 pipeline registers before the partial sums are added, as
+    in the cells generated with --latency.
+
+    The fold cells of an array generated with --fold swap the row and the
+    column when their fold bit is set: they add no force and their row
+    inputs, partial sums included, leave them downwards and their column
+    inputs to the right, through the same pipeline.
+    """
+    def __init__(self, netlist, fixed=None):
+        self.netlist = netlist
+        self.N = netlist.N
+        self.fixed = fixed
+        self.latency = netlist.latency
+        self.cycle = 0
+        dtype = np.float64 if fixed is None else np.int64
+        C = len(netlist.instances)
+
+        # The output registers of each cell
+        self.q_i = np.zeros((C, 3), dtype=dtype)
+        self.q_j = np.zeros((C, 3), dtype=dtype)
+        self.m_i = np.zeros((C), dtype=dtype)
+        self.m_j = np.zeros((C), dtype=dtype)
+        self.p_right = np.zeros((C, 3), dtype=dtype)
+        self.p_down = np.zeros((C, 3), dtype=dtype)
+        self.zero = np.zeros((1), dtype=dtype)
+        self.port_pr = np.zeros((self.N, 3), dtype=dtype)
+        self.port_pd = np.zeros((self.N, 3), dtype=dtype)
+
+        # The (f, in_p_right, in_p_down, in_q_i, in_q_j, in_m_i, in_m_j) of
+        # each pipeline stage, in a ring with the oldest at self.stage
+        self.pipeline = [[np.zeros_like(register) for register in
+                          (self.p_right, self.p_right, self.p_down, self.q_i,
+                           self.q_j, self.m_i, self.m_j)]
+                         for _ in range(self.latency - 1)]
+        self.stage = 0
+
+    def partial_sums(self):
+        """The table of the partial sums of the cells and the ports
+        """
+        return np.concatenate((self.p_right.ravel(), self.p_down.ravel(),
+                               self.port_pr.ravel(), self.port_pd.ravel(),
+                               self.zero))
+
+    @property
+    def out_pr(self):
+        """The (N, 3) partial sums leaving the right of the array
+        """
+        return self.partial_sums()[self.netlist.results['out_pr']]
+
+    @property
+    def out_pd(self):
+        """The (N, 3) partial sums leaving the bottom of the array
+        """
+        return self.partial_sums()[self.netlist.results['out_pd']]
+
+    def clock(self, q_i, q_j, m_i, m_j, pr=0, pd=0, fold=None):
+        """A rising edge of the clock with the given (N, 3) positions and
+        (N,) masses on the row (i) and column (j) ports, and the partial sums
+        entering the array, zero by default. fold is the (N,) fold bits of
+        the rows of a folding array
+        """
+        N = self.N
+        sources = self.netlist.sources
+        self.port_pr[:] = pr
+        self.port_pd[:] = pd
+        q = np.concatenate((self.q_i.ravel(), self.q_j.ravel(),
+                            np.ravel(q_i), np.ravel(q_j), self.zero))
+        m = np.concatenate((self.m_i, self.m_j, m_i, m_j, self.zero))
+        p = self.partial_sums()
+        in_q_i, in_q_j = q[sources['in_q_i']], q[sources['in_q_j']]
+        in_m_i, in_m_j = m[sources['in_m_i']], m[sources['in_m_j']]
+        in_pr, in_pd = p[sources['in_p_right']], p[sources['in_p_down']]
+
+        if self.fixed is None:
+            f_ij = codegen.cell_force(in_q_i, in_m_i, in_q_j, in_m_j)
+        else:
+            f_ij = self.fixed.interact(in_q_i, in_m_i, in_q_j, in_m_j)
+        fold = np.zeros((N), dtype=bool) if fold is None else fold
+        folding = self.netlist.folding & \
+                  np.append(fold, False)[sources['fold']]
+        if folding.any():
+            cells = np.flatnonzero(folding)
+            f_ij[cells] = 0
+            for row, column in ((in_q_i, in_q_j), (in_m_i, in_m_j),
+                                (in_pr, in_pd)):
+                row[cells], column[cells] = column[cells], row[cells]
+        current = [f_ij, in_pr, in_pd, in_q_i, in_q_j, in_m_i, in_m_j]
+
+        # The registers take the values leaving the last pipeline stage,
+        # which then takes this edge's
+        oldest = self.pipeline[self.stage] if self.pipeline else current
+        f_ij, in_pr, in_pd = oldest[:3]
+        if self.fixed is None:
+            np.add(in_pr, f_ij, out=self.p_right)
+            np.subtract(in_pd, f_ij, out=self.p_down)
+        else:
+            self.p_right[:] = self.fixed.saturate(in_pr + f_ij)
+            self.p_down[:] = self.fixed.saturate(in_pd - f_ij)
+        for register, value in zip((self.q_i, self.q_j, self.m_i, self.m_j),
+                                   oldest[3:]):
+            np.copyto(register, value)
+        if self.pipeline:
+            for stage, value in zip(oldest, current):
+                np.copyto(stage, value)
+            self.stage = (self.stage + 1) % len(self.pipeline)
+
+        self.cycle += 1
+
+
+def simulate(q, m, N, fixed=None, latency=1, fold=False, generate=False,
+             design=None):
+    """Drives an ArraySimulator with the n bodies of positions q (n, 3) and
+    masses m like the data file testbench, and returns the (n, 3) forces it
+    accumulates from the outputs.
+
+    Row u of the array starts block k at step k * N + u * L, feeding its
+    particle for N steps, and the sums of block k leave row u after step
+    k * N + (u + N) * L - 1 (and the same for the columns). The positions and
+    masses are words for a fixed-point array, and the forces are summed in 64
+    bit integers.
+
+    With fold the diagonal blocks are folded in pairs like the testbench
+    walks them. The diagonal cell of row u takes the particles fed at step
+    s - u * L and folds their blocks (a, c) with a >= c, whose forces on c
+    leave the right of the array and those on a the bottom.
+
+    The array is the Netlist of the design text, generated with
+    generate_design_code and these options if none is given. The stimulus
+    is skewed for the latency given, and the cells run at the netlist's.
+    """
+    n = len(m)
+    b = n // N
+    L = latency
+    block_i, block_j = np.triu_indices(b)
+    if fold:
+        block_i, block_j = np.array(codegen.folded_blocks(b)).T
+    blocks = len(block_i)
+    # the block rows of the forces leaving the right and bottom
+    block_r = np.minimum(block_i, block_j)
+    block_d = np.maximum(block_i, block_j)
+    steps = codegen.testbench_steps(N, n, latency, fold)
+
+    if design is None:
+        design = codegen.generate_design_code(N, fixed, latency, generate,
+                                              fold)
+    netlist = Netlist(design)
+    if netlist.N != N:
+        raise NetlistError('The design is a {0}x{0} array, not {1}x{1}'
+                           .format(netlist.N, N))
+    array = ArraySimulator(netlist, fixed)
+    forces = np.zeros((n, 3), dtype=array.p_right.dtype)
+    # The bodies with an extra zero one fed when a row is idle
+    q = np.concatenate((q, np.zeros((1, 3), dtype=q.dtype)))
+    m = np.concatenate((m, np.zeros((1), dtype=m.dtype)))
+    lanes = np.arange(N)
+
+    for s in range(steps):
+        # The sums that left the array after the last step
+        x = s - (lanes + N) * L
+        k = x // N
+        drained = (x >= 0) & (x % N == 0) & (k < blocks)
+        if drained.any():
+            u = lanes[drained]
+            i, j = block_r[k[drained]], block_d[k[drained]]
+            forces[i * N + u] += array.out_pr[u]
+            off = i != j
+            forces[j[off] * N + u[off]] += array.out_pd[u[off]]
+
+        # The particles fed on this step, n when none is
+        x = s - lanes * L
+        k = np.clip(x // N, 0, blocks - 1)
+        fed = (x >= 0) & (x // N < blocks)
+        rows = np.where(fed, block_i[k] * N + lanes, n)
+        cols = np.where(fed, block_j[k] * N + lanes, n)
+        folds = None
+        if fold:
+            x = s - 2 * lanes * L
+            k = np.clip(x // N, 0, blocks - 1)
+            folds = (x >= 0) & (x // N < blocks) & \
+                    (block_i[k] >= block_j[k])
+        array.clock(q[rows], q[cols], m[rows], m[cols], fold=folds)
+
+    return forces
+
+
+def compare(forces, expected, fixed=None, tol=1e-9):
+    """The number of force components that differ from the expected ones as
+    the testbench checks them: exactly for fixed-point forces, and relative
+    to the expected force by more than tol for reals
+    """
+    if fixed is not None:
+        return int(np.count_nonzero(forces != expected))
+    return int(np.count_nonzero(np.abs(forces - expected) >
+                                tol * np.abs(expected)))
+
+
+def check(N, n, fixed=None, latency=1, seed=0, data=None, binary=False,
+          fold=False, generate=False, design=None):
+    """Simulates the array for the bodies of the testbench, from its data
+    files if given and otherwise generated like them with the seed. The
+    array is read from the design text, or generated. Returns
+    the number of force components that differ from the expected ones and
+    the steps simulated
+    """
+    if data is not None:
+        q, m, expected = codegen.read_data_files(data, fixed is not None,
+                                                 binary)
+    else:
+        q, m = codegen.initial_conditions(n, seed)
+        if fixed is None:
+            expected = codegen.expected_forces(q, m, N, fold)
+        else:
+            q, m = fixed.quantize(q, m)
+            expected = fixed.forces(q, m, N, fold)
+    if len(m) % N != 0:
+        raise ValueError('N ({}) must divide n ({})'.format(N, len(m)))
+
+    forces = simulate(q, m, N, fixed, latency, fold, generate, design)
+    steps = codegen.testbench_steps(N, len(m), latency, fold)
+    return compare(forces, expected, fixed), steps
+
+
+def regress(configurations):
+    """Checks each (N, n, fixed, latency, fold, generate) of the
+    configurations, printing the ones that fail. Returns whether all of them
+    pass
+    """
+    passed = True
+    for N, n, fixed, latency, fold, generate in configurations:
+        errors, _ = check(N, n, fixed, latency, fold=fold, generate=generate)
+        if errors:
+            passed = False
+            print('N={} n={} fixed={} latency={} fold={} generate={}: {} of '
+                  '{} force components differ'.format(
+                      N, n, fixed is not None, latency, fold, generate,
+                      errors, 3 * n))
+    return passed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Simulates the generated systolic array with NumPy and '
+                    'checks the forces like the data file testbench. Without '
+                    'N and n a grid of configurations is checked.')
+    parser.add_argument('N', type=int, nargs='?',
+                        help='The size of the systolic array.')
+    parser.add_argument('n', type=int, nargs='?',
+                        help='The number of bodies.')
+    parser.add_argument('--data', type=str, metavar='PREFIX',
+                        help='Read the bodies and expected forces from the '
+                             'data files of a testbench.')
+    parser.add_argument('--binary', action='store_true',
+                        help='The data files are binary.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the random bodies without --data.')
+    parser.add_argument('--fixed', action='store_true',
+                        help='Simulate the fixed-point cells with the word '
+                             'lengths below.')
+    fixed_point.add_arguments(parser)
+    parser.add_argument('--latency', type=int, default=1, metavar='L',
+                        help='The pipeline stages of the cells.')
+    parser.add_argument('--fold', action='store_true',
+                        help='Fold the diagonal blocks in pairs.')
+    parser.add_argument('--generate', action='store_true',
+                        help='Simulate the array built with generate loops.')
+    parser.add_argument('--design', type=str, metavar='FILE',
+                        help='Simulate the array of a design file instead of '
+                             'generating one.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    fixed = fixed_point.from_args(args) if args.fixed else None
+
+    if args.N is None:
+        configurations = [(N, n, word, latency, fold, generate)
+                          for N in (1, 2, 3, 4, 8)
+                          for n in (N, 3 * N, 8 * N)
+                          for word in (None, fixed_point.FixedPoint())
+                          for latency in (1, 3)
+                          for fold in (False, True)
+                          for generate in (False, True)]
+        start = time.perf_counter()
+        if not regress(configurations):
+            raise SystemExit(1)
+        print('{} configurations pass ({:.1f} s)'.format(
+            len(configurations), time.perf_counter() - start))
+        return
+
+    n = args.n if args.n is not None else 0
+    design = None
+    if args.design:
+        with open(args.design) as f:
+            design = f.read()
+    start = time.perf_counter()
+    try:
+        errors, steps = check(args.N, n, fixed, args.latency, args.seed,
+                              args.data, args.binary, args.fold,
+                              args.generate, design)
+    except NetlistError as error:
+        raise SystemExit('FAILED: {}'.format(error))
+    elapsed = time.perf_counter() - start
+    if errors == 0:
+        print('PASSED: the forces on all bodies match ({} steps in {:.1f} s)'
+              .format(steps, elapsed))
+    else:
+        print('FAILED: {} force components differ'.format(errors))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
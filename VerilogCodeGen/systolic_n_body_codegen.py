@@ -6,6 +6,12 @@
 # Developed by William McInroy, 2020/07/17.
 
 import argparse
+import io
+import math
+
+import numpy as np
+
+import fixed_point
 
 
 def parse_args():
@@ -20,352 +26,1036 @@ def parse_args():
                         help='The size of the systolic array.')
     parser.add_argument('n', type=int,
                         help='The number of bodies for testbench file.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print the block of every input and output step.')
+    parser.add_argument('--data', type=str, metavar='PREFIX',
+                        help='Write the initial conditions and expected '
+                             'forces to data files starting with PREFIX, '
+                             'read by the testbench instead of inlined.')
+    parser.add_argument('--binary', action='store_true',
+                        help='Write binary data files read with $fread '
+                             'instead of hex files read with $readmemh.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the random initial conditions.')
+    parser.add_argument('--fixed', action='store_true',
+                        help='Generate synthesizable fixed-point cells with '
+                             'the word lengths below. The testbench needs '
+                             '--data.')
+    fixed_point.add_arguments(parser)
+    parser.add_argument('--latency', type=int, default=1, metavar='L',
+                        help='Pipeline the cells over L stages, so their '
+                             'outputs come L cycles after their inputs. The '
+                             'testbench needs --data when L > 1.')
+    parser.add_argument('--generate', action='store_true',
+                        help='Generate a systolic_NxN_3D parameterized by N '
+                             'built with generate loops, whose size does not '
+                             'depend on N. The testbench needs --data.')
+    parser.add_argument('--fold', action='store_true',
+                        help='Fold pairs of diagonal blocks into one block, '
+                             'with diagonal cells that can swap the row and '
+                             'the column. The testbench needs --data.')
     return parser.parse_args()
 
 
-def generate_design_code(N):
+def _write_joined(f, sep, items, strip_last=False):
+    """Writes the items separated by sep, like f.write(sep.join(items)),
+    without building the string. With strip_last the last character of the
+    last item (its trailing comma) is left out.
+    """
+    previous = None
+    for item in items:
+        if previous is not None:
+            f.write(previous + sep)
+        previous = item
+    if previous is not None:
+        f.write(previous[:-1] if strip_last else previous)
+
+
+def generate_design_code(N, fixed=None, latency=1, generate=False,
+                         fold=False):
     """A function to generate the SystemVerilog code for a systolic n-body.
 
-    TODO: change from real to some synthesizable other form.
+    The cells use real ports and $sqrt unless fixed, a FixedPoint from
+    fixed_point, is given. Then the cells are synthesizable and use the
+    fixed-point words and arithmetic it describes.
+
+    With a latency above 1 the cells are pipelined over that many stages:
+    f_ij and the cell's inputs pass through latency - 1 registers before the
+    partial sums are added, so every output of a cell comes latency cycles
+    after its inputs. The registers follow the arithmetic, for the retiming
+    of synthesis to spread them through it.
+
+    With generate the array is the module systolic_NxN_3D #(parameter N),
+    which builds the cells with generate loops and has a port per kind of
+    input and output indexed by the row or column, so the code does not grow
+    with N and serves every size of array. N is only its default. The ports
+    of fixed-point arrays are packed, the real ones unpacked.
+
+    With fold the diagonal cells are systolic_n_body_3D_fold_cells, which
+    swap the row and the column when the array's fold input of their row is
+    set, so a folded block (a, c) computes the upper triangle of the
+    diagonal block (c, c) above the diagonal and the lower triangle of
+    (a, a) below it, and the two diagonal blocks take one pass.
+    """
+    f = io.StringIO()
+    write_design_code(f, N, fixed, latency, generate, fold)
+    return f.getvalue()
+
+
+def _types(fixed, kind='wire'):
+    """The SystemVerilog types of the positions, masses and partial forces.
+    """
+    if fixed is None:
+        return {'q': 'real', 'm': 'real', 'p': 'real'}
+    return {'q': '{} signed [{}:0]'.format(kind, fixed.q_width - 1),
+            'm': '{} [{}:0]'.format(kind, fixed.m_width - 1),
+            'p': '{} signed [{}:0]'.format(kind, fixed.p_width - 1)}
+
+
+def _write_pipeline_declarations(f, latency, types):
+    """Writes the pipeline registers of a cell pipelined over latency stages,
+    with the given types of the positions, masses and partial forces.
+    """
+    if latency == 1:
+        return
+    f.write('  // The L - 1 pipeline registers f_ij and the inputs pass '
+            'through before the\n'
+            '  // partial sums are added, so the outputs come L cycles after '
+            'the inputs\n'
+            '  localparam L = {};\n'.format(latency) +
+            '  {} f_pipe[L-1][3];\n'.format(types['p']) +
+            '  {} p_right_pipe[L-1][3];\n'.format(types['p']) +
+            '  {} p_down_pipe[L-1][3];\n'.format(types['p']) +
+            '  {} q_i_pipe[L-1][3];\n'.format(types['q']) +
+            '  {} q_j_pipe[L-1][3];\n'.format(types['q']) +
+            '  {} m_i_pipe[L-1];\n'.format(types['m']) +
+            '  {} m_j_pipe[L-1];\n'.format(types['m']) +
+            '  integer stage;\n\n')
+
+
+def _write_pipeline_registers(f):
+    """Writes the shifting of f_ij and the inputs through the pipeline
+    registers, which retiming moves into the arithmetic before them.
     """
+    f.write('    // f_ij and the inputs move down the pipeline, and '
+            'retiming spreads its\n'
+            '    // registers through the arithmetic above\n'
+            '    f_pipe[0] <= f_ij;\n'
+            '    p_right_pipe[0] <= in_p_right;\n'
+            '    p_down_pipe[0] <= in_p_down;\n'
+            '    q_i_pipe[0] <= in_q_i;\n'
+            '    q_j_pipe[0] <= in_q_j;\n'
+            '    m_i_pipe[0] <= in_m_i;\n'
+            '    m_j_pipe[0] <= in_m_j;\n'
+            '    for (stage = 1; stage < L - 1; stage = stage + 1) begin\n'
+            '      f_pipe[stage] <= f_pipe[stage - 1];\n'
+            '      p_right_pipe[stage] <= p_right_pipe[stage - 1];\n'
+            '      p_down_pipe[stage] <= p_down_pipe[stage - 1];\n'
+            '      q_i_pipe[stage] <= q_i_pipe[stage - 1];\n'
+            '      q_j_pipe[stage] <= q_j_pipe[stage - 1];\n'
+            '      m_i_pipe[stage] <= m_i_pipe[stage - 1];\n'
+            '      m_j_pipe[stage] <= m_j_pipe[stage - 1];\n'
+            '    end\n\n'
+            '    // the partial sums are added as they leave the last stage\n')
+
+
+def _write_pipeline_outputs(f):
+    """Writes the positions and masses leaving the last pipeline stage and
+    the end of the cell.
+    """
+    f.write('    out_q_i <= q_i_pipe[L-2];\n'
+            '    out_q_j <= q_j_pipe[L-2];\n'
+            '    out_m_i <= m_i_pipe[L-2];\n'
+            '    out_m_j <= m_j_pipe[L-2];\n'
+            '  end\n\n'
+            'endmodule  // end of single systolic cell module\n\n\n')
+
+
+def _write_real_cell(f, latency=1):
+    """Writes the cell computing with reals, pipelined over latency stages.
+    """
+    f.write('// We have ports for each input/output\n'
+            'module systolic_n_body_3D_cell(input wire clk,\n'
+            '                               input real in_q_i[3],\n'
+            '                               input real in_q_j[3],\n'
+            '                               input real in_m_i,\n'
+            '                               input real in_m_j,\n'
+            '                               input real in_p_right[3],\n'
+            '                               input real in_p_down[3],\n'
+            '                               output real out_q_i[3],\n'
+            '                               output real out_q_j[3],\n'
+            '                               output real out_m_i,\n'
+            '                               output real out_m_j,\n'
+            '                               output real out_p_right[3],\n'
+            '                               output real out_p_down[3]);\n\n'
+            '  real diff[3];\n'
+            '  real denom;\n'
+            '  real scale;\n'
+            '  real f_ij[3];\n\n')
+    _write_pipeline_declarations(f, latency, _types(None))
+
+    f.write('  // When the clock cycle hits the next input, '
+            'then proceed with calculations\n'
+            '  always @(posedge clk) begin\n'
+            '    diff[0] = in_q_j[0] - in_q_i[0];\n'
+            '    diff[1] = in_q_j[1] - in_q_i[1];\n'
+            '    diff[2] = in_q_j[2] - in_q_i[2];\n'
+            '    denom = $sqrt(diff[0] * diff[0] + diff[1] * diff[1] + '
+            'diff[2] * diff[2]);\n'
+            '    if (denom < 1e-8) begin\n'
+            '      f_ij[0] = 0;\n'
+            '      f_ij[1] = 0;\n'
+            '      f_ij[2] = 0;\n'
+            '    end else begin\n'
+            '      // Gravity causes errors, use in verlet\n'
+            '      scale = in_m_i * in_m_j / denom / denom / denom;\n'
+            '      f_ij[0] = scale * diff[0];\n'
+            '      f_ij[1] = scale * diff[1];\n'
+            '      f_ij[2] = scale * diff[2];\n'
+            '    end\n\n')
+    if latency > 1:
+        _write_pipeline_registers(f)
+        f.write('    out_p_right[0] <= p_right_pipe[L-2][0] + '
+                'f_pipe[L-2][0];\n'
+                '    out_p_right[1] <= p_right_pipe[L-2][1] + '
+                'f_pipe[L-2][1];\n'
+                '    out_p_right[2] <= p_right_pipe[L-2][2] + '
+                'f_pipe[L-2][2];\n'
+                '    out_p_down[0] <= p_down_pipe[L-2][0] - '
+                'f_pipe[L-2][0];\n'
+                '    out_p_down[1] <= p_down_pipe[L-2][1] - '
+                'f_pipe[L-2][1];\n'
+                '    out_p_down[2] <= p_down_pipe[L-2][2] - '
+                'f_pipe[L-2][2];\n')
+        _write_pipeline_outputs(f)
+        return
+
+    f.write('    out_p_right[0] <= in_p_right[0] + f_ij[0];\n'
+            '    out_p_right[1] <= in_p_right[1] + f_ij[1];\n'
+            '    out_p_right[2] <= in_p_right[2] + f_ij[2];\n'
+            '    out_p_down[0] <= in_p_down[0] - f_ij[0];\n'
+            '    out_p_down[1] <= in_p_down[1] - f_ij[1];\n'
+            '    out_p_down[2] <= in_p_down[2] - f_ij[2];\n'
+            '    out_q_i[0] <= in_q_i[0];\n'
+            '    out_q_i[1] <= in_q_i[1];\n'
+            '    out_q_i[2] <= in_q_i[2];\n'
+            '    out_q_j[0] <= in_q_j[0];\n'
+            '    out_q_j[1] <= in_q_j[1];\n'
+            '    out_q_j[2] <= in_q_j[2];\n'
+            '    out_m_i <= in_m_i;\n'
+            '    out_m_j <= in_m_j;\n'
+            '  end\n\n'
+            'endmodule  // end of single systolic cell module\n\n\n')
+
+
+def _write_fixed_cell(f, fixed, latency=1):
+    """Writes the synthesizable cell computing with the fixed-point words of
+    fixed, bit for bit as FixedPoint.interact models it, pipelined over
+    latency stages.
+    """
+    f.write('// We have ports for each input/output. Positions are signed QW '
+            'bit words with\n'
+            '// QF fractional bits, masses unsigned MW bit words with MF and '
+            'the partial\n'
+            '// forces signed PW bit words with PF.\n'
+            'module systolic_n_body_3D_cell #(parameter QW = {}, QF = {}, '
+            'MW = {}, MF = {},\n'
+            '                                           PW = {}, PF = {})\n'
+            .format(fixed.q_width, fixed.q_frac, fixed.m_width, fixed.m_frac,
+                    fixed.p_width, fixed.p_frac) +
+            '                               (input wire clk,\n'
+            '                                input wire signed [QW-1:0] '
+            'in_q_i[3],\n'
+            '                                input wire signed [QW-1:0] '
+            'in_q_j[3],\n'
+            '                                input wire [MW-1:0] in_m_i,\n'
+            '                                input wire [MW-1:0] in_m_j,\n'
+            '                                input wire signed [PW-1:0] '
+            'in_p_right[3],\n'
+            '                                input wire signed [PW-1:0] '
+            'in_p_down[3],\n'
+            '                                output logic signed [QW-1:0] '
+            'out_q_i[3],\n'
+            '                                output logic signed [QW-1:0] '
+            'out_q_j[3],\n'
+            '                                output logic [MW-1:0] out_m_i,\n'
+            '                                output logic [MW-1:0] out_m_j,\n'
+            '                                output logic signed [PW-1:0] '
+            'out_p_right[3],\n'
+            '                                output logic signed [PW-1:0] '
+            'out_p_down[3]);\n\n'
+            '  // 1 / sqrt(r^2) is looked up from r^2 normalized to [1, 4) '
+            'and refined by\n'
+            '  // Newton-Raphson steps, the 4^e normalizing it is shifted '
+            'back at the end\n'
+            '  localparam RF = {};  // fractional bits of 1 / sqrt\n'
+            .format(fixed.rsqrt_frac) +
+            '  localparam LUT_BITS = {};  // index bits of its table\n'
+            .format(fixed.lut_bits) +
+            '  localparam NEWTON = {};\n'.format(fixed.newton) +
+            '  localparam R2W = 2 * QW + 2;\n'
+            '  localparam MYW = 2 * MW - MF + RF + 3;\n'
+            '  localparam FW = MYW + QW + 2;\n'
+            '  localparam logic signed [FW+PW:0] P_MAX = '
+            '{{(FW + 2){1\'b0}}, {(PW - 1){1\'b1}}};\n'
+            '  localparam logic signed [FW+PW:0] P_MIN = -P_MAX - 1;\n\n'
+            '  logic signed [QW:0] diff[3];\n'
+            '  logic [R2W-1:0] r2;\n'
+            '  logic [RF+1:0] mn;\n'
+            '  logic [RF:0] y;\n'
+            '  logic [RF+3:0] t;\n'
+            '  logic [2*RF+4:0] prod;\n'
+            '  logic [2*MW-1:0] mm;\n'
+            '  logic [MYW-1:0] my;\n'
+            '  logic signed [FW-1:0] f_wide;\n'
+            '  logic signed [FW+PW:0] wide;\n'
+            '  logic signed [PW-1:0] f_ij[3];\n'
+            '  integer b, c, k, e2, shift;\n\n')
+    _write_pipeline_declarations(f, latency, {
+        'q': 'logic signed [QW-1:0]', 'm': 'logic [MW-1:0]',
+        'p': 'logic signed [PW-1:0]'})
+    f.write('  // 1 / sqrt(m) at the middle of each interval of m in [1, 4), '
+            'from the top\n'
+            '  // LUT_BITS bits of m\n'
+            '  function automatic logic [RF:0] rsqrt_lut('
+            'input logic [LUT_BITS-1:0] index);\n'
+            '    case (index)\n')
+    lut = fixed.lut()
+    for index in range(1 << (fixed.lut_bits - 2), len(lut)):
+        f.write('      {}: rsqrt_lut = {};\n'.format(index, lut[index]))
+    f.write('      default: rsqrt_lut = 0;\n'
+            '    endcase\n'
+            '  endfunction\n\n'
+            '  function automatic logic signed [PW-1:0] saturate('
+            'input logic signed [FW+PW:0] x);\n'
+            '    if (x > P_MAX)\n'
+            '      return P_MAX[PW-1:0];\n'
+            '    if (x < P_MIN)\n'
+            '      return P_MIN[PW-1:0];\n'
+            '    return x[PW-1:0];\n'
+            '  endfunction\n\n'
+            '  // When the clock cycle hits the next input, '
+            'then proceed with calculations\n'
+            '  always @(posedge clk) begin\n'
+            '    diff[0] = in_q_j[0] - in_q_i[0];\n'
+            '    diff[1] = in_q_j[1] - in_q_i[1];\n'
+            '    diff[2] = in_q_j[2] - in_q_i[2];\n'
+            '    r2 = diff[0] * diff[0] + diff[1] * diff[1] + '
+            'diff[2] * diff[2];\n\n'
+            '    // the leading one of r^2, rounded down to an even bit\n'
+            '    e2 = 0;\n'
+            '    for (b = 0; b < R2W; b = b + 1)\n'
+            '      if (r2[b])\n'
+            '        e2 = b;\n'
+            '    e2 = e2 - e2 % 2;\n\n'
+            '    // 1 / sqrt of r^2 / 4^(e2 / 2), which is in [1, 4)\n'
+            '    if (e2 >= RF)\n'
+            '      mn = r2 >> (e2 - RF);\n'
+            '    else\n'
+            '      mn = r2 << (RF - e2);\n'
+            '    y = rsqrt_lut(mn >> (RF + 2 - LUT_BITS));\n'
+            '    for (k = 0; k < NEWTON; k = k + 1) begin\n'
+            '      prod = y * y;\n'
+            '      prod = mn * (prod >> RF);\n'
+            '      t = prod >> RF;\n'
+            '      prod = y * ((3 << RF) - t);\n'
+            '      y = prod >> (RF + 1);\n'
+            '    end\n\n'
+            '    // m_i * m_j / sqrt(m)^3, with MF + RF fractional bits\n'
+            '    prod = y * y;\n'
+            '    prod = (prod >> RF) * y;\n'
+            '    mm = (in_m_i * in_m_j) >> MF;\n'
+            '    my = mm * (prod >> RF);\n\n'
+            '    // times diff, shifted by the 1 / 8^(e2 / 2 - QF) left out '
+            'of 1 / r^3\n'
+            '    shift = MF + RF + QF - PF + 3 * ((e2 - 2 * QF) / 2);\n'
+            '    for (c = 0; c < 3; c = c + 1) begin\n'
+            '      f_wide = $signed({1\'b0, my}) * diff[c];\n'
+            '      if (r2 == 0) begin\n'
+            '        f_ij[c] = 0;\n'
+            '      end else if (shift >= 0) begin\n'
+            '        f_ij[c] = saturate(f_wide >>> shift);\n'
+            '      end else begin\n'
+            '        wide = f_wide;\n'
+            '        f_ij[c] = saturate(wide <<< (-shift > PW ? PW : '
+            '-shift));\n'
+            '      end\n')
+    if latency > 1:
+        f.write('    end\n\n')
+        _write_pipeline_registers(f)
+        f.write('    for (c = 0; c < 3; c = c + 1) begin\n'
+                '      wide = p_right_pipe[L-2][c] + f_pipe[L-2][c];\n'
+                '      out_p_right[c] <= saturate(wide);\n'
+                '      wide = p_down_pipe[L-2][c] - f_pipe[L-2][c];\n'
+                '      out_p_down[c] <= saturate(wide);\n'
+                '    end\n')
+        _write_pipeline_outputs(f)
+        return
+
+    f.write('\n'
+            '      wide = in_p_right[c] + f_ij[c];\n'
+            '      out_p_right[c] <= saturate(wide);\n'
+            '      wide = in_p_down[c] - f_ij[c];\n'
+            '      out_p_down[c] <= saturate(wide);\n'
+            '      out_q_i[c] <= in_q_i[c];\n'
+            '      out_q_j[c] <= in_q_j[c];\n'
+            '    end\n'
+            '    out_m_i <= in_m_i;\n'
+            '    out_m_j <= in_m_j;\n'
+            '  end\n\n'
+            'endmodule  // end of single systolic cell module\n\n\n')
+
+
+def _write_fold_cell(f, fixed=None, latency=1):
+    """Writes the diagonal cell of an array folding diagonal blocks, a
+    systolic_n_body_3D_cell whose outputs are swapped while folding.
+    """
+    if fixed is None:
+        kinds = {'in_q': 'input real', 'in_m': 'input real',
+                 'in_p': 'input real', 'out_q': 'output real',
+                 'out_m': 'output real', 'out_p': 'output real'}
+        types = _types(None)
+        header = 'module systolic_n_body_3D_fold_cell'
+        params = ''
+    else:
+        kinds = {'in_q': 'input wire signed [QW-1:0]',
+                 'in_m': 'input wire [MW-1:0]',
+                 'in_p': 'input wire signed [PW-1:0]',
+                 'out_q': 'output logic signed [QW-1:0]',
+                 'out_m': 'output logic [MW-1:0]',
+                 'out_p': 'output logic signed [PW-1:0]'}
+        types = {'q': 'logic signed [QW-1:0]', 'm': 'logic [MW-1:0]',
+                 'p': 'logic signed [PW-1:0]'}
+        header = 'module systolic_n_body_3D_fold_cell'
+        header += (' #(parameter QW = {}, QF = {}, MW = {},\n'
+                   .format(fixed.q_width, fixed.q_frac, fixed.m_width) +
+                   ' ' * len(header + ' #(parameter ') +
+                   'MF = {}, PW = {}, PF = {})\n'
+                   .format(fixed.m_frac, fixed.p_width, fixed.p_frac) +
+                   ' ' * len(header))
+        params = (' #(.QW(QW), .QF(QF), .MW(MW), .MF(MF),\n' +
+                  ' ' * len('  systolic_n_body_3D_cell') +
+                  '   .PW(PW), .PF(PF))\n' +
+                  ' ' * len('  systolic_n_body_3D_cell'))
+
+    s = '\n' + ' ' * len(header.split('\n')[-1] + '(')
+    f.write('// The diagonal cell of an array folding diagonal blocks. With '
+            'fold set along with\n'
+            '// its inputs the cell swaps the row and the column instead of '
+            'adding a force:\n'
+            '// the particle, mass and partial sums coming from the left '
+            'leave it downwards\n'
+            '// and those coming from above to the right, L cycles later like '
+            'its outputs.\n'
+            '// The cells above the diagonal then pair the column particles '
+            'of the block and\n'
+            '// those below it the row particles.\n' +
+            header + '(input wire clk,' + s + 'input wire fold,' + s)
+    _write_joined(f, s, ['{} {}[3],'.format(kinds['in_q'], 'in_q_i'),
+                         '{} {}[3],'.format(kinds['in_q'], 'in_q_j'),
+                         '{} {},'.format(kinds['in_m'], 'in_m_i'),
+                         '{} {},'.format(kinds['in_m'], 'in_m_j'),
+                         '{} {}[3],'.format(kinds['in_p'], 'in_p_right'),
+                         '{} {}[3],'.format(kinds['in_p'], 'in_p_down'),
+                         '{} {}[3],'.format(kinds['out_q'], 'out_q_i'),
+                         '{} {}[3],'.format(kinds['out_q'], 'out_q_j'),
+                         '{} {},'.format(kinds['out_m'], 'out_m_i'),
+                         '{} {},'.format(kinds['out_m'], 'out_m_j'),
+                         '{} {}[3],'.format(kinds['out_p'], 'out_p_right'),
+                         '{} {}[3],'.format(kinds['out_p'], 'out_p_down')],
+                  strip_last=True)
+    s = ' ' * len('  systolic_n_body_3D_cell cell(')
+    f.write(');\n\n'
+            '  localparam L = {};\n\n'.format(latency) +
+            '  // The outputs of the cell\n'
+            '  {q} q_i_c[3];\n'
+            '  {q} q_j_c[3];\n'
+            '  {m} m_i_c;\n'
+            '  {m} m_j_c;\n'
+            '  {p} p_right_c[3];\n'
+            '  {p} p_down_c[3];\n\n'
+            '  // fold and the partial sums entering the cell, delayed like '
+            'its outputs\n'
+            '  logic fold_pipe[L];\n'
+            '  {p} p_right_pipe[L][3];\n'
+            '  {p} p_down_pipe[L][3];\n'
+            '  integer stage, c;\n\n'.format(**types) +
+            '  systolic_n_body_3D_cell' + params + ' cell(.clk(clk),\n' +
+            s + '.in_q_i(in_q_i), .in_q_j(in_q_j),\n' +
+            s + '.in_m_i(in_m_i), .in_m_j(in_m_j),\n' +
+            s + '.in_p_right(in_p_right), .in_p_down(in_p_down),\n' +
+            s + '.out_q_i(q_i_c), .out_q_j(q_j_c),\n' +
+            s + '.out_m_i(m_i_c), .out_m_j(m_j_c),\n' +
+            s + '.out_p_right(p_right_c), .out_p_down(p_down_c));\n\n'
+            '  always @(posedge clk) begin\n'
+            '    fold_pipe[0] <= fold;\n'
+            '    p_right_pipe[0] <= in_p_right;\n'
+            '    p_down_pipe[0] <= in_p_down;\n'
+            '    for (stage = 1; stage < L; stage = stage + 1) begin\n'
+            '      fold_pipe[stage] <= fold_pipe[stage - 1];\n'
+            '      p_right_pipe[stage] <= p_right_pipe[stage - 1];\n'
+            '      p_down_pipe[stage] <= p_down_pipe[stage - 1];\n'
+            '    end\n'
+            '  end\n\n'
+            '  // Folding, the row and the column cross over\n'
+            '  always_comb begin\n'
+            '    for (c = 0; c < 3; c = c + 1) begin\n'
+            '      out_q_i[c] = fold_pipe[L-1] ? q_j_c[c] : q_i_c[c];\n'
+            '      out_q_j[c] = fold_pipe[L-1] ? q_i_c[c] : q_j_c[c];\n'
+            '      out_p_right[c] = fold_pipe[L-1] ? p_down_pipe[L-1][c] : '
+            'p_right_c[c];\n'
+            '      out_p_down[c] = fold_pipe[L-1] ? p_right_pipe[L-1][c] : '
+            'p_down_c[c];\n'
+            '    end\n'
+            '    out_m_i = fold_pipe[L-1] ? m_j_c : m_i_c;\n'
+            '    out_m_j = fold_pipe[L-1] ? m_i_c : m_j_c;\n'
+            '  end\n\n'
+            'endmodule  // end of the folding diagonal cell module\n\n\n')
+
+
+def write_design_code(f, N, fixed=None, latency=1, generate=False,
+                      fold=False):
+    """Writes the SystemVerilog code for a systolic n-body to the file f as it
+    is generated, so memory stays bounded for any N. See generate_design_code
+    for fixed, latency, generate and fold.
+    """
+    if latency < 1:
+        raise ValueError('The cells need a latency of at least 1')
+    types = _types(fixed)
     # start with the header
-    code = ('// Systolic array for n-body simulations. Generated code.\n'
+    f.write('// Systolic array for n-body simulations. Generated code.\n'
             '//\n'
             '// This program implements a {0}x{0} '.format(N) +
             'systolic array for n-body simulations.\n\n\n')
     # add the cell code
-    code += ('// We have ports for each input/output\n'
-             'module systolic_n_body_3D_cell(input wire clk,\n'
-             '                               input real in_q_i[3],\n'
-             '                               input real in_q_j[3],\n'
-             '                               input real in_m_i,\n'
-             '                               input real in_m_j,\n'
-             '                               input real in_p_right[3],\n'
-             '                               input real in_p_down[3],\n'
-             '                               output real out_q_i[3],\n'
-             '                               output real out_q_j[3],\n'
-             '                               output real out_m_i,\n'
-             '                               output real out_m_j,\n'
-             '                               output real out_p_right[3],\n'
-             '                               output real out_p_down[3]);\n\n'
-             '  real diff[3];\n'
-             '  real denom;\n'
-             '  real scale;\n'
-             '  real f_ij[3];\n\n'
-
-             '  // When the clock cycle hits the next input, '
-             'then proceed with calculations\n'
-             '  always @(posedge clk) begin\n'
-             '    diff[0] = in_q_j[0] - in_q_i[0];\n'
-             '    diff[1] = in_q_j[1] - in_q_i[1];\n'
-             '    diff[2] = in_q_j[2] - in_q_i[2];\n'
-             '    denom = $sqrt(diff[0] * diff[0] + diff[1] * diff[1] + '
-             'diff[2] * diff[2]);\n'
-             '    if (denom < 1e-8) begin\n'
-             '      f_ij[0] = 0;\n'
-             '      f_ij[1] = 0;\n'
-             '      f_ij[2] = 0;\n'
-             '    end else begin\n'
-             '      // Gravity causes errors, use in verlet\n'
-             '      scale = in_m_i * in_m_j / denom / denom / denom;\n'
-             '      f_ij[0] = scale * diff[0];\n'
-             '      f_ij[1] = scale * diff[1];\n'
-             '      f_ij[2] = scale * diff[2];\n'
-             '    end\n\n'
-             '    out_p_right[0] <= in_p_right[0] + f_ij[0];\n'
-             '    out_p_right[1] <= in_p_right[1] + f_ij[1];\n'
-             '    out_p_right[2] <= in_p_right[2] + f_ij[2];\n'
-             '    out_p_down[0] <= in_p_down[0] - f_ij[0];\n'
-             '    out_p_down[1] <= in_p_down[1] - f_ij[1];\n'
-             '    out_p_down[2] <= in_p_down[2] - f_ij[2];\n'
-             '    out_q_i[0] <= in_q_i[0];\n'
-             '    out_q_i[1] <= in_q_i[1];\n'
-             '    out_q_i[2] <= in_q_i[2];\n'
-             '    out_q_j[0] <= in_q_j[0];\n'
-             '    out_q_j[1] <= in_q_j[1];\n'
-             '    out_q_j[2] <= in_q_j[2];\n'
-             '    out_m_i <= in_m_i;\n'
-             '    out_m_j <= in_m_j;\n'
-             '  end\n\n'
-             'endmodule  // end of single systolic cell module\n\n\n')
+    if fixed is None:
+        _write_real_cell(f, latency)
+    else:
+        _write_fixed_cell(f, fixed, latency)
+    if fold:
+        _write_fold_cell(f, fixed, latency)
+
+    if generate:
+        _write_generic_array(f, N, fixed, fold)
+        return
 
     # Now we add the design for the NxN array on the chip (assume it fits)
 
     # the module definition
     s = '\n' + (' ' * len('module systolic_{0}x{0}_3D('.format(N)))
-    code += ('// This module computes a single {0}x{0} '.format(N) +
-             'execution of the systolic array.\n'
-             'module systolic_{0}x{0}_3D(input wire clk,'.format(N) + s +
-             s.join(['input real q_' + str(i) + 'i[3],'  # input row pos
-                     for i in range(N)]) + s +
-             s.join(['input real q_' + str(i) + 'j[3],'  # input col pos
-                     for i in range(N)]) + s +
-             s.join(['input real m_' + str(i) + 'i,'  # input row mass
-                     for i in range(N)]) + s +
-             s.join(['input real m_' + str(i) + 'j,'  # input col mass
-                     for i in range(N)]) + s +
-             s.join(['input real pd_' + str(i) + '[3],'  # input down acc
-                     for i in range(N)]) + s +
-             s.join(['input real pr_' + str(i) + '[3],'  # input right acc
-                     for i in range(N)]) + s +
-             s.join(['output real out_pd_' + str(i) + '[3],'  # out down
-                     for i in range(N)]) + s +
-             s.join(['output real out_pr_' + str(i) + '[3],'  # out right
-                     for i in range(N)])[:-1] + ');\n')
+    f.write('// This module computes a single {0}x{0} '.format(N) +
+            'execution of the systolic array.\n'
+            'module systolic_{0}x{0}_3D(input wire clk,'.format(N) + s)
+    ports = [port.format(types[kind], i)
+             for port, kind in (('input {} q_{}i[3],', 'q'),  # input row pos
+                                ('input {} q_{}j[3],', 'q'),  # input col pos
+                                ('input {} m_{}i,', 'm'),  # input row mass
+                                ('input {} m_{}j,', 'm'),  # input col mass
+                                ('input {} pd_{}[3],', 'p'),  # input down acc
+                                ('input {} pr_{}[3],', 'p'),  # in right acc
+                                ('output {} out_pd_{}[3],', 'p'),  # out down
+                                ('output {} out_pr_{}[3],', 'p'))  # out right
+             for i in range(N)]
+    if fold:
+        # whether the diagonal cell of each row folds
+        ports[6 * N:6 * N] = ['input wire fold_{},'.format(i)
+                              for i in range(N)]
+    _write_joined(f, s, ports, strip_last=True)
+    f.write(');\n')
 
     # local wires: accumulations across/downwards, positions, masses
-    s = '\n' + (' ' * len('  real '))
-    code += ('\n  // The accumulation across to the right wires (i, j)\n'
-             '\n  real ' +
-             s.join(['pr_{0}_{1}[3],'.format(i, j)
-                     for i in range(N) for j in range(N - 1)])[:-1] + ';')
-    code += ('\n\n  // The accumulation downwards wires (i, j)\n'
-             '\n  real ' +
-             s.join(['pd_{0}_{1}[3],'.format(i, j)
-                     for i in range(N - 1) for j in range(N)])[:-1] + ';')
-    code += ('\n\n  // The position passing wires to the right out of (i, j)\n'
-             '\n  real ' +
-             s.join(['q_{0}_{1}_i[3],'.format(i, j)
-                     for i in range(N) for j in range(N - 1)])[:-1] + ';')
-    code += ('\n\n  // The position passing wires downwards out of (i, j)\n'
-             '\n  real ' +
-             s.join(['q_{0}_{1}_j[3],'.format(i, j)
-                     for i in range(N - 1) for j in range(N)])[:-1] + ';')
-    code += ('\n\n  // The mass passing wires to the right out of (i, j)\n'
-             '\n  real ' +
-             s.join(['m_{0}_{1}_i,'.format(i, j)
-                     for i in range(N) for j in range(N - 1)])[:-1] + ';')
-    code += ('\n\n  // The mass passing wires downwards out of (i, j)\n'
-             '\n  real ' +
-             s.join(['m_{0}_{1}_j,'.format(i, j)
-                     for i in range(N - 1) for j in range(N)])[:-1] + ';')
+    wires = [
+        ('The accumulation across to the right wires (i, j)', 'pr_{0}_{1}[3],',
+         0, 'p'),
+        ('The accumulation downwards wires (i, j)', 'pd_{0}_{1}[3],', 1, 'p'),
+        ('The position passing wires to the right out of (i, j)',
+         'q_{0}_{1}_i[3],', 0, 'q'),
+        ('The position passing wires downwards out of (i, j)',
+         'q_{0}_{1}_j[3],', 1, 'q'),
+        ('The mass passing wires to the right out of (i, j)', 'm_{0}_{1}_i,',
+         0, 'm'),
+        ('The mass passing wires downwards out of (i, j)', 'm_{0}_{1}_j,', 1,
+         'm'),
+    ]
+    for k, (comment, wire, down, kind) in enumerate(wires):
+        s = '\n' + (' ' * len('  {} '.format(types[kind])))
+        f.write(('\n' if k == 0 else '\n\n') +
+                '  // {}\n'.format(comment) +
+                '\n  {} '.format(types[kind]))
+        _write_joined(f, s, (wire.format(i, j)
+                             for i in range(N - down)
+                             for j in range(N - 1 + down)), strip_last=True)
+        f.write(';')
 
     # the systolic cells. Cases for edges of array use input/output of module
-    code += ('\n\n' + '\n'
-             .join(['  systolic_n_body_3D_cell b_{0}_{1}(.clk(clk),'
-                    .format(i, j) +
-                    '\n' + (' ' * len('  systolic_n_body_3D_cell b_{0}_{1}('
-                                      .format(i, j))) +
-                    '.in_q_i({0}), .in_q_j({1}),'
-                    .format('q_{0}i'.format(i) if j == 0 else
-                            'q_{0}_{1}_i'.format(i, j - 1),
-                            'q_{0}j'.format(j) if i == 0 else
-                            'q_{0}_{1}_j'.format(i - 1, j)) +
-                    '\n' + (' ' * len('  systolic_n_body_3D_cell b_{0}_{1}('
-                                      .format(i, j))) +
-                    '.in_m_i({0}), .in_m_j({1}),'
-                    .format('m_{0}i'.format(i) if j == 0 else
-                            'm_{0}_{1}_i'.format(i, j - 1),
-                            'm_{0}j'.format(j) if i == 0 else
-                            'm_{0}_{1}_j'.format(i - 1, j)) +
-                    '\n' + (' ' * len('  systolic_n_body_3D_cell b_{0}_{1}('
-                                      .format(i, j))) +
-                    '.in_p_right({0}), .in_p_down({1}),'
-                    .format('pr_{0}'.format(i) if j == 0 else
-                            'pr_{0}_{1}'.format(i, j - 1),
-                            'pd_{0}'.format(j) if i == 0 else
-                            'pd_{0}_{1}'.format(i - 1, j)) +
-                    '\n' + (' ' * len('  systolic_n_body_3D_cell b_{0}_{1}('
-                                      .format(i, j))) +
-                    '.out_q_i({0}), .out_q_j({1}),'
-                    .format('' if j == N - 1 else
-                            'q_{0}_{1}_i'.format(i, j),
-                            '' if i == N - 1 else
-                            'q_{0}_{1}_j'.format(i, j)) +
-                    '\n' + (' ' * len('  systolic_n_body_3D_cell b_{0}_{1}('
-                                      .format(i, j))) +
-                    '.out_m_i({0}), .out_m_j({1}),'
-                    .format('' if j == N - 1 else
-                            'm_{0}_{1}_i'.format(i, j),
-                            '' if i == N - 1 else
-                            'm_{0}_{1}_j'.format(i, j)) +
-                    '\n' + (' ' * len('  systolic_n_body_3D_cell b_{0}_{1}('
-                                      .format(i, j))) +
-                    '.out_p_right({0}),'
-                    .format('out_pr_{0}'.format(i) if j == N - 1 else
-                            'pr_{0}_{1}'.format(i, j)) +
-                    '\n' + (' ' * len('  systolic_n_body_3D_cell b_{0}_{1}('
-                                      .format(i, j))) +
-                    '.out_p_down({0}));'
-                    .format('out_pd_{0}'.format(j) if i == N - 1 else
-                            'pd_{0}_{1}'.format(i, j))
-                    for i in range(N) for j in range(N)]) +
-             '\n\nendmodule  // end of the {0}x{0} execution'.format(N))
-
-    return code
-
-
-def generate_testbench_code(N, n):
+    f.write('\n\n')
+    _write_joined(f, '\n', (_cell_instance(N, i, j, fold)
+                            for i in range(N) for j in range(N)))
+    f.write('\n\nendmodule  // end of the {0}x{0} execution'.format(N))
+
+
+def _write_generic_array(f, N, fixed=None, fold=False):
+    """Writes systolic_NxN_3D, the NxN array for any N built with generate
+    loops. See generate_design_code.
+    """
+    # whether the diagonal cell of each row folds
+    fold_port = ('                        input wire [N-1:0] fold,\n'
+                 if fold else '')
+    if fixed is None:
+        f.write('// This module computes a single NxN execution of the '
+                'systolic array. Row and\n'
+                '// column u of the array are element u of the ports.\n'
+                'module systolic_NxN_3D #(parameter N = {})\n'.format(N) +
+                '                       (input wire clk,\n'
+                '                        input real q_i[N][3],\n'
+                '                        input real q_j[N][3],\n'
+                '                        input real m_i[N],\n'
+                '                        input real m_j[N],\n'
+                '                        input real pd[N][3],\n'
+                '                        input real pr[N][3],\n' +
+                fold_port +
+                '                        output real out_pd[N][3],\n'
+                '                        output real out_pr[N][3]);\n\n')
+        types = {'q': 'real', 'm': 'real', 'p': 'real'}
+    else:
+        f.write('// This module computes a single NxN execution of the '
+                'systolic array. Row and\n'
+                '// column u of the array are element u of the packed ports, '
+                'which hold the\n'
+                '// words of the cells.\n'
+                'module systolic_NxN_3D #(parameter N = {}, QW = {}, QF = {}, '
+                'MW = {}, MF = {},\n'
+                .format(N, fixed.q_width, fixed.q_frac, fixed.m_width,
+                        fixed.m_frac) +
+                '                                     PW = {}, PF = {})\n'
+                .format(fixed.p_width, fixed.p_frac) +
+                '                       (input wire clk,\n'
+                '                        input wire signed '
+                '[N-1:0][2:0][QW-1:0] q_i,\n'
+                '                        input wire signed '
+                '[N-1:0][2:0][QW-1:0] q_j,\n'
+                '                        input wire [N-1:0][MW-1:0] m_i,\n'
+                '                        input wire [N-1:0][MW-1:0] m_j,\n'
+                '                        input wire signed '
+                '[N-1:0][2:0][PW-1:0] pd,\n'
+                '                        input wire signed '
+                '[N-1:0][2:0][PW-1:0] pr,\n' + fold_port +
+                '                        output wire signed '
+                '[N-1:0][2:0][PW-1:0] out_pd,\n'
+                '                        output wire signed '
+                '[N-1:0][2:0][PW-1:0] out_pr);\n\n')
+        types = {'q': 'wire signed [QW-1:0]', 'm': 'wire [MW-1:0]',
+                 'p': 'wire signed [PW-1:0]'}
+
+    f.write('  // The signals passing to the right into cell (i, j), column 0 '
+            'coming from the\n'
+            '  // ports and column N going to them\n'
+            '  {p} pr_w[N][N+1][3];\n'
+            '  {q} q_i_w[N][N+1][3];\n'
+            '  {m} m_i_w[N][N+1];\n\n'
+            '  // and downwards into cell (i, j), row 0 coming from the ports '
+            'and row N going\n'
+            '  // to them\n'
+            '  {p} pd_w[N+1][N][3];\n'
+            '  {q} q_j_w[N+1][N][3];\n'
+            '  {m} m_j_w[N+1][N];\n\n'.format(**types) +
+            '  genvar i, j, c;\n'
+            '  generate\n'
+            '    for (i = 0; i < N; i = i + 1) begin : edges\n'
+            '      for (c = 0; c < 3; c = c + 1) begin : components\n'
+            '        assign q_i_w[i][0][c] = q_i[i][c];\n'
+            '        assign q_j_w[0][i][c] = q_j[i][c];\n'
+            '        assign pr_w[i][0][c] = pr[i][c];\n'
+            '        assign pd_w[0][i][c] = pd[i][c];\n'
+            '        assign out_pr[i][c] = pr_w[i][N][c];\n'
+            '        assign out_pd[i][c] = pd_w[N][i][c];\n'
+            '      end\n'
+            '      assign m_i_w[i][0] = m_i[i];\n'
+            '      assign m_j_w[0][i] = m_j[i];\n'
+            '    end\n\n'
+            '    for (i = 0; i < N; i = i + 1) begin : rows\n'
+            '      for (j = 0; j < N; j = j + 1) begin : cells\n')
+    if not fold:
+        f.write(_generic_cell_instance('systolic_n_body_3D_cell', fixed))
+    else:
+        f.write('        if (i == j) begin : cell\n' +
+                _generic_cell_instance('systolic_n_body_3D_fold_cell', fixed,
+                                       '  ', '.fold(fold[i]),') +
+                '        end else begin : cell\n' +
+                _generic_cell_instance('systolic_n_body_3D_cell', fixed,
+                                       '  ') +
+                '        end\n')
+    f.write('      end\n'
+            '    end\n'
+            '  endgenerate\n\n'
+            'endmodule  // end of the NxN execution')
+
+
+def _generic_cell_instance(module, fixed=None, indent='', extra=None):
+    """The instantiation of cell (i, j) in the generate loops of
+    systolic_NxN_3D, passing on the word lengths of a fixed-point array,
+    with any extra port connections.
+    """
+    params = ''
+    if fixed is not None:
+        s = ' ' * len(indent + '        ' + module)
+        params = (' #(.QW(QW), .QF(QF), .MW(MW), .MF(MF),\n' + s +
+                  '   .PW(PW), .PF(PF))\n' + s)
+    s = ' ' * len(indent + '        {} b('.format(module))
+    return (indent + '        ' + module + params + ' b(.clk(clk),' +
+            (' ' + extra if extra else '') + '\n' +
+            s + '.in_q_i(q_i_w[i][j]), .in_q_j(q_j_w[i][j]),\n' +
+            s + '.in_m_i(m_i_w[i][j]), .in_m_j(m_j_w[i][j]),\n' +
+            s + '.in_p_right(pr_w[i][j]), .in_p_down(pd_w[i][j]),\n' +
+            s + '.out_q_i(q_i_w[i][j+1]), .out_q_j(q_j_w[i+1][j]),\n' +
+            s + '.out_m_i(m_i_w[i][j+1]), .out_m_j(m_j_w[i+1][j]),\n' +
+            s + '.out_p_right(pr_w[i][j+1]),\n' +
+            s + '.out_p_down(pd_w[i+1][j]));\n')
+
+
+def _cell_instance(N, i, j, fold=False):
+    """The instantiation of cell (i, j) of the NxN array. Cases for edges of
+    array use input/output of module. With fold the diagonal cells fold.
+    """
+    if fold and i == j:
+        module = 'systolic_n_body_3D_fold_cell'
+        clk = '.clk(clk), .fold(fold_{}),'.format(i)
+    else:
+        module = 'systolic_n_body_3D_cell'
+        clk = '.clk(clk),'
+    s = '\n' + (' ' * len('  {} b_{}_{}('.format(module, i, j)))
+    return ('  {} b_{}_{}('.format(module, i, j) + clk + s +
+            '.in_q_i({0}), .in_q_j({1}),'
+            .format('q_{0}i'.format(i) if j == 0 else
+                    'q_{0}_{1}_i'.format(i, j - 1),
+                    'q_{0}j'.format(j) if i == 0 else
+                    'q_{0}_{1}_j'.format(i - 1, j)) + s +
+            '.in_m_i({0}), .in_m_j({1}),'
+            .format('m_{0}i'.format(i) if j == 0 else
+                    'm_{0}_{1}_i'.format(i, j - 1),
+                    'm_{0}j'.format(j) if i == 0 else
+                    'm_{0}_{1}_j'.format(i - 1, j)) + s +
+            '.in_p_right({0}), .in_p_down({1}),'
+            .format('pr_{0}'.format(i) if j == 0 else
+                    'pr_{0}_{1}'.format(i, j - 1),
+                    'pd_{0}'.format(j) if i == 0 else
+                    'pd_{0}_{1}'.format(i - 1, j)) + s +
+            '.out_q_i({0}), .out_q_j({1}),'
+            .format('' if j == N - 1 else
+                    'q_{0}_{1}_i'.format(i, j),
+                    '' if i == N - 1 else
+                    'q_{0}_{1}_j'.format(i, j)) + s +
+            '.out_m_i({0}), .out_m_j({1}),'
+            .format('' if j == N - 1 else
+                    'm_{0}_{1}_i'.format(i, j),
+                    '' if i == N - 1 else
+                    'm_{0}_{1}_j'.format(i, j)) + s +
+            '.out_p_right({0}),'
+            .format('out_pr_{0}'.format(i) if j == N - 1 else
+                    'pr_{0}_{1}'.format(i, j)) + s +
+            '.out_p_down({0}));'
+            .format('out_pd_{0}'.format(j) if i == N - 1 else
+                    'pd_{0}_{1}'.format(i, j)))
+
+
+def generate_testbench_code(N, n, verbose=False, data=None, binary=False,
+                            seed=0, fixed=None, latency=1, generate=False,
+                            fold=False):
     """Code to generate a testbench of the systolic design for n bodies.
 
     Arguments:
         N: The size of the systolic array.
         n: The number of bodies in the simulation.
             Must be divisible by N to ease our autogeneration.
+        verbose: Print the blocks of every input and output step.
+        data: When given, random initial conditions and the expected forces
+            are written to data files starting with this prefix, and the
+            testbench reads them and checks the forces itself. Its size does
+            not depend on n.
+        binary: Write binary data files read with $fread rather than hex
+            files read with $readmemh.
+        seed: The seed of the random initial conditions.
+        fixed: The FixedPoint of a fixed-point design. Its testbench needs
+            data files, holding the words of the positions, masses and
+            forces, and the forces are checked bit for bit.
+        latency: The pipeline stages of the cells of the design. The
+            testbench of a design with latency above 1 needs data files.
+        generate: Test the systolic_NxN_3D of a design generated with
+            generate, with the array ports. It needs data files.
+        fold: Test a design generated with fold, pairing up the diagonal
+            blocks into folded blocks. It needs data files.
     """
-    if n % N != 0:
-        raise ValueError('N ({}) must divide n ({})'.format(N, n))
+    f = io.StringIO()
+    write_testbench_code(f, N, n, verbose, data, binary, seed, fixed, latency,
+                         generate, fold)
+    return f.getvalue()
+
+
+def _block_row(block, b):
+    """The row of the given block walking the b x b upper triangle of blocks
+    row by row, and the number of blocks up to the end of that row. Past the
+    last block this is the last row.
+
+    The first k rows hold k * b - k * (k - 1) / 2 blocks, so the row is found
+    by solving the quadratic rather than walking the rows.
+    """
+    def _blocks_before(k):
+        return k * b - k * (k - 1) // 2
+
+    if _blocks_before(b) <= block:
+        return b - 1, _blocks_before(b)
+
+    # the smallest k with _blocks_before(k) > block, then row k - 1
+    k = (2 * b + 1 - math.isqrt((2 * b + 1) ** 2 - 8 * block)) // 2
+    while k > 1 and _blocks_before(k - 1) > block:
+        k -= 1
+    while _blocks_before(k) <= block:
+        k += 1
+    return k - 1, _blocks_before(k)
 
+
+def _write_testbench_header(f, N, fixed=None):
+    """Writes the header and the testbench of a single cell. The variables of
+    the fixed-point cell are its words, and its stimulus the words of the
+    same positions and masses.
+    """
     # start with the header
-    code = ('// Systolic array for n-body simulations. Generated code.\n'
+    f.write('// Systolic array for n-body simulations. Generated code.\n'
             '//\n'
             '// This program implements a testbench of a {0}x{0} '.format(N) +
             'systolic array for n-body simulations.\n\n\n')
 
+    # the positions of the two steps and the masses, as words if fixed
+    q = np.array([[[-3, -2, -2], [-1, -1, 0]], [[-2, -2, 0], [2, 2, 2]]])
+    m = np.ones((2), dtype=np.int64)
+    if fixed is not None:
+        q, m = fixed.quantize(q, m)
+    types = _types(fixed, 'logic')
+
     # add the cell test bench code
-    code += ('// testbench for a single systolic cell -- Confirmed\n'
-             'module NxN_cell_tb;\n\n'
-             'reg clk;\n'
-             'real in_q_i[3];\n'
-             'real in_q_j[3];\n'
-             'real in_m_i;\n'
-             'real in_m_j;\n'
-             'real in_p_right[3];\n'
-             'real in_p_down[3];\n\n'
-             'real out_q_i[3];\n'
-             'real out_q_j[3];\n'
-             'real out_m_i;\n'
-             'real out_m_j;\n'
-             'real out_p_right[3];\n'
-             'real out_p_down[3];\n\n'
-             'systolic_n_body_3D_cell UUT(.clk(clk),\n'
-             '                            .in_q_i(in_q_i),\n'
-             '                            .in_q_j(in_q_j),\n'
-             '                            .in_m_i(in_m_i),\n'
-             '                            .in_m_j(in_m_j),\n'
-             '                            .in_p_right(in_p_right),\n'
-             '                            .in_p_down(in_p_down),\n'
-             '                            .out_q_i(out_q_i),\n'
-             '                            .out_q_j(out_q_j),\n'
-             '                            .out_m_i(out_m_i),\n'
-             '                            .out_m_j(out_m_j),\n'
-             '                            .out_p_right(out_p_right),\n'
-             '                            .out_p_down(out_p_down));\n\n'
-             '// Create a test\n'
-             'initial begin\n\n'
-             '  // Initialize the variables\n'
-             '  in_q_i[0] = -3;\n'
-             '  in_q_i[1] = -2;\n'
-             '  in_q_i[2] = -2;\n'
-             '  in_q_j[0] = -1;\n'
-             '  in_q_j[1] = -1;\n'
-             '  in_q_j[2] = 0;\n'
-             '  in_m_i = 1;\n'
-             '  in_m_j = 1;\n'
-             '  in_p_right[0] = 0;\n'
-             '  in_p_right[1] = 0;\n'
-             '  in_p_right[2] = 0;\n'
-             '  in_p_down[0] = 0;\n'
-             '  in_p_down[1] = 0;\n'
-             '  in_p_down[2] = 0;\n'
-             '  clk = 1;\n'
-             '  #5;\n'
-             '  $stop;\n'
-             '  clk = 0;\n'
-             '  #5;\n'
-             '  in_q_i[0] = -2;\n'
-             '  in_q_i[1] = -2;\n'
-             '  in_q_i[2] = 0;\n'
-             '  in_q_j[0] = 2;\n'
-             '  in_q_j[1] = 2;\n'
-             '  in_q_j[2] = 2;\n'
-             '  clk = 1;\n'
-             '  #5;\n'
-             '  $stop;\n'
-             'end\n\nendmodule\n\n\n')
+    f.write(('// testbench for a single systolic cell -- Confirmed\n'
+             if fixed is None else
+             '// testbench for a single fixed-point systolic cell\n') +
+            'module NxN_cell_tb;\n\n'
+            'reg clk;\n')
+    for prefix in ('in', 'out'):
+        f.write('{q} {0}_q_i[3];\n'
+                '{q} {0}_q_j[3];\n'
+                '{m} {0}_m_i;\n'
+                '{m} {0}_m_j;\n'
+                '{p} {0}_p_right[3];\n'
+                '{p} {0}_p_down[3];\n\n'.format(prefix, **types))
+    f.write('systolic_n_body_3D_cell UUT(.clk(clk),\n'
+            '                            .in_q_i(in_q_i),\n'
+            '                            .in_q_j(in_q_j),\n'
+            '                            .in_m_i(in_m_i),\n'
+            '                            .in_m_j(in_m_j),\n'
+            '                            .in_p_right(in_p_right),\n'
+            '                            .in_p_down(in_p_down),\n'
+            '                            .out_q_i(out_q_i),\n'
+            '                            .out_q_j(out_q_j),\n'
+            '                            .out_m_i(out_m_i),\n'
+            '                            .out_m_j(out_m_j),\n'
+            '                            .out_p_right(out_p_right),\n'
+            '                            .out_p_down(out_p_down));\n\n'
+            '// Create a test\n'
+            'initial begin\n\n'
+            '  // Initialize the variables\n')
+    for step in range(2):
+        if step:
+            f.write('  clk = 0;\n'
+                    '  #5;\n')
+        for side, c in ((side, c) for side in range(2) for c in range(3)):
+            f.write('  in_q_{}[{}] = {};\n'.format('ij'[side], c,
+                                                   q[step, side, c]))
+        if step == 0:
+            f.write('  in_m_i = {};\n'
+                    '  in_m_j = {};\n'.format(m[0], m[1]) +
+                    ''.join('  in_p_{}[{}] = 0;\n'.format(side, c)
+                            for side in ('right', 'down')
+                            for c in range(3)))
+        f.write('  clk = 1;\n'
+                '  #5;\n'
+                '  $stop;\n')
+    f.write('end\n\nendmodule\n\n\n')
+
+
+def _write_uut(f, N, fixed=None, generate=False, fold=False):
+    """Writes the variables passed to the NxN array and the array itself.
+    """
+    if generate:
+        _write_generic_uut(f, fixed, fold)
+        return
+
+    # add the variables to pass to UUT, all reals or grouped by their type
+    f.write('\n\n// Variables to pass to the UUT'
+            '\nreg clk;')
+    names = [('Q_{0}i[3],', 'q'), ('Q_{0}j[3],', 'q'), ('M_{0}i,', 'm'),
+             ('M_{0}j,', 'm'), ('PR_{0}[3],', 'p'), ('PD_{0}[3],', 'p'),
+             ('OPR_{0}[3],', 'p'), ('OPD_{0}[3],', 'p')]
+    types = _types(fixed, 'logic')
+    groups = ([('real', [name for name, _ in names])] if fixed is None else
+              [(types[kind], [name for name, of in names if of == kind])
+               for kind in 'qmp'])
+    for decl, group in groups:
+        s = '\n' + (' ' * len(decl + ' '))
+        f.write('\n' + decl + ' ')
+        _write_joined(f, s, [name.format(i)
+                             for name in group
+                             for i in range(N)], strip_last=True)
+        f.write(';')
+    if fold:
+        s = '\n' + (' ' * len('logic '))
+        f.write('\nlogic ')
+        _write_joined(f, s, ['FOLD_{},'.format(i) for i in range(N)],
+                      strip_last=True)
+        f.write(';')
+
+    # create the UUT
+    s = '\n' + (' ' * len('systolic_{0}x{0}_3D UUT('.format(N)))
+    f.write('\n\nsystolic_{0}x{0}_3D UUT(.clk(clk),'.format(N) + s)
+    ports = (['.q_{0}{1}(Q_{0}{1}),'.format(i, side)  # input row/col pos
+              for i in range(N) for side in 'ij'] +
+             ['.m_{0}{1}(M_{0}{1}),'.format(i, side)  # input row/col mass
+              for i in range(N) for side in 'ij'] +
+             ['.pd_{0}(PD_{0}),'.format(i)  # input down acc
+              for i in range(N)] +
+             ['.pr_{0}(PR_{0}),'.format(i)  # input right acc
+              for i in range(N)] +
+             ['.fold_{0}(FOLD_{0}),'.format(i)  # diagonal cell folds
+              for i in range(N if fold else 0)] +
+             ['.out_pd_{0}(OPD_{0}),'.format(i)  # out down
+              for i in range(N)] +
+             ['.out_pr_{0}(OPR_{0}),'.format(i)  # out right
+              for i in range(N)])
+    _write_joined(f, s, ports, strip_last=True)
+    f.write(');\n')
+
+
+def _write_generic_uut(f, fixed=None, fold=False):
+    """Writes the array variables passed to systolic_NxN_3D and the array.
+    """
+    f.write('\n\n// Variables to pass to the UUT'
+            '\nreg clk;')
+    if fixed is None:
+        groups = [('real', ['Q_i[N][3],', 'Q_j[N][3],', 'M_i[N],', 'M_j[N],',
+                            'PR[N][3],', 'PD[N][3],', 'OPR[N][3],',
+                            'OPD[N][3],'])]
+    else:
+        groups = [('logic signed [N-1:0][2:0][QW-1:0]', ['Q_i,', 'Q_j,']),
+                  ('logic [N-1:0][MW-1:0]', ['M_i,', 'M_j,']),
+                  ('logic signed [N-1:0][2:0][PW-1:0]',
+                   ['PR,', 'PD,', 'OPR,', 'OPD,'])]
+    if fold:
+        groups.append(('logic [N-1:0]', ['FOLD,']))
+    for decl, group in groups:
+        s = '\n' + (' ' * len(decl + ' '))
+        f.write('\n' + decl + ' ')
+        _write_joined(f, s, group, strip_last=True)
+        f.write(';')
+
+    s = '\n' + (' ' * len('systolic_NxN_3D #(.N(N)) UUT('))
+    f.write('\n\nsystolic_NxN_3D #(.N(N)) UUT(.clk(clk),' + s)
+    _write_joined(f, s, ['.q_i(Q_i),', '.q_j(Q_j),', '.m_i(M_i),',
+                         '.m_j(M_j),', '.pd(PD),', '.pr(PR),'] +
+                  (['.fold(FOLD),'] if fold else []) +
+                  ['.out_pd(OPD),', '.out_pr(OPR),'], strip_last=True)
+    f.write(');\n')
+
+
+def testbench_steps(N, n, latency=1, fold=False, data=True):
+    """The number of steps the testbench for n bodies runs a timestep for.
+
+    The data file testbench runs STEPS = (BLOCKS - 1) * N + (2 * N - 1) * L
+    + 1 steps: the last block starts at step (BLOCKS - 1) * N and its last
+    sums leave row and column N - 1 after (2 * N - 1) * L more. The inlined
+    testbench, only for unfolded single cycle cells, feeds each block for
+    N steps after an extra N - 1 and runs 2 * N - 1 + N * BLOCKS steps.
+    """
+    b = n // N
+    blocks = b * (b - 1) // 2 + (b + 1) // 2 if fold else b * (b + 1) // 2
+    if data:
+        return (blocks - 1) * N + (2 * N - 1) * latency + 1
+    return 2 * N - 1 + N * blocks
+
+
+def write_testbench_code(f, N, n, verbose=False, data=None, binary=False,
+                         seed=0, fixed=None, latency=1, generate=False,
+                         fold=False):
+    """Writes the testbench of the systolic design for n bodies to the file f
+    a step at a time, so memory stays bounded and the time is linear in the
+    number of steps. See generate_testbench_code for the arguments.
+    """
+    if n % N != 0:
+        raise ValueError('N ({}) must divide n ({})'.format(N, n))
+
+    _write_testbench_header(f, N, fixed)
+
+    if data is not None:
+        q, m = initial_conditions(n, seed)
+        if fixed is None:
+            forces = expected_forces(q, m, N, fold)
+        else:
+            q, m = fixed.quantize(q, m)
+            forces = fixed.forces(q, m, N, fold)
+        write_data_files(data, q, m, forces, binary)
+        _write_data_testbench(f, N, n, data, binary, fixed, latency,
+                              generate, fold)
+        return
+    if fixed is not None:
+        raise ValueError('The inlined testbench drives real ports, use data '
+                         'files for the fixed-point design')
+    if latency != 1:
+        raise ValueError('The inlined testbench is timed for single cycle '
+                         'cells, use data files for pipelined cells')
+    if generate:
+        raise ValueError('The inlined testbench drives the ports of each row '
+                         'and column, use data files for systolic_NxN_3D')
+    if fold:
+        raise ValueError('The inlined testbench walks the unfolded blocks, '
+                         'use data files for folded diagonal blocks')
 
     # add the code for the NxN acceleration with n bodies test
-    code += ('// testbench for {0}x{0} acceleration with {1} bodies '
-             '-- Confirmed\nmodule acceleration_3D_tb;\n\n'
-             .format(N, n))
+    f.write('// testbench for {0}x{0} acceleration with {1} bodies '
+            '-- Confirmed\nmodule acceleration_3D_tb;\n\n'
+            .format(N, n))
 
     # add the variables used in the software
     s = '\n' + (' ' * len('real '))
-    code += ('// Variables for the software side'
-             '\nreal ' +
-             s.join(['q_{}[3],'.format(i)
-                     for i in range(n)]) + s +
-             s.join(['a_{}[3],'.format(i)
-                     for i in range(n)]) + s +
-             s.join(['m_{},'.format(i)
-                     for i in range(n)])[:-1] + ';')
-
-    # add the variables to pass to UUT
-    s = '\n' + (' ' * len('real '))
-    code += ('\n\n// Variables to pass to the UUT'
-             '\nreg clk;'
-             '\nreal ' +
-             s.join(['Q_{0}i[3],'.format(i)
-                     for i in range(N)]) + s +
-             s.join(['Q_{0}j[3],'.format(i)
-                     for i in range(N)]) + s +
-             s.join(['M_{0}i,'.format(i)
-                     for i in range(N)]) + s +
-             s.join(['M_{0}j,'.format(i)
-                     for i in range(N)]) + s +
-             s.join(['PR_{0}[3],'.format(i)
-                     for i in range(N)]) + s +
-             s.join(['PD_{0}[3],'.format(i)
-                     for i in range(N)]) + s +
-             s.join(['OPR_{0}[3],'.format(i)
-                     for i in range(N)]) + s +
-             s.join(['OPD_{0}[3],'.format(i)
-                     for i in range(N)])[:-1] + ';')
+    f.write('// Variables for the software side'
+            '\nreal ')
+    _write_joined(f, s, [name.format(i)
+                         for name in ('q_{}[3],', 'a_{}[3],', 'm_{},')
+                         for i in range(n)], strip_last=True)
+    f.write(';')
 
-    # create the UUT
-    s = '\n' + (' ' * len('systolic_{0}x{0}_3D UUT('.format(N)))
-    code += ('\n\nsystolic_{0}x{0}_3D UUT(.clk(clk),'.format(N) + s +
-             s.join(['.q_{0}i(Q_{0}i),'.format(i) + s +  # input row pos
-                     '.q_{0}j(Q_{0}j),'.format(i)  # input col pos
-                     for i in range(N)]) + s +
-             s.join(['.m_{0}i(M_{0}i),'.format(i) + s +  # input row mass
-                     '.m_{0}j(M_{0}j),'.format(i)  # input col mass
-                     for i in range(N)]) + s +
-             s.join(['.pd_{0}(PD_{0}),'.format(i)  # input down acc
-                     for i in range(N)]) + s +
-             s.join(['.pr_{0}(PR_{0}),'.format(i)  # input right acc
-                     for i in range(N)]) + s +
-             s.join(['.out_pd_{0}(OPD_{0}),'.format(i)  # out down
-                     for i in range(N)]) + s +
-             s.join(['.out_pr_{0}(OPR_{0}),'.format(i)  # out right
-                     for i in range(N)])[:-1] + ');\n')
+    _write_uut(f, N)
 
     # initialize the variables
     s = '\n' + (' ' * 2)
-    code += ('\ninitial begin\n' + s + 'clk = 0;' + s +
-             s.join(['q_{0}[0] = {1}; q_{0}[1] = {2}; q_{0}[2] = {3};'
-                     .format(i, 0, 0, 0)  # TODO put in initial positions
-                     for i in range(n)]) + s +
-             s.join(['a_{0}[0] = {1}; a_{0}[1] = {2}; a_{0}[2] = {3};'
-                     .format(i, 0, 0, 0)  # TODO put in initial accelerations
-                     for i in range(n)]) + s +
-             s.join(['m_{0} = {1};'
-                     .format(i, 1)  # TODO put in masses
-                     for i in range(n)]) + '\n' + s +
-             s.join(['Q_{0}i[0] = 0; Q_{0}i[1] = 0; Q_{0}i[2] = 0;'
-                     .format(i)
-                     for i in range(N)]) + s +
-             s.join(['Q_{0}j[0] = 0; Q_{0}j[1] = 0; Q_{0}j[2] = 0;'
-                     .format(i)
-                     for i in range(N)]) + s +
-             s.join(['M_{0}i = 0;'
-                     .format(i)
-                     for i in range(N)]) + s +
-             s.join(['M_{0}j = 0;'
-                     .format(i)
-                     for i in range(N)]) + s +
-             s.join(['PD_{0}[0] = 0; PD_{0}[1] = 0; PD_{0}[2] = 0;'
-                     .format(i)
-                     for i in range(N)]) + s +
-             s.join(['PR_{0}[0] = 0; PR_{0}[1] = 0; PR_{0}[2] = 0;'
-                     .format(i)
-                     for i in range(N)]) + s +
-             s.join(['OPD_{0}[0] = 0; OPD_{0}[1] = 0; OPD_{0}[2] = 0;'
-                     .format(i)
-                     for i in range(N)]) + s +
-             s.join(['OPR_{0}[0] = 0; OPR_{0}[1] = 0; OPR_{0}[2] = 0;'
-                     .format(i)
-                     for i in range(N)]))
+    f.write('\ninitial begin\n' + s + 'clk = 0;')
+    for i in range(n):
+        # TODO put in initial positions
+        f.write(s + 'q_{0}[0] = {1}; q_{0}[1] = {2}; q_{0}[2] = {3};'
+                .format(i, 0, 0, 0))
+    for i in range(n):
+        # TODO put in initial accelerations
+        f.write(s + 'a_{0}[0] = {1}; a_{0}[1] = {2}; a_{0}[2] = {3};'
+                .format(i, 0, 0, 0))
+    for i in range(n):
+        # TODO put in masses
+        f.write(s + 'm_{0} = {1};'.format(i, 1))
+    f.write('\n')
+    for init in ('Q_{0}i[0] = 0; Q_{0}i[1] = 0; Q_{0}i[2] = 0;',
+                 'Q_{0}j[0] = 0; Q_{0}j[1] = 0; Q_{0}j[2] = 0;',
+                 'M_{0}i = 0;',
+                 'M_{0}j = 0;',
+                 'PD_{0}[0] = 0; PD_{0}[1] = 0; PD_{0}[2] = 0;',
+                 'PR_{0}[0] = 0; PR_{0}[1] = 0; PR_{0}[2] = 0;',
+                 'OPD_{0}[0] = 0; OPD_{0}[1] = 0; OPD_{0}[2] = 0;',
+                 'OPR_{0}[0] = 0; OPR_{0}[1] = 0; OPR_{0}[2] = 0;'):
+        for i in range(N):
+            f.write(s + init.format(i))
 
     # Now compute the timesteps block-by-block
     # To generate the code, we take note that for block i, j
@@ -429,7 +1119,8 @@ def generate_testbench_code(N, n):
         """sets the inputs for each t, starting at 0 and less than
         N * b * (b + 1) / 2 + 3 * N - 1).
         """
-        # TODO diagonals
+        # The diagonal blocks are fed whole, their bottoms dropped. Folding
+        # them in pairs needs the data file testbench
         b = int(n / N)
 
         def _generate_row_input(i, j, u, step):
@@ -480,14 +1171,7 @@ def generate_testbench_code(N, n):
 
         # go up to n for in matrix (N * b * (b + 1) / 2)
         # then check after if in 0 phase
-        comp_blocks = 0
-        curr_i = -1
-        for i in range(0, b):
-            if comp_blocks <= curr_block:
-                comp_blocks += (b - i)
-                curr_i += 1
-            else:
-                break
+        curr_i, comp_blocks = _block_row(curr_block, b)
 
         # exit if we're after the feed in stage.
         if comp_blocks <= curr_block:
@@ -507,10 +1191,12 @@ def generate_testbench_code(N, n):
         into_j = (curr_j + 1 if curr_j + 1 < b and curr_i >= 0
                   else curr_i + 1)
 
-        print('\n\tinput:[ t: {}, curr_block: {}, into_next_block: {},\n'
-              '\t          curr_i: {}, curr_j: {}, into_i: {}, into_j: {} ]'
-              .format(t, curr_block, into_next_block,
-                      curr_i, curr_j, into_i, into_j))
+        if verbose:
+            print('\n\tinput:[ t: {}, curr_block: {}, into_next_block: {},\n'
+                  '\t          curr_i: {}, curr_j: {}, '
+                  'into_i: {}, into_j: {} ]'
+                  .format(t, curr_block, into_next_block,
+                          curr_i, curr_j, into_i, into_j))
 
         # the first into_next_block inputs will be from into_i, into_j
         s = '\n  '
@@ -567,14 +1253,7 @@ def generate_testbench_code(N, n):
 
         # go up to n for in matrix (N * b * (b + 1) / 2)
         # then check after if in 0 phase
-        comp_blocks = 0
-        curr_i = -1
-        for i in range(0, b):
-            if comp_blocks <= curr_block:
-                comp_blocks += (b - i)
-                curr_i += 1
-            else:
-                break
+        curr_i, comp_blocks = _block_row(curr_block, b)
 
         curr_j = curr_block - int(curr_i * (curr_i + 1) / 2)
  
@@ -583,10 +1262,12 @@ def generate_testbench_code(N, n):
         into_j = (curr_j + 1 if curr_j + 1 < b and curr_i >= 0
                   else curr_i + 1)
 
-        print('\n\toutput:[ t: {}, curr_block: {}, into_next_block: {},\n'
-              '\t           curr_i: {}, curr_j: {}, into_i: {}, into_j: {} ]'
-              .format(t, curr_block, into_next_block,
-                      curr_i, curr_j, into_i, into_j))
+        if verbose:
+            print('\n\toutput:[ t: {}, curr_block: {}, into_next_block: {},\n'
+                  '\t           curr_i: {}, curr_j: {}, '
+                  'into_i: {}, into_j: {} ]'
+                  .format(t, curr_block, into_next_block,
+                          curr_i, curr_j, into_i, into_j))
 
         # the first into_next_block inputs will be from last_i, last_j
         s = '\n  '
@@ -606,34 +1287,444 @@ def generate_testbench_code(N, n):
 
     # Compute only a single cycle - this loop just feeds in N inputs for each
     # block and then an extra N steps for the output to propagate.
-    for t in range(2 * N - 1 + int(N * b * (b + 1) / 2)):
-        code += ('\n' + s + '//// compute step {}'.format(t) +
-                 s + '#10; $stop;' +
-                 _generate_inputs(t) + '\n' + s +
-                 '// increment outputs' +
-                 _generate_outputs(t))
+    for t in range(testbench_steps(N, n, data=False)):
+        f.write('\n' + s + '//// compute step {}'.format(t) +
+                s + '#10; $stop;' +
+                _generate_inputs(t) + '\n' + s +
+                '// increment outputs' +
+                _generate_outputs(t))
 
     # end the code for the NxN acceleration with n bodies test
-    code += ('\n\nend\n\n'
-             '// always have clk taking care of sync across cells\n'
-             'initial begin\n'
-             '  forever #5 clk = ~clk;\n'
-             'end\n\n'
-             'endmodule')
+    f.write('\n\nend\n\n'
+            '// always have clk taking care of sync across cells\n'
+            'initial begin\n'
+            '  forever #5 clk = ~clk;\n'
+            'end\n\n'
+            'endmodule')
+
+
+def initial_conditions(n, seed=0):
+    """Random positions in the cube [-1, 1]^3 and masses in [0.5, 1.5] for n
+    bodies, as (n, 3) and (n,) arrays of doubles.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-1, 1, (n, 3)), rng.uniform(0.5, 1.5, n)
+
+
+def cell_force(q_i, m_i, q_j, m_j):
+    """The f_ij systolic_n_body_3D_cell computes with reals, given
+    broadcastable (..., 3) positions and (...) masses, as (..., 3) forces
+    computed in the same order.
+    """
+    diff = q_j - q_i
+    denom = np.sqrt(diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1] +
+                    diff[..., 2] * diff[..., 2])
+    close = denom < 1e-8
+    denom = np.where(close, 1, denom)
+    scale = np.where(close, 0, m_i * m_j / denom / denom / denom)
+    return scale[..., None] * diff
+
+
+def expected_forces(q, m, N, fold=False):
+    """The force on each body as the data testbench accumulates it from the
+    NxN array, returned as an (n, 3) array.
+
+    Each cell computes what systolic_n_body_3D_cell computes, the partial
+    sums are added in the order they pass through the cells and the sums
+    leaving the array are added to the forces in block order, so the result
+    matches the simulation bit for bit. A block row of the upper triangle is
+    computed at a time.
+
+    With fold every even block row starts with the folded block of its
+    diagonal block and the next row's, see folded_forces, and the rows leave
+    out their diagonal blocks.
+    """
+    n = len(m)
+    b = n // N
+    forces = np.zeros_like(q)
+    for i in range(b):
+        rows = slice(i * N, (i + 1) * N)
+        start = (i + 1) * N if fold else i * N
+        folded = []
+        if fold and i % 2 == 0:
+            a = slice(min(i + 1, b - 1) * N, min(i + 2, b) * N)
+            right, down = folded_forces(
+                cell_force(q[rows, None, :], m[rows, None], q[None, rows, :],
+                           m[None, rows]),
+                cell_force(q[a, None, :], m[a, None], q[None, a, :],
+                           m[None, a]))
+            folded = [right[:, None]]
+            # the bottom of (i, i) repeats its right
+            if i + 1 < b:
+                forces[a] += down
+
+        f_ij = cell_force(q[rows, None, :], m[rows, None], q[None, start:, :],
+                          m[None, start:])
+
+        # partial sums out of the right of the rows of each block (i, j)
+        right = 0 + np.add.accumulate(
+            f_ij.reshape(N, (n - start) // N, N, 3), axis=2)[:, :, -1]
+        forces[rows] = np.add.accumulate(
+            np.concatenate([forces[rows, None]] + folded + [right], axis=1),
+            axis=1)[:, -1]
+
+        # and out of the bottom, dropped for the diagonal block
+        down = 0 - np.add.accumulate(f_ij, axis=0)[-1]
+        forces[(i + 1) * N:] += down[(i + 1) * N - start:]
+
+    return forces
+
+
+def folded_forces(f_c, f_a):
+    """The sums leaving the array for the folded block (a, c) of two
+    diagonal blocks, given the (N, N, 3) f_ij of the diagonal blocks (c, c)
+    and (a, a), with a = c for a block folded with itself.
+
+    The sum leaving the right of row u comes down column u through the cells
+    above the diagonal, subtracting the f_ij of the column particle u and
+    the row particles of c before u, and then along row u, adding those of
+    u and the particles of c after it. The sum leaving the bottom of column
+    u passes the cells below the diagonal along row u and then down column
+    u. Returns the (N, 3) forces on the particles of c out of the right and
+    on those of a out of the bottom.
+    """
+    upper = np.triu(np.ones(f_c.shape[:2], dtype=bool), 1)[:, :, None]
+    lower = upper.transpose(1, 0, 2)
+    right = (np.where(upper, f_c, 0) -
+             np.where(lower, f_c.transpose(1, 0, 2), 0))
+    down = (np.where(lower, f_a, 0) -
+            np.where(upper, f_a.transpose(1, 0, 2), 0))
+    return (0 + np.add.accumulate(right, axis=1)[:, -1],
+            0 + np.add.accumulate(down, axis=1)[:, -1])
+
+
+def folded_blocks(b):
+    """The (i, j) blocks of a timestep as the testbench of a folding array
+    walks them: the upper triangle row by row without the diagonal blocks,
+    each even row starting with the folded block (i + 1, i), or (i, i) in
+    the last row.
+    """
+    blocks = []
+    for i in range(b):
+        if i % 2 == 0:
+            blocks.append((min(i + 1, b - 1), i))
+        blocks.extend((i, j) for j in range(i + 1, b))
+    return blocks
+
+
+def _data_path(prefix, name, binary):
+    return '{}_{}.{}'.format(prefix, name, 'bin' if binary else 'hex')
+
+
+def write_data_files(prefix, q, m, forces, binary=False):
+    """Writes the positions, masses and forces as 64 bit words, the bits of
+    doubles or integers for the fixed-point words, one word per line in hex
+    for $readmemh or big endian words for $fread.
+    """
+    for name, values in (('q', q), ('m', m), ('forces', forces)):
+        values = np.asarray(values)
+        words = values.astype(np.float64 if values.dtype.kind == 'f' else
+                              np.int64).ravel()
+        path = _data_path(prefix, name, binary)
+        if binary:
+            words.astype(words.dtype.newbyteorder('>')).tofile(path)
+        else:
+            np.savetxt(path, words.view(np.uint64), fmt='%016x')
+
+
+def read_data_files(prefix, fixed=False, binary=False):
+    """Reads back the positions (n, 3), masses and forces (n, 3) written by
+    write_data_files, as doubles or for a fixed-point design as integers.
+    """
+    values = []
+    for name in ('q', 'm', 'forces'):
+        path = _data_path(prefix, name, binary)
+        if binary:
+            words = np.fromfile(path, dtype='>u8').astype(np.uint64)
+        else:
+            with open(path) as f:
+                words = np.array([int(word, 16) for word in f.read().split()],
+                                 dtype=np.uint64)
+        values.append(words.view(np.int64 if fixed else np.float64))
+    q, m, forces = values
+    return q.reshape(-1, 3), m, forces.reshape(-1, 3)
+
+
+def _read_data(prefix, name, memory, binary):
+    """The statements loading a data file into the memory.
+    """
+    path = _data_path(prefix, name, binary).replace('\\', '/')
+    if not binary:
+        return '  $readmemh("{}", {});\n'.format(path, memory)
+    return ('  fd = $fopen("{0}", "rb");\n'
+            '  if (fd == 0) $fatal(1, "Can not open {0}");\n'
+            '  count = $fread({1}, fd);\n'
+            '  $fclose(fd);\n'.format(path, memory))
+
 
-    return code
+def _write_data_testbench(f, N, n, prefix, binary, fixed=None, latency=1,
+                          generate=False, fold=False):
+    """Writes the testbench of the NxN array for n bodies reading its inputs
+    and expected forces from the data files.
+
+    Every cell delays its outputs by L = latency cycles, so row u of the
+    array starts block k at step k * N + u * L and column v at step
+    k * N + v * L, feeding its particle for N steps, and the sums of block k
+    leave row u and column v of the array after steps k * N + (u + N) * L - 1
+    and k * N + (v + N) * L - 1. The testbench drives the inputs and reads
+    the outputs on the falling edge of the clock.
+
+    The forces of a fixed-point design are added up in 64 bit integers and
+    have to match exactly. The testbench of a systolic_NxN_3D loops over its
+    rows and columns, so its size does not depend on N either.
+
+    With fold each even block row starts with the folded block (i + 1, i),
+    or (i, i) in the last row, and the rows leave out their diagonal blocks.
+    The diagonal cell of row u takes the particles fed to row and column u
+    at step s - u * L, so its fold input is set at step s when their block
+    (a, c) has a >= c. The forces on c then leave the right of the array and
+    those on a the bottom.
+    """
+    b = n // N
+    blocks = b * (b - 1) // 2 + (b + 1) // 2 if fold else b * (b + 1) // 2
+    f.write('// testbench for {0}x{0} acceleration with {1} bodies read from '
+            'data files\nmodule acceleration_3D_tb;\n\n'.format(N, n) +
+            'localparam N = {};\n'.format(N) +
+            'localparam n = {};\n'.format(n) +
+            'localparam L = {};\n'.format(latency) +
+            'localparam BLOCKS = {};\n'.format(blocks) +
+            'localparam STEPS = (BLOCKS - 1) * N + (2 * N - 1) * L + 1;\n' +
+            ('localparam real TOL = 1e-9;\n\n'
+             '// Positions, masses and expected forces as the bits of '
+             'doubles\n' if fixed is None else
+             'localparam QW = {};\n'
+             'localparam MW = {};\n'
+             'localparam PW = {};\n\n'
+             '// Positions, masses and expected forces as 64 bit words\n'
+             .format(fixed.q_width, fixed.m_width, fixed.p_width)) +
+            'reg [63:0] q_bits[0:3 * n - 1];\n'
+            'reg [63:0] m_bits[0:n - 1];\n'
+            'reg [63:0] f_bits[0:3 * n - 1];\n\n'
+            '// The (i, j) of each block, walking the upper triangle row by '
+            'row\n' +
+            ('' if not fold else
+             '// with the diagonal blocks folded in pairs, and the block rows '
+             'of the forces\n'
+             '// leaving the right (r) and bottom (d) of the array\n') +
+            'integer block_i[0:BLOCKS - 1];\n'
+            'integer block_j[0:BLOCKS - 1];\n' +
+            ('' if not fold else
+             'integer block_r[0:BLOCKS - 1];\n'
+             'integer block_d[0:BLOCKS - 1];\n') + '\n'
+            '// The forces accumulated from the outputs\n' +
+            ('real a[0:n - 1][0:2];\n\n'
+             'integer i, j, k, p, c, s, u, errors, fd, count;\n'
+             'real expected, diff;' if fixed is None else
+             'longint a[0:n - 1][0:2];\n\n'
+             'integer i, j, k, p, c, s, u, errors, fd, count;\n'
+             'longint expected;'))
+
+    _write_uut(f, N, fixed, generate, fold)
+    add = '$signed(sum[{}])' if generate and fixed is not None else 'sum[{}]'
+    if fixed is None:
+        load = ('task automatic load(input integer p, output real q[3], '
+                'output real m);\n'
+                '  if (p < 0) begin\n'
+                '    q[0] = 0; q[1] = 0; q[2] = 0; m = 0;\n'
+                '  end else begin\n'
+                '    q[0] = $bitstoreal(q_bits[3 * p]);\n'
+                '    q[1] = $bitstoreal(q_bits[3 * p + 1]);\n'
+                '    q[2] = $bitstoreal(q_bits[3 * p + 2]);\n'
+                '    m = $bitstoreal(m_bits[p]);\n'
+                '  end\n'
+                'endtask\n\n'
+                'task automatic accumulate(input integer p, '
+                'input real sum[3]);\n')
+        compare = ('      expected = $bitstoreal(f_bits[3 * p + c]);\n'
+                   '      diff = a[p][c] - expected;\n'
+                   '      if ((diff < 0 ? -diff : diff) >\n'
+                   '          TOL * (expected < 0 ? -expected : expected)) '
+                   'begin\n'
+                   '        if (errors < 10)\n'
+                   '          $display("a_%0d[%0d] = %g, expected %g", p, c, '
+                   'a[p][c], expected);\n')
+    else:
+        # the elements of the packed ports of systolic_NxN_3D, whose selects
+        # are unsigned
+        if generate:
+            q_type, sum_type = 'logic [2:0][QW-1:0] q', \
+                               'logic [2:0][PW-1:0] sum'
+        else:
+            q_type, sum_type = 'logic signed [QW-1:0] q[3]', \
+                               'logic signed [PW-1:0] sum[3]'
+        load = ('task automatic load(input integer p, '
+                'output {},\n'.format(q_type) +
+                '                    output logic [MW-1:0] m);\n'
+                '  if (p < 0) begin\n'
+                '    q[0] = 0; q[1] = 0; q[2] = 0; m = 0;\n'
+                '  end else begin\n'
+                '    q[0] = q_bits[3 * p][QW-1:0];\n'
+                '    q[1] = q_bits[3 * p + 1][QW-1:0];\n'
+                '    q[2] = q_bits[3 * p + 2][QW-1:0];\n'
+                '    m = m_bits[p][MW-1:0];\n'
+                '  end\n'
+                'endtask\n\n'
+                'task automatic accumulate(input integer p, '
+                'input {});\n'.format(sum_type))
+        compare = ('      expected = f_bits[3 * p + c];\n'
+                   '      if (a[p][c] != expected) begin\n'
+                   '        if (errors < 10)\n'
+                   '          $display("a_%0d[%0d] = %0d, expected %0d", '
+                   'p, c, a[p][c], expected);\n')
+
+    f.write('\n'
+            '// The particle fed to row (or column) u at step s, -1 if none\n'
+            'function automatic integer fed(input integer s, '
+            'input integer u,\n'
+            '                               input integer row);\n'
+            '  if (s < u * L || (s - u * L) / N >= BLOCKS)\n'
+            '    return -1;\n'
+            '  return (row ? block_i[(s - u * L) / N] : '
+            'block_j[(s - u * L) / N]) * N + u;\n'
+            'endfunction\n\n'
+            '// The block whose sums left row (or column) u after step t, -1 '
+            'if none\n'
+            'function automatic integer drained(input integer t, '
+            'input integer u);\n'
+            '  if (t - (u + N) * L + 1 < 0 || (t - (u + N) * L + 1) % N != 0 '
+            '||\n'
+            '      (t - (u + N) * L + 1) / N >= BLOCKS)\n'
+            '    return -1;\n'
+            '  return (t - (u + N) * L + 1) / N;\n'
+            'endfunction\n\n' +
+            ('' if not fold else
+             '// Whether the diagonal cell of row u folds at step s, taking '
+             'the particles fed\n'
+             '// to row and column u at step s - u * L\n'
+             'function automatic logic folds(input integer s, '
+             'input integer u);\n'
+             '  if (s < 2 * u * L || (s - 2 * u * L) / N >= BLOCKS)\n'
+             '    return 0;\n'
+             '  return block_i[(s - 2 * u * L) / N] >= '
+             'block_j[(s - 2 * u * L) / N];\n'
+             'endfunction\n\n') + load +
+            '  a[p][0] = a[p][0] + {};\n'.format(add.format(0)) +
+            '  a[p][1] = a[p][1] + {};\n'.format(add.format(1)) +
+            '  a[p][2] = a[p][2] + {};\n'.format(add.format(2)) +
+            'endtask\n\n'
+            'initial begin\n'
+            '  clk = 0;\n')
+    f.write(_read_data(prefix, 'q', 'q_bits', binary) +
+            _read_data(prefix, 'm', 'm_bits', binary) +
+            _read_data(prefix, 'forces', 'f_bits', binary))
+    if not fold:
+        f.write('\n'
+                '  k = 0;\n'
+                '  for (i = 0; i < n / N; i = i + 1)\n'
+                '    for (j = i; j < n / N; j = j + 1) begin\n'
+                '      block_i[k] = i;\n'
+                '      block_j[k] = j;\n'
+                '      k = k + 1;\n'
+                '    end\n')
+    else:
+        f.write('\n'
+                '  k = 0;\n'
+                '  for (i = 0; i < n / N; i = i + 1) begin\n'
+                '    if (i % 2 == 0) begin\n'
+                '      block_i[k] = i + 1 < n / N ? i + 1 : i;\n'
+                '      block_j[k] = i;\n'
+                '      k = k + 1;\n'
+                '    end\n'
+                '    for (j = i + 1; j < n / N; j = j + 1) begin\n'
+                '      block_i[k] = i;\n'
+                '      block_j[k] = j;\n'
+                '      k = k + 1;\n'
+                '    end\n'
+                '  end\n'
+                '  for (k = 0; k < BLOCKS; k = k + 1) begin\n'
+                '    block_r[k] = block_i[k] < block_j[k] ? block_i[k] : '
+                'block_j[k];\n'
+                '    block_d[k] = block_i[k] < block_j[k] ? block_j[k] : '
+                'block_i[k];\n'
+                '  end\n')
+    f.write('  for (p = 0; p < n; p = p + 1)\n'
+            '    for (c = 0; c < 3; c = c + 1)\n'
+            '      a[p][c] = 0;\n')
+    if generate:
+        f.write('  for (u = 0; u < N; u = u + 1)\n'
+                '    for (c = 0; c < 3; c = c + 1) begin\n'
+                '      PR[u][c] = 0;\n'
+                '      PD[u][c] = 0;\n'
+                '    end\n')
+    for u in range(0 if generate else N):
+        f.write('  PR_{0}[0] = 0; PR_{0}[1] = 0; PR_{0}[2] = 0;\n'
+                '  PD_{0}[0] = 0; PD_{0}[1] = 0; PD_{0}[2] = 0;\n'.format(u))
+
+    f.write('\n'
+            '  for (s = 0; s < STEPS; s = s + 1) begin\n'
+            '    @(negedge clk);\n')
+    # the block rows of the forces leaving the right and bottom
+    right, down = ('block_r', 'block_d') if fold else ('block_i', 'block_j')
+    if generate:
+        f.write('    for (u = 0; u < N; u = u + 1) begin\n'
+                '      k = drained(s - 1, u);\n'
+                '      if (k >= 0) begin\n'
+                '        accumulate({0}[k] * N + u, OPR[u]);\n'
+                '        if ({0}[k] != {1}[k])\n'
+                '          accumulate({1}[k] * N + u, OPD[u]);\n'
+                '      end\n'
+                '      load(fed(s, u, 1), Q_i[u], M_i[u]);\n'
+                '      load(fed(s, u, 0), Q_j[u], M_j[u]);\n'
+                .format(right, down) +
+                ('      FOLD[u] = folds(s, u);\n' if fold else '') +
+                '    end\n')
+    for u in range(0 if generate else N):
+        f.write('\n'
+                '    // row and column {0}\n'
+                '    k = drained(s - 1, {0});\n'
+                '    if (k >= 0) begin\n'
+                '      accumulate({1}[k] * N + {0}, OPR_{0});\n'
+                '      if ({1}[k] != {2}[k])\n'
+                '        accumulate({2}[k] * N + {0}, OPD_{0});\n'
+                '    end\n'
+                '    load(fed(s, {0}, 1), Q_{0}i, M_{0}i);\n'
+                '    load(fed(s, {0}, 0), Q_{0}j, M_{0}j);\n'
+                .format(u, right, down) +
+                ('    FOLD_{0} = folds(s, {0});\n'.format(u) if fold else ''))
+    f.write('  end\n\n'
+            '  errors = 0;\n'
+            '  for (p = 0; p < n; p = p + 1)\n'
+            '    for (c = 0; c < 3; c = c + 1) begin\n' + compare +
+            '        errors = errors + 1;\n'
+            '      end\n'
+            '    end\n'
+            '  if (errors == 0)\n'
+            '    $display("PASSED: the forces on all %0d bodies match", n);\n'
+            '  else\n'
+            '    $display("FAILED: %0d of %0d force components differ", '
+            'errors, 3 * n);\n'
+            '  $finish;\n'
+            'end\n\n'
+            '// always have clk taking care of sync across cells\n'
+            'initial begin\n'
+            '  forever #5 clk = ~clk;\n'
+            'end\n\n'
+            'endmodule')
 
 
 def main():
     args = parse_args()
 
-    design_code = generate_design_code(args.N)
+    fixed = fixed_point.from_args(args) if args.fixed else None
+
     with open(args.design_file, 'w') as f:
-        f.write(design_code)
+        write_design_code(f, args.N, fixed, args.latency, args.generate,
+                          args.fold)
 
-    testbench_code = generate_testbench_code(args.N, args.n)
     with open(args.tb_file, 'w') as f:
-        f.write(testbench_code)
+        write_testbench_code(f, args.N, args.n, args.verbose, args.data,
+                             args.binary, args.seed, fixed, args.latency,
+                             args.generate, args.fold)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,34 @@
+import time
+
+import numpy as np
+
+from systolic import ReferenceSystolicArray, SystolicArray
+
+
+def cycles_per_second(array_class, n, N, cycles):
+    """
+    Times the cycle step (position buffers and array update) of the given
+    systolic array class walking the upper triangle of blocks
+    """
+    b = n // N
+    blocks = [(i, j) for i in range(b) for j in range(i, b)]
+    position_state = np.zeros((n))
+    array = array_class(n, N)
+
+    start = time.perf_counter()
+    for cycle in range(cycles):
+        i, j = blocks[cycle % len(blocks)]
+        top, left = array.update_position_buffer(i, j)
+        array.update_systolic_array(top, left, position_state)
+    return cycles / (time.perf_counter() - start)
+
+
+n = 32768
+print("n = {}".format(n))
+print("{:>4} {:>16} {:>16} {:>9}".format("N", "roll cycles/s", "ring cycles/s",
+                                         "speedup"))
+for N in (4, 16, 64):
+    before = cycles_per_second(ReferenceSystolicArray, n, N, 200000 // N**2 + 50)
+    after = cycles_per_second(SystolicArray, n, N, 20000)
+    print("{:>4} {:>16.0f} {:>16.0f} {:>8.1f}x".format(N, before, after,
+                                                      after / before))
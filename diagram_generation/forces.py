@@ -0,0 +1,141 @@
+import numpy as np
+
+
+def cell_forces(q_i, m_i, q_j, m_j):
+    """
+    The (3, N, N) f_ij of the cells of a block, cell (u, v) pairing row
+    particle u with column particle v, like systolic_n_body_3D_cell
+    """
+    diff = q_j[:, None, :] - q_i[:, :, None]
+    denom = np.sqrt(diff[0] * diff[0] + diff[1] * diff[1] + diff[2] * diff[2])
+
+    close = denom < 1e-8
+    denom[close] = 1
+    scale = m_i[:, None] * m_j[None, :] / denom / denom / denom
+    f_ij = scale * diff
+    f_ij[:, close] = 0
+
+    return f_ij
+
+
+def interaction_tile(q_i, m_i, q_j, m_j):
+    """
+    Evaluates an N x N block of systolic cells as a single array operation
+
+    q_i and q_j are (3, N) positions of the row and column particles, m_i and
+    m_j their masses. Every cell computes what systolic_n_body_3D_cell in the
+    code generator computes: the diff, the denom < 1e-8 guard and the
+    m_i * m_j / r^3 scale. The f_ij are then summed in the order they pass
+    through the cells, to the right along the rows (+f_ij) and down the
+    columns (-f_ij), starting from zero.
+
+    Returns the (3, N) partial sums leaving the right of each row and the
+    bottom of each column
+    """
+    f_ij = cell_forces(q_i, m_i, q_j, m_j)
+
+    # accumulate is sequential, unlike sum, so the rounding matches the cells
+    right = 0 + np.add.accumulate(f_ij, axis=2)[:, :, -1]
+    down = 0 - np.add.accumulate(f_ij, axis=1)[:, -1, :]
+
+    return right, down
+
+
+def folded_tile(q_a, m_a, q_c, m_c):
+    """
+    Evaluates the folded block (a, c) of two diagonal blocks, see
+    SystolicArray. The rows carry the particles of block a and the columns
+    those of block c, and the diagonal cells swap them along with their
+    partial sums, so the cells above the diagonal compute the upper triangle
+    of (c, c) and the cells below it the lower triangle of (a, a).
+
+    The sum leaving the right of row u comes down column u through the cells
+    above the diagonal (-f_ij of c's particles w and u) and then along row u
+    (+f_ij of u and v), and the sum leaving the bottom of column v along row
+    v through the cells below the diagonal and then down column v. Every
+    interaction is computed once, and a diagonal block folded with itself
+    (a = c) gives the same right sums as interaction_tile.
+
+    Returns the (3, N) forces on the particles of c leaving the right and on
+    those of a leaving the bottom
+    """
+    N = len(m_a)
+    upper = np.triu(np.ones((N, N), dtype=bool), 1)
+    lower = upper.T
+    f_c = cell_forces(q_c, m_c, q_c, m_c)
+    f_a = cell_forces(q_a, m_a, q_a, m_a)
+
+    f_c_t = f_c.transpose(0, 2, 1)
+    f_a_t = f_a.transpose(0, 2, 1)
+    right = np.where(upper, f_c, 0) - np.where(lower, f_c_t, 0)
+    down = np.where(lower, f_a, 0) - np.where(upper, f_a_t, 0)
+    right = 0 + np.add.accumulate(right, axis=2)[:, :, -1]
+    down = 0 + np.add.accumulate(down, axis=2)[:, :, -1]
+
+    return right, down
+
+
+def direct_sum(positions, masses, N, blocks=None):
+    """
+    Computes the force on every particle block by block, without stepping the
+    systolic array
+
+    positions is a (3, n) array and masses has length n. The blocks are the
+    (i, j) blocks of a timestep in the order their partial sums reach the
+    accumulators, e.g. SystolicModel.schedule_blocks(), and default to the
+    row major walk of SingleModel. The sums are accumulated in that order so
+    the result matches the numerical systolic models bit for bit. Blocks
+    (i, j) with i > j are folded blocks, see folded_tile.
+
+    Returns the (3, n) forces
+    """
+    n = len(masses)
+    b = n // N
+    if blocks is None:
+        blocks = [(i, j) for i in range(b) for j in range(i, b)]
+
+    forces = np.zeros_like(positions)
+    for i, j in blocks:
+        rows = slice(i * N, (i + 1) * N)
+        cols = slice(j * N, (j + 1) * N)
+        if i > j:
+            # A folded block
+            right, down = folded_tile(positions[:, rows], masses[rows],
+                                      positions[:, cols], masses[cols])
+            forces[:, cols] += right
+            forces[:, rows] += down
+            continue
+
+        right, down = interaction_tile(positions[:, rows], masses[rows],
+                                       positions[:, cols], masses[cols])
+        forces[:, rows] += right
+        # For diagonal blocks the bottom repeats the right
+        if i != j:
+            forces[:, cols] += down
+
+    return forces
+
+
+def potential_energy(positions, masses, chunk=1024):
+    """
+    The potential energy -sum m_i m_j / r_ij of the (3, n) positions over the
+    pairs i < j, with the units of the cells (G = 1) and their r < 1e-8 guard
+
+    It is summed in doubles, chunk rows at a time, so measuring the energy
+    of float32 particles does not add rounding of its own
+    """
+    q = positions.astype(np.float64)
+    m = masses.astype(np.float64)
+    n = len(m)
+    energy = 0.0
+    for start in range(0, n, chunk):
+        rows = slice(start, min(start + chunk, n))
+        diff = q[:, None, start + 1:] - q[:, rows, None]
+        r = np.sqrt(diff[0] * diff[0] + diff[1] * diff[1] + diff[2] * diff[2])
+        # Only the pairs above the diagonal
+        upper = np.triu(np.ones(r.shape, dtype=bool))
+        upper &= r >= 1e-8
+        scale = m[rows, None] * m[None, start + 1:]
+        energy -= np.sum(scale[upper] / r[upper])
+
+    return energy
@@ -0,0 +1,379 @@
+# integrator.py
+#
+# Integrates the particles of a numerical systolic model over many timesteps
+# with leapfrog, moving each particle as soon as the accumulators flush its
+# force, and measures the simulated timesteps per second and the energy
+# drift of the schedule.
+
+import argparse
+import time
+
+import numpy as np
+
+from forces import direct_sum, potential_energy
+from systolic import DataflowModel, MultiModel, SingleModel
+
+
+class Leapfrog():
+    """
+    Kick-drift-kick leapfrog (velocity Verlet) driven by the accumulator
+    flushes of a model built with positions and masses.
+
+    The state is the model's own (3, n) positions and a (3, n) array of
+    velocities of the same dtype, both contiguous and updated in place, so
+    the blocks the arrays start next read the new positions. A particle's
+    force for a timestep is complete when it is flushed, and nothing of the
+    timestep uses its position after that, so each cycle the flushed
+    particles finish the last kick with the new force (half a kick for the
+    first force), kick again and drift:
+
+        v += a dt / 2    (the velocity of the timestep)
+        v += a dt / 2
+        q += v dt
+
+    On a hazard free schedule this is the same as moving every particle at
+    once at the end of the timestep. With hazards a block reads a position
+    before or after its update, as the hardware would.
+
+    Every energy_every timesteps the positions and velocities of the
+    timestep are kept as the particles are flushed, and the energy is
+    measured once all of them have been. The time it takes is not counted in
+    run's timesteps per second
+    """
+    def __init__(self, model, dt, velocities=None, energy_every=1):
+        if model.positions is None:
+            raise ValueError('The model needs positions and masses')
+        positions = model.positions
+        if not positions.flags.c_contiguous:
+            raise ValueError('The positions have to be contiguous, as the '
+                             'model reads them in place')
+        dtype = positions.dtype
+        n = model.n
+
+        self.model = model
+        self.positions = positions
+        self.masses = model.masses
+        self.inverse_masses = (1 / self.masses).astype(dtype)
+        if velocities is None:
+            self.velocities = np.zeros((3, n), dtype=dtype)
+        else:
+            self.velocities = np.array(velocities, dtype=dtype, order='C')
+        self.dt = dtype.type(dt)
+        self.half = dtype.type(dt / 2)
+        # The timesteps each particle has completed
+        self.completed = np.zeros((n), dtype=np.int64)
+
+        # Two timesteps can be in flight, so there are two snapshots
+        self.energy_every = energy_every
+        self.snapshot_positions = np.zeros((2, 3, n), dtype=dtype)
+        self.snapshot_velocities = np.zeros((2, 3, n), dtype=dtype)
+        self.snapshot_timesteps = np.zeros((2), dtype=np.int64)
+        self.snapshot_counts = np.zeros((2), dtype=np.int64)
+        self.energies = []
+        self.energy_seconds = 0.0
+
+    def step(self):
+        """
+        Steps the model forward a cycle and integrates the flushed particles
+        """
+        self.model.forward()
+        flushed = self.model.accumulator.flushed
+        if len(flushed):
+            self.integrate(flushed)
+
+    def integrate(self, particles):
+        """
+        Kicks and drifts the given particles with their flushed forces
+        """
+        timesteps = self.completed[particles]
+        a = self.model.accumulator.forces[:, particles] * \
+            self.inverse_masses[particles]
+        v = self.velocities[:, particles]
+        kick = a * self.half
+        synced = np.where(timesteps == 0, v, v + kick)
+        if self.energy_every:
+            self.record(particles, timesteps, synced)
+
+        v = synced + kick
+        self.velocities[:, particles] = v
+        self.positions[:, particles] += v * self.dt
+        self.completed[particles] += 1
+
+    def record(self, particles, timesteps, velocities):
+        """
+        Keeps the positions and velocities of the particles for the timesteps
+        that are measured, and measures the ones all particles have reached
+        """
+        measured = timesteps % self.energy_every == 0
+        if not measured.any():
+            return
+        start = time.perf_counter()
+
+        particles = particles[measured]
+        timesteps = timesteps[measured]
+        slots = timesteps // self.energy_every % 2
+        self.snapshot_positions[slots, :, particles] = \
+            self.positions[:, particles].T
+        self.snapshot_velocities[slots, :, particles] = \
+            velocities[:, measured].T
+        self.snapshot_timesteps[slots] = timesteps
+        np.add.at(self.snapshot_counts, slots, 1)
+
+        for slot in np.flatnonzero(self.snapshot_counts == self.model.n):
+            self.energies.append((
+                int(self.snapshot_timesteps[slot]),
+                energy(self.snapshot_positions[slot],
+                       self.snapshot_velocities[slot], self.masses)
+            ))
+            self.snapshot_counts[slot] = 0
+
+        self.energy_seconds += time.perf_counter() - start
+
+    @property
+    def energy_drift(self):
+        """
+        The largest relative change of the energy from the first timestep
+        measured, or None before two have been
+        """
+        if len(self.energies) < 2:
+            return None
+        energies = np.array([e for _, e in sorted(self.energies)])
+        return float(np.max(np.abs(energies - energies[0])) /
+                     abs(energies[0]))
+
+    def run(self, timesteps):
+        """
+        Steps the model until every particle has completed the given number
+        of timesteps more, and returns a dict with the cycles and seconds it
+        took, the simulated timesteps and cycles per second, the hazards and
+        the energy drift so far
+        """
+        target = np.min(self.completed) + timesteps
+        cycles = self.model.iteration
+        hazards = self.model.hazards.count
+        measuring = self.energy_seconds
+        start = time.perf_counter()
+        while np.min(self.completed) < target:
+            self.step()
+        seconds = time.perf_counter() - start - \
+                  (self.energy_seconds - measuring)
+
+        cycles = self.model.iteration - cycles
+        return {
+            'timesteps': timesteps,
+            'cycles': cycles,
+            'cycles_per_timestep': cycles / timesteps,
+            'seconds': seconds,
+            'timesteps_per_second': timesteps / seconds,
+            'cycles_per_second': cycles / seconds,
+            'hazards': self.model.hazards.count - hazards,
+            'energy_drift': self.energy_drift,
+        }
+
+
+def energy(positions, velocities, masses):
+    """
+    The kinetic plus potential energy of the particles, in doubles
+    """
+    v = velocities.astype(np.float64)
+    kinetic = 0.5 * np.sum(masses.astype(np.float64) * np.sum(v * v, axis=0))
+    return float(kinetic + potential_energy(positions, masses))
+
+
+def leapfrog(positions, velocities, masses, N, dt, timesteps, blocks=None):
+    """
+    The reference for Leapfrog: every particle is moved at once at the end
+    of each timestep, with the forces of direct_sum in the order of blocks.
+    On a hazard free schedule with the same blocks it matches Leapfrog bit
+    for bit.
+
+    Returns the positions and velocities, half a timestep ahead of them
+    """
+    dtype = positions.dtype
+    q = positions.copy()
+    v = np.array(velocities, dtype=dtype)
+    inverse_masses = (1 / masses).astype(dtype)
+    dt, half = dtype.type(dt), dtype.type(dt / 2)
+    for timestep in range(timesteps):
+        a = direct_sum(q, masses, N, blocks) * inverse_masses
+        kick = a * half
+        if timestep:
+            v += kick
+        v += kick
+        q += v * dt
+
+    return q, v
+
+
+def plummer(n, seed=0):
+    """
+    A Plummer sphere of n equal masses in virial equilibrium, in the units of
+    the cells (G = 1) with total mass 1 and energy -1/4, following Aarseth,
+    Henon and Wielen (1974). Radii are cut at 10 times the scale radius.
+
+    Returns the (3, n) positions and velocities and the masses
+    """
+    rng = np.random.default_rng(seed)
+
+    def directions(radii):
+        z = rng.uniform(-1, 1, n)
+        phi = rng.uniform(0, 2 * np.pi, n)
+        s = np.sqrt(1 - z * z)
+        return radii * np.array([s * np.cos(phi), s * np.sin(phi), z])
+
+    radii = np.empty((n))
+    filled = 0
+    while filled < n:
+        x = rng.uniform(0, 1, n)
+        r = 1 / np.sqrt(x ** (-2 / 3) - 1)
+        r = r[r < 10][:n - filled]
+        radii[filled:filled + len(r)] = r
+        filled += len(r)
+
+    # The speed is a fraction of the escape speed, sampled by rejection
+    fractions = np.empty((n))
+    filled = 0
+    while filled < n:
+        x = rng.uniform(0, 1, n)
+        y = rng.uniform(0, 0.1, n)
+        x = x[y < x * x * (1 - x * x) ** 3.5][:n - filled]
+        fractions[filled:filled + len(x)] = x
+        filled += len(x)
+    speeds = fractions * np.sqrt(2) * (1 + radii * radii) ** -0.25
+
+    scale = 3 * np.pi / 16
+    positions = directions(radii) * scale
+    velocities = directions(speeds) / np.sqrt(scale)
+    positions -= positions.mean(axis=1, keepdims=True)
+    velocities -= velocities.mean(axis=1, keepdims=True)
+
+    return positions, velocities, np.full((n), 1 / n)
+
+
+def load(path):
+    """
+    Reads the positions, masses and, if present, velocities from a .npz
+    file, as (3, n) or (n, 3) arrays. Returns the (3, n) positions and
+    velocities and the masses
+    """
+    data = np.load(path)
+    masses = np.asarray(data['masses'], dtype=np.float64)
+    n = len(masses)
+
+    def soa(name):
+        values = np.asarray(data[name], dtype=np.float64)
+        return values if values.shape == (3, n) else values.T
+
+    velocities = soa('velocities') if 'velocities' in data else \
+                 np.zeros((3, n))
+    return soa('positions'), velocities, masses
+
+
+def build(args, n, positions, masses):
+    """
+    The model the arguments ask for, computing forces on positions
+    """
+    kwargs = dict(positions=positions, masses=masses, latency=args.latency,
+                  fold=args.fold)
+    if args.model == 'dataflow':
+        return DataflowModel(n, args.N, args.arrays, **kwargs)
+    if args.arrays == 1:
+        return SingleModel(n, args.N, hazard_policy=args.hazard_policy,
+                           **kwargs)
+    return MultiModel(n, args.N, args.arrays,
+                      hazard_policy=args.hazard_policy, **kwargs)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Integrates n bodies over many timesteps on the systolic '
+                    'models and measures the simulated timesteps per second '
+                    'and the energy drift.')
+    parser.add_argument('n', type=int,
+                        help='The number of particles of the Plummer sphere.')
+    parser.add_argument('N', type=int,
+                        help='The size of the systolic arrays.')
+    parser.add_argument('--data', type=str,
+                        help='A .npz file of positions, masses and '
+                             'velocities to use instead, whose size '
+                             'replaces n.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the Plummer sphere.')
+    parser.add_argument('--arrays', type=int, default=1,
+                        help='The number of systolic arrays.')
+    parser.add_argument('--model', choices=['fixed', 'dataflow'],
+                        default='fixed',
+                        help='fixed walks the SingleModel/MultiModel '
+                             'schedule, dataflow uses DataflowModel.')
+    parser.add_argument('--hazard-policy', choices=['count', 'stall'],
+                        default='stall',
+                        help='How the fixed schedule handles hazards.')
+    parser.add_argument('--latency', type=int, default=1,
+                        help='The pipeline stages of the cells.')
+    parser.add_argument('--fold', action='store_true',
+                        help='Fold the diagonal blocks.')
+    parser.add_argument('--dtype', choices=['float32', 'float64'],
+                        nargs='+', default=['float32', 'float64'],
+                        help='The precisions to integrate in.')
+    parser.add_argument('--dt', type=float, default=1e-3,
+                        help='The timestep.')
+    parser.add_argument('--timesteps', type=int, default=100,
+                        help='The number of timesteps.')
+    parser.add_argument('--energy-every', type=int, default=10,
+                        help='Measure the energy every this many timesteps, '
+                             '0 for never.')
+    parser.add_argument('--clock', type=float,
+                        help='A clock frequency in MHz to convert the cycles '
+                             'per timestep to hardware timesteps per second.')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare the trajectory with the reference '
+                             'leapfrog on the schedule\'s blocks.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.data:
+        positions, velocities, masses = load(args.data)
+    else:
+        positions, velocities, masses = plummer(args.n, args.seed)
+    n = len(masses)
+    if n % args.N != 0:
+        raise SystemExit('N has to divide the {} particles'.format(n))
+
+    for name in args.dtype:
+        dtype = np.dtype(name)
+        q = positions.astype(dtype)
+        m = masses.astype(dtype)
+        model = build(args, n, q, m)
+        integrator = Leapfrog(model, args.dt, velocities, args.energy_every)
+        result = integrator.run(args.timesteps)
+
+        drift = result['energy_drift']
+        print('{}: {} timesteps in {:.2f} s, {:.1f} timesteps/s ({:.0f} '
+              'cycles/s), {:.1f} cycles per timestep, {} hazards, energy '
+              'drift {}'.format(
+                  name, args.timesteps, result['seconds'],
+                  result['timesteps_per_second'],
+                  result['cycles_per_second'], result['cycles_per_timestep'],
+                  result['hazards'],
+                  'not measured' if drift is None else '{:.2e}'.format(drift)))
+        if args.clock:
+            print('    {:.0f} timesteps/s at {:g} MHz'.format(
+                args.clock * 1e6 / result['cycles_per_timestep'],
+                args.clock))
+
+        if args.check:
+            blocks = model.schedule_blocks() if args.model == 'fixed' \
+                     else None
+            reference, _ = leapfrog(positions.astype(dtype), velocities, m,
+                                    args.N, args.dt, args.timesteps, blocks)
+            error = np.max(np.abs(integrator.positions - reference))
+            print('    {} the reference leapfrog{}'.format(
+                'matches' if error == 0 else 'differs from',
+                ' bit for bit' if error == 0
+                else ' by up to {:.2e}'.format(error)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,23 @@
-from plotter import DoublePlotter
+from plotter import DoublePlotter, color_dict
 from systolic import DoubleModel
 
-color_dict = {
-    -1:'w',
-    0:'#336699',
-    1:'#9EE493',
-    2:'#E3170A',
-    3:'#DAF7DC',
-    4:'#8A716A',
-    5:'#86BBD8',
-    6:'#E7E247',
-    7:'#474A2C'
-}
-
 # Creates the model and plotter
 model = DoubleModel(32, 4)
 plotter = DoublePlotter(4, color_dict)
 
 # Warms up the systolic array so the gif will loop smooothly
-for _ in range(10):
-    model.forward()
+model.advance(10)
 
-# Adds the state of the systolic array to the plotter then advances the array
-for i in range(19):
-    plotter.add_frame(model.generate_force_matrix_data(),
-                      model.systolic_one.systolic_array,
-                      model.systolic_two.systolic_array,
-                      model.accumulator.fractions)
-    plotter.end_frame()
+def frames(count):
+    """
+    Yields the state of the systolic arrays then advances the arrays
+    """
+    for _ in range(count):
+        yield (model.generate_force_coordinates(),
+               model.systolic_one.systolic_array,
+               model.systolic_two.systolic_array,
+               model.accumulator.fractions)
 
-    model.forward()
+        model.forward()
 
-plotter.make_animation("figures/double_systolic.gif", 250)
+plotter.animate(frames(19), "figures/double_systolic.gif", 250, count=19)
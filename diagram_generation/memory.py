@@ -0,0 +1,107 @@
+from collections import OrderedDict
+
+
+class MemoryModel():
+    """
+    Models reading the positions and masses from off-chip memory into an
+    on-chip buffer holding a limited number of block rows (N particles each).
+
+    Block rows are fetched one at a time over a single channel: a fetch
+    occupies the channel for N * bytes_per_particle / bandwidth cycles
+    (bandwidth in bytes per cycle), and the data arrives latency cycles after
+    the transfer. A block (i, j) can start once rows i and j have arrived.
+    When the buffer is full the least recently used row is evicted, so with
+    reuse the row block i stays on chip while the array walks along j. With
+    reuse off every block fetches its rows again, unless they were
+    prefetched for the upcoming blocks.
+
+    The models check ready() for the blocks they are about to start, which
+    fetches any missing rows, and stall until they are. With a lookahead the
+    models also fetch the rows of that many upcoming cycles of the schedule
+    ahead of time.
+    """
+    def __init__(self, N, bandwidth, latency, capacity, bytes_per_particle=16,
+                 reuse=True, lookahead=0):
+        if capacity < 2:
+            raise ValueError('The buffer must hold at least two block rows')
+
+        self.N = N
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.capacity = capacity
+        self.bytes_per_particle = bytes_per_particle
+        self.reuse = reuse
+        self.lookahead = lookahead
+
+        self.transfer = -(-N * bytes_per_particle // bandwidth)
+        self.channel_free = 0
+        # Block row -> the cycle it arrives, least recently used first
+        self.resident = OrderedDict()
+        # The rows prefetched for the upcoming blocks
+        self.window = set()
+
+        self.fetches = 0
+        self.bytes_moved = 0
+
+    def fetch(self, row, cycle, keep=()):
+        """
+        Makes sure the row is on chip or on its way, evicting the least
+        recently used rows not in keep. Returns the cycle it arrives
+        """
+        if row in self.resident:
+            self.resident.move_to_end(row)
+            return self.resident[row]
+
+        while len(self.resident) >= self.capacity:
+            for old in self.resident:
+                if old not in keep:
+                    del self.resident[old]
+                    break
+            else:
+                return None
+
+        start = max(cycle, self.channel_free)
+        self.channel_free = start + self.transfer
+        self.resident[row] = self.channel_free + self.latency
+        self.fetches += 1
+        self.bytes_moved += self.N * self.bytes_per_particle
+        return self.resident[row]
+
+    def ready(self, blocks, cycle):
+        """
+        Fetches the rows of the (i, j) blocks if they are not on chip, and
+        returns whether they have all arrived by the given cycle
+        """
+        rows = {row for block in blocks if block[0] != -1 for row in block}
+        if len(rows) > self.capacity:
+            raise ValueError('The buffer can not hold the rows of {} '
+                             'blocks at once'.format(len(blocks)))
+
+        arrivals = [self.fetch(row, cycle, rows) for row in sorted(rows)]
+        return all(arrival <= cycle for arrival in arrivals)
+
+    def prefetch(self, blocks, cycle, keep):
+        """
+        Fetches the rows of upcoming blocks in order, as long as that does
+        not evict the rows in keep or the rows of earlier upcoming blocks
+        """
+        keep = set(keep)
+        self.window = set()
+        for block in blocks:
+            if block[0] == -1:
+                continue
+            for row in block:
+                keep.add(row)
+                if self.fetch(row, cycle, keep) is None:
+                    return
+                self.window.add(row)
+
+    def use(self, i, j):
+        """
+        Called as block (i, j) starts. Without reuse its rows are dropped,
+        except those the upcoming blocks were prefetched with
+        """
+        if not self.reuse:
+            for row in (i, j):
+                if row not in self.window:
+                    self.resident.pop(row, None)
@@ -0,0 +1,220 @@
+import heapq
+import os
+import sys
+import time
+
+import numpy as np
+
+from systolic import MultiModel, SingleModel
+
+def balance_rows(b, K):
+    """
+    Splits the b block rows between K arrays like MultiModel: longest first,
+    each to the array with the least blocks so far (the lowest numbered one
+    on a tie). Returns the array of each row and the blocks of each array
+    """
+    owner = np.empty((b), dtype=np.int64)
+    loads = [(0, array) for array in range(K)]
+    for i in range(b):
+        load, array = heapq.heappop(loads)
+        owner[i] = array
+        heapq.heappush(loads, (load + b - i, array))
+
+    return owner, np.bincount(owner, weights=b - np.arange(b),
+                              minlength=K).astype(np.int64)
+
+
+def row_spans(b, owner, fold=False):
+    """
+    The cycles between the first and last block of each block row within a
+    timestep, when every array walks its rows in row major order.
+
+    Row i of an array starts at the sum of the lengths of its rows before it,
+    offset(i), and block (i, j) starts j - i later. So block row k is first
+    and last used by the rows r < k with the least and greatest
+    offset(r) - r, or by its own row. This costs O(b) rather than walking
+    all b (b + 1) / 2 blocks.
+
+    With fold each array pairs up its rows in order, see fold_diagonals: the
+    first row of a pair starts with the folded block, which also uses the
+    second row, and the second row loses its diagonal block, so its blocks
+    (i, j) start j - i - 1 after its offset
+    """
+    rows = np.arange(b)
+    second = np.zeros((b), dtype=np.int64)
+    partner = rows.copy()
+    offsets = np.empty((b), dtype=np.int64)
+    for array in np.unique(owner):
+        mine = np.flatnonzero(owner == array)
+        if fold:
+            pairs = mine[:len(mine) // 2 * 2].reshape(-1, 2)
+            second[pairs[:, 1]] = 1
+            partner[pairs[:, 1]] = pairs[:, 0]
+        lengths = b - mine - second[mine]
+        offsets[mine] = np.cumsum(lengths) - lengths
+    lengths = b - rows - second
+
+    # The rows before k use it as a column
+    shifted = offsets - rows - second
+    earliest = np.concatenate(([b * b], np.minimum.accumulate(shifted)))
+    latest = np.concatenate(([-b * b], np.maximum.accumulate(shifted)))
+    first = np.minimum(rows + earliest[:-1], offsets[partner])
+    last = np.maximum(rows + latest[:-1], offsets[partner])
+    # Its own row, empty for the second row of the last pair
+    own = lengths > 0
+    first[own] = np.minimum(first[own], offsets[own])
+    last[own] = np.maximum(last[own], offsets[own] + lengths[own] - 1)
+
+    return last - first
+
+
+def predict(n, N, K=1, latency=1, fold=False):
+    """
+    Predicts the performance of K N x N arrays on n particles, using the
+    row major schedule of SingleModel for one array and MultiModel for more,
+    with cells pipelined over latency stages and, with fold, diagonal blocks
+    folded in pairs.
+
+    Returns a dict with:
+        blocks: blocks per timestep, b (b + 1) / 2 unfolded and
+                b (b - 1) / 2 + ceil(b / 2) folded on one array
+        cycles_per_timestep: the period of the schedule
+        hazard_free: whether every particle is updated before the next
+                     timestep uses it. SingleModel does not stall, so it is
+                     only hazard free if b >= N * latency + 2
+        latency: cycles from empty arrays until every particle is updated
+        utilization: the fraction of array cycles starting a block
+        timesteps_per_cycle, particles_per_cycle and interactions_per_cycle:
+                     the steady state throughput, counting the n (n - 1) / 2
+                     distinct interactions like PerformanceCounters.report
+        interaction_utilization: the fraction of cell cycles spent on the
+                     n (n - 1) / 2 distinct interactions of a timestep
+        hardware_cycles: the steps the data file testbench runs for a
+                     timestep of one array, STEPS = N (blocks - 1) +
+                     (2N - 1) latency + 1, where a block takes N steps and a
+                     cell latency steps
+        inline_hardware_cycles: the steps the inlined testbench runs,
+                     2N - 1 + N blocks, or None for pipelined or folded
+                     cells, which it does not generate
+    """
+    b = n // N
+    single = b * (b - 1) // 2 + (b + 1) // 2 if fold else b * (b + 1) // 2
+
+    owner, loads = balance_rows(b, K)
+    if fold:
+        # Every array drops one diagonal block per pair of its rows
+        loads -= np.bincount(owner, minlength=K) // 2
+    blocks = int(np.sum(loads))
+    spans = row_spans(b, owner, fold)
+    # The last partial sum of a particle leaves the array N * latency cycles
+    # after its block starts, is flushed the cycle after and updates the
+    # position state the cycle after that
+    hazard_period = int(np.max(spans)) + N * latency + 2
+    if K == 1:
+        period = blocks
+    else:
+        period = max(int(np.max(loads)), hazard_period)
+
+    return {
+        'blocks': blocks,
+        'cycles_per_timestep': period,
+        'hazard_free': period >= hazard_period,
+        'latency': int(np.max(loads)) + (2 * N - 1) * latency + 1,
+        'utilization': blocks / (K * period),
+        'timesteps_per_cycle': 1 / period,
+        'particles_per_cycle': n / period,
+        'interactions_per_cycle': n * (n - 1) / 2 / period,
+        'interaction_utilization': n * (n - 1) / 2 / (K * period * N * N),
+        'hardware_cycles': N * (single - 1) + (2 * N - 1) * latency + 1,
+        'inline_hardware_cycles': 2 * N - 1 + N * single
+                                  if latency == 1 and not fold else None,
+    }
+
+
+def simulate(n, N, K=1, latency=1, fold=False):
+    """
+    Measures what predict predicts by stepping the model through two
+    timesteps from empty arrays
+    """
+    model = SingleModel(n, N, latency=latency, fold=fold) if K == 1 else \
+            MultiModel(n, N, K, latency=latency, fold=fold)
+    while np.min(model.position_state) < 1:
+        model.forward()
+    latency = model.iteration
+    while np.min(model.position_state) < 2:
+        model.forward()
+
+    return {
+        'blocks': len(model.schedule_blocks()),
+        'cycles_per_timestep': model.iteration - latency,
+        'hazard_free': model.hazards.count == 0,
+        'latency': latency,
+        'utilization': model.utilization,
+    }
+
+
+def validate(configurations, testbench_steps=None):
+    """
+    Checks the predictions against the simulator for each (n, N, K,
+    latency, fold), printing the ones that disagree. Given the code
+    generator's testbench_steps, the hardware cycles are checked against the
+    run lengths of the testbenches it writes too. Returns whether all of
+    them agree
+    """
+    agree = True
+    for n, N, K, latency, fold in configurations:
+        predicted = predict(n, N, K, latency, fold)
+        simulated = simulate(n, N, K, latency, fold)
+        if testbench_steps is not None:
+            simulated['hardware_cycles'] = testbench_steps(N, n, latency,
+                                                           fold)
+            if latency == 1 and not fold:
+                simulated['inline_hardware_cycles'] = testbench_steps(
+                    N, n, data=False)
+        for key, value in simulated.items():
+            # The utilization of a run includes filling the arrays
+            if key == 'utilization':
+                continue
+            if predicted[key] != value:
+                agree = False
+                print('n={} N={} K={} latency={} fold={}: predicted {} {}, '
+                      'simulated {}'.format(n, N, K, latency, fold, key,
+                                            predicted[key], value))
+
+    return agree
+
+
+if __name__ == '__main__':
+    # The hardware cycles are checked against the run lengths of the
+    # testbenches the code generator writes
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 os.pardir, 'VerilogCodeGen'))
+    from systolic_n_body_codegen import testbench_steps
+
+    configurations = [(n, N, K, latency, fold) for N in (2, 3, 4, 8, 16)
+                      for n in (N, 4 * N, 9 * N, 20 * N, 33 * N)
+                      for K in (1, 2, 3, 5)
+                      for latency in (1, 4)
+                      for fold in (False, True)]
+    if validate(configurations, testbench_steps):
+        print('{} configurations agree with the simulator'.format(
+            len(configurations)))
+
+    start = time.perf_counter()
+    prediction = predict(10**6, 32, 4)
+    elapsed = time.perf_counter() - start
+    print('n = 10^6, N = 32, K = 4: {} cycles per timestep ({:.1f} ms to '
+          'predict)'.format(prediction['cycles_per_timestep'],
+                            elapsed * 1000))
+
+    # The diagonal blocks are 1 / b of a timestep, so folding pays off for
+    # few block rows
+    for n in (128, 512, 2048):
+        plain, folded = predict(n, 32), predict(n, 32, fold=True)
+        print('n = {}, N = 32: folding the diagonal blocks takes {} rather '
+              'than {} cycles per timestep, interaction utilization {:.3f} '
+              'rather than {:.3f}'.format(
+                  n, folded['cycles_per_timestep'],
+                  plain['cycles_per_timestep'],
+                  folded['interaction_utilization'],
+                  plain['interaction_utilization']))
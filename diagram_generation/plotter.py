@@ -7,7 +7,29 @@ from matplotlib import cm
 import numpy as np
 
 
+# The colors of the blocks of particles, -1 being no particle
+color_dict = {
+    -1:'w',
+    0:'#336699',
+    1:'#9EE493',
+    2:'#E3170A',
+    3:'#DAF7DC',
+    4:'#8A716A',
+    5:'#86BBD8',
+    6:'#E7E247',
+    7:'#474A2C'
+}
+
+
 class SystolicPlotter():
+    """
+    There are two ways to animate. add_frame/end_frame draw new artists for
+    every frame and make_animation plays them with an ArtistAnimation, so
+    memory grows with the number of frames. animate instead creates the
+    artists once and updates them from each frame of an iterable with a
+    FuncAnimation, so it runs in constant memory for any number of frames.
+    The frames are the arguments of add_frame
+    """
     def __init__(self, color_dict):
         """
         Constructs a systolic plotter object with given height of the image and
@@ -34,6 +56,24 @@ class SystolicPlotter():
                                         repeat_delay=speed)
         ani.save(name, writer='imagemagick')
 
+    def animate(self, frames, name, speed, count=None, writer='imagemagick'):
+        """
+        Creates the animation with given name from the frames, an iterable
+        of add_frame arguments. Give the count if the frames have no len
+        """
+        artists = self.create_artists()
+
+        def update(frame):
+            self.update_frame(*frame)
+            return artists
+
+        ani = animation.FuncAnimation(self.fig, update, frames=frames,
+                                      init_func=lambda: artists,
+                                      interval=speed, blit=True,
+                                      repeat_delay=speed, save_count=count,
+                                      cache_frame_data=False)
+        ani.save(name, writer=writer)
+
 
 class SinglePlotter(SystolicPlotter):
     def __init__(self, height, color_dict):
@@ -51,6 +91,16 @@ class SinglePlotter(SystolicPlotter):
         self.systolic.add(systolic_data, self.current_frame)
         self.accumulator.add(accumulator_data, self.current_frame)
 
+    def create_artists(self):
+        return (self.force_matrix.create_artists() +
+                self.systolic.create_artists() +
+                self.accumulator.create_artists())
+
+    def update_frame(self, force_data, systolic_data, accumulator_data):
+        self.force_matrix.update(force_data)
+        self.systolic.update(systolic_data)
+        self.accumulator.update(accumulator_data)
+
 
 class DoublePlotter(SystolicPlotter):
     def __init__(self, height, color_dict):
@@ -73,6 +123,19 @@ class DoublePlotter(SystolicPlotter):
         self.systolic_two.add(systolic_data_two, self.current_frame)
         self.accumulator.add(accumulator_data, self.current_frame)
 
+    def create_artists(self):
+        return (self.force_matrix.create_artists() +
+                self.systolic_one.create_artists() +
+                self.systolic_two.create_artists() +
+                self.accumulator.create_artists())
+
+    def update_frame(self, force_data, systolic_data_one, systolic_data_two,
+                     accumulator_data):
+        self.force_matrix.update(force_data)
+        self.systolic_one.update(systolic_data_one)
+        self.systolic_two.update(systolic_data_two)
+        self.accumulator.update(accumulator_data)
+
 
 class AccumulatorSubplot():
     def __init__(self, fig, gs_ele, color_dict):
@@ -116,6 +179,27 @@ class AccumulatorSubplot():
                 r_patch = ax.add_patch(rect)
                 current_frame.append(r_patch)
 
+    def create_artists(self):
+        """
+        Creates an empty bar in each accumulator for update to resize
+        """
+        self.bars = [list([None] * 8) for _ in range(4)]
+        for j in range(8):
+            for i in range(4):
+                rect = patches.Rectangle((0,0), 1, 0, fill=True,
+                                         color=self.color_dict[j])
+                self.bars[i][j] = self.accumulators_axis[i][j].add_patch(rect)
+
+        return [bar for row in self.bars for bar in row]
+
+    def update(self, data):
+        """
+        Sets the heights of the bars to the accumulators, like add
+        """
+        for j in range(8):
+            for i in range(4):
+                self.bars[i][j].set_height(data[i+j*4])
+
 
 class ForceMatrixSubplot():
     def __init__(self, fig, gs_ele, color_dict):
@@ -156,13 +240,17 @@ class ForceMatrixSubplot():
         """
         Adds a force matrix to the current frame.
 
-        Data should be a 32 by 32 matrix with 1s at the locations where elements
-        are currently being calculated
+        Data should be a (k, 3) array of (i, j, array) for the elements which
+        are currently being calculated, with the arrays numbered from 1, as
+        given by generate_force_coordinates
         """
+        empty = np.zeros((4, 4))
+        blocks = self.split_blocks(data)
+
         for i in range(8):
             for j in range(i, 8):
                 ax = self.force_matrix_axis[i][j]
-                local_data = data[i*4:(i+1)*4, j*4:(j+1)*4]
+                local_data = blocks.get((i, j), empty)
 
                 im = ax.imshow(local_data,cmap=cm.binary)
                 current_frame.append(im)
@@ -181,6 +269,57 @@ class ForceMatrixSubplot():
                     r_patch = ax.add_patch(rect)
                     current_frame.append(r_patch)
 
+    def split_blocks(self, data):
+        """
+        Splits the (k, 3) coordinates into a dict of the 4 x 4 blocks with
+        any interactions
+        """
+        blocks = {}
+        for i, j, array in data:
+            local_data = blocks.setdefault((i // 4, j // 4), np.zeros((4, 4)))
+            local_data[i % 4, j % 4] = array
+
+        return blocks
+
+    def create_artists(self):
+        """
+        Creates the image and the two outlines of each block for update to
+        change
+        """
+        self.images = {}
+        self.outlines = {}
+        for i in range(8):
+            for j in range(i, 8):
+                ax = self.force_matrix_axis[i][j]
+                im = ax.imshow(np.zeros((4, 4)), cmap=cm.binary)
+                l, r, b, t, = im.get_extent()
+                self.images[i, j] = im
+                self.outlines[i, j] = [
+                    ax.add_patch(patches.Rectangle((l,b), r-l, t-b,
+                                                   fill=False, clip_on=False,
+                                                   color=color,
+                                                   visible=False))
+                    for color in ('k', 'r')
+                ]
+
+        return list(self.images.values()) + \
+               [outline for pair in self.outlines.values() for outline in pair]
+
+    def update(self, data):
+        """
+        Sets the blocks to the given coordinates, like add. The images are
+        rescaled to their data as a new imshow would be
+        """
+        empty = np.zeros((4, 4))
+        blocks = self.split_blocks(data)
+
+        for (i, j), im in self.images.items():
+            local_data = blocks.get((i, j), empty)
+            im.set_data(local_data)
+            im.autoscale()
+            for array, outline in enumerate(self.outlines[i, j], 1):
+                outline.set_visible(bool(np.any(local_data==array)))
+
 
 class SystolicSubplot():
     def __init__(self, fig, gs_ele, color_dict, title=None, arrow_color=None):
@@ -246,3 +385,32 @@ class SystolicSubplot():
                                         fill=True, linewidth=0, zorder=1.0)
                 ax.add_patch(right)
                 current_frame.append(right)
+
+    def create_artists(self):
+        """
+        Creates the two halves of each cell for update to recolor
+        """
+        self.halves = [list([None] * 4) for _ in range(4)]
+        for i in range(4):
+            for j in range(4):
+                ax = self.systolic_arr_axis[i][j]
+                self.halves[i][j] = [
+                    ax.add_patch(patches.Polygon(corners,
+                                                 color=self.color_dict[-1],
+                                                 fill=True, linewidth=0,
+                                                 zorder=1.0))
+                    for corners in (np.array([[0.1,0.9],[0.9,0.1],[0.9,0.9]]),
+                                    np.array([[0.1,0.9],[0.9,0.1],[0.1,0.1]]))
+                ]
+
+        return [half for row in self.halves for pair in row for half in pair]
+
+    def update(self, data):
+        """
+        Colors the cells by the blocks of their particles, like add
+        """
+        for i in range(4):
+            for j in range(4):
+                top, right = self.halves[i][j]
+                top.set_facecolor(self.color_dict[data[i,j,0]//4])
+                right.set_facecolor(self.color_dict[data[i,j,1]//4])
@@ -0,0 +1,309 @@
+import io
+import struct
+import subprocess
+
+import numpy as np
+from matplotlib.colors import to_rgb
+from PIL import Image
+
+
+class FrameRenderer():
+    """
+    Paints the force matrix, the systolic arrays and the accumulators of a
+    model straight into NumPy frame buffers, without matplotlib.
+
+    Frames are (height, width) arrays of indices into the palette, which rgb
+    turns into (height, width, 3) uint8 RGB. The blocks of particles are
+    colored from color_dict as in the plotters (repeating its colors past
+    the last block), and interactions in the force matrix by the array
+    calculating them with array_colors. With more particles than size the
+    force matrix and the accumulators are downsampled to size pixels: a
+    pixel of the matrix is painted if any of its interactions is being
+    calculated, and a column of the bars shows the mean of its particles'
+    accumulators. Everything that does not change is painted once, and a frame is a handful of array operations into
+    preallocated buffers, so the frame returned is only valid until the next
+    one.
+    """
+    white, black, grey = 0, 1, 2
+
+    def __init__(self, n, N, num_arrays, color_dict, size=256,
+                 array_colors=('k', 'r', 'b', 'g', 'm', 'c', 'y')):
+        """
+        Lays out the panels so each is at most size pixels tall
+        """
+        self.n = n
+        self.N = N
+        self.num_arrays = num_arrays
+
+        # The palette: white, black and grey, the blocks, then the arrays
+        blocks = [color_dict[key] for key in sorted(color_dict) if key >= 0]
+        colors = ['w', 'k', '#D0D0D0'] + blocks + list(array_colors)
+        self.palette = np.array([[round(255 * c) for c in to_rgb(color)]
+                                 for color in colors], dtype=np.uint8)
+        # block_lut[k + 1] is the color of block k, and of -1 (nothing)
+        self.block_lut = np.array(
+            [colors.index(color_dict[-1]) if -1 in color_dict else 0] +
+            [3 + k % len(blocks) for k in range(n // N)], dtype=np.uint8)
+        self.array_lut = np.array(
+            [0] + [3 + len(blocks) + a % len(array_colors)
+                   for a in range(num_arrays)], dtype=np.uint8)
+
+        gap = max(2, size // 32)
+        self.p = max(1, size // n)
+        self.c = max(3, size // N)
+        self.w = max(1, size // n)
+        self.matrix_side = matrix = min(self.p * n, size)
+        self.bar_width = min(self.w * n, size)
+        array = self.c * N
+        self.bar_height = size
+
+        self.height = max(matrix, array, self.bar_height)
+        self.height += self.height % 2
+        self.matrix_x = 0
+        self.arrays_x = [matrix + gap + a * (array + gap)
+                         for a in range(num_arrays)]
+        self.bars_x = matrix + gap + num_arrays * (array + gap)
+        self.width = self.bars_x + self.bar_width
+        self.width += self.width % 2
+
+        self.frame = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.rgb_frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+
+        self.setup_matrix()
+        self.setup_arrays()
+        self.setup_bars()
+
+    def setup_matrix(self):
+        """
+        Paints the blocks of the force matrix, white above the diagonal and
+        grey below, with black lines between them. Pixel r of a side starts
+        at particle r * n // side
+        """
+        n, N, side = self.n, self.N, self.matrix_side
+        block = np.arange(side) * n // side // N
+        self.matrix = np.where(block[:, None] <= block[None, :], self.white,
+                               self.grey).astype(np.uint8)
+        if N * side >= 4 * n:
+            edges = np.flatnonzero(np.diff(block, prepend=-1))
+            self.matrix[edges, :] = self.black
+            self.matrix[:, edges] = self.black
+        self.offsets = np.arange(self.p)
+
+    def setup_arrays(self):
+        """
+        Finds the cell and half of every pixel of an array. The i of a cell
+        colors its upper right half and the j its lower left, and the cells
+        have black borders
+        """
+        N, c = self.N, self.c
+        local = np.arange(N * c) % c
+        cell = np.arange(N * c) // c
+        self.cell_r = np.repeat(cell[:, None], N * c, axis=1)
+        self.cell_c = np.repeat(cell[None, :], N * c, axis=0)
+        self.upper = local[None, :] > local[:, None]
+        self.border = (local[:, None] == 0) | (local[None, :] == 0) | \
+                      (local[:, None] == c - 1) | (local[None, :] == c - 1)
+
+        self.colors_i = np.empty((N * c, N * c), dtype=np.uint8)
+        self.colors_j = np.empty((N * c, N * c), dtype=np.uint8)
+
+    def setup_bars(self):
+        """
+        Finds the particle of every column of the accumulators, or the first
+        of the particles it averages when they are downsampled, and the
+        height of every row above the bottom
+        """
+        n, N, w, width = self.n, self.N, self.w, self.bar_width
+        self.bar_starts = None
+        if w * n <= width:
+            self.bar_particle = np.arange(width) // w
+        else:
+            self.bar_particle = self.bar_starts = np.arange(width) * n // width
+            self.bar_counts = np.diff(np.append(self.bar_starts, n))
+        self.bar_color = self.block_lut[self.bar_particle // N + 1]
+        self.bar_rows = (self.bar_height - 0.5 -
+                         np.arange(self.bar_height))[:, None]
+        self.bar_gaps = np.zeros((width), dtype=bool)
+        if w >= 3:
+            self.bar_gaps[w - 1::w] = True
+        self.filled = np.empty((self.bar_height, width), dtype=bool)
+
+    def render(self, force_data, systolic_data, accumulator_data):
+        """
+        Paints a frame and returns it as palette indices
+
+        force_data is the (k, 3) array of (i, j, array) coordinates given by
+        generate_force_coordinates, systolic_data a list with the (N, N, 2)
+        systolic_array of every array and accumulator_data the accumulators
+        as fractions
+        """
+        frame = self.frame
+        frame[:] = self.white
+
+        # Force matrix
+        n, side = self.n, self.matrix_side
+        matrix = frame[:side, self.matrix_x:self.matrix_x + side]
+        np.copyto(matrix, self.matrix)
+        if len(force_data):
+            force_data = np.asarray(force_data)
+            rows = force_data[:, 0, None, None] * side // n + \
+                   self.offsets[:, None]
+            cols = force_data[:, 1, None, None] * side // n + \
+                   self.offsets[None, :]
+            matrix[rows, cols] = self.array_lut[force_data[:, 2, None, None]]
+
+        # Systolic arrays
+        side = self.N * self.c
+        for x, cells in zip(self.arrays_x, systolic_data):
+            lut_i = self.block_lut[cells[:, :, 0] // self.N + 1]
+            lut_j = self.block_lut[cells[:, :, 1] // self.N + 1]
+            np.copyto(self.colors_i, lut_i[self.cell_r, self.cell_c])
+            np.copyto(self.colors_j, lut_j[self.cell_r, self.cell_c])
+            panel = frame[:side, x:x + side]
+            np.copyto(panel, self.colors_j)
+            np.copyto(panel, self.colors_i, where=self.upper)
+            panel[self.border] = self.black
+
+        # Accumulators
+        fractions = np.asarray(accumulator_data)
+        if self.bar_starts is None:
+            heights = fractions[self.bar_particle]
+        else:
+            heights = np.add.reduceat(fractions, self.bar_starts) / \
+                      self.bar_counts
+        heights = heights * self.bar_height
+        np.less(self.bar_rows, heights[None, :], out=self.filled)
+        self.filled[:, self.bar_gaps] = False
+        bars = frame[:self.bar_height,
+                     self.bars_x:self.bars_x + self.bar_width]
+        np.copyto(bars, self.bar_color[None, :], where=self.filled)
+
+        return frame
+
+    def rgb(self, frame):
+        """
+        Looks up the RGB colors of a frame of palette indices
+        """
+        np.take(self.palette, frame, axis=0, out=self.rgb_frame)
+        return self.rgb_frame
+
+
+def encode_gif_frame(frame, palette):
+    """
+    Encodes a single frame of palette indices with Pillow and splits it into
+    the header (with the (256, 3) palette) and the image data
+    """
+    image = Image.fromarray(frame, 'P')
+    image.putpalette(palette.ravel().tolist())
+    data = io.BytesIO()
+    image.save(data, format='GIF', optimize=False)
+    data = data.getvalue()
+
+    # Skips the screen descriptor, palette and extensions to the image
+    packed = data[10]
+    header = 13 + (3 << ((packed & 7) + 1) if packed & 0x80 else 0)
+    offset = header
+    while data[offset] == 0x21:
+        offset += 2
+        while data[offset]:
+            offset += data[offset] + 1
+        offset += 1
+
+    # The delays and looping are GIF89a extensions
+    return b'GIF89a' + data[6:header], data[offset:-1]
+
+
+class GifWriter():
+    """
+    Streams frames of palette indices to an animated GIF one at a time.
+
+    Pillow only writes whole animations from frames it holds in memory, so
+    each frame is encoded on its own and its image data is appended to the
+    file after a graphic control block with the frame's delay
+    """
+    def __init__(self, path, palette, fps):
+        self.file = open(path, 'wb')
+        self.palette = np.zeros((256, 3), dtype=np.uint8)
+        self.palette[:len(palette)] = palette
+        self.delay = round(100 / fps)
+        self.started = False
+
+    def write(self, frame):
+        self.write_encoded(*encode_gif_frame(frame, self.palette))
+
+    def write_encoded(self, header, image):
+        """
+        Appends a frame encoded by encode_gif_frame, e.g. in another process
+        """
+        if not self.started:
+            self.file.write(header)
+            # Loops forever
+            self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+            self.started = True
+        self.file.write(b'\x21\xf9\x04\x04' + struct.pack('<H', self.delay) +
+                        b'\x00\x00')
+        self.file.write(image)
+
+    def close(self):
+        self.file.write(b'\x3b')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FFmpegWriter():
+    """
+    Streams RGB frames to ffmpeg through a pipe, for any format ffmpeg can
+    write such as MP4
+    """
+    def __init__(self, path, palette, fps, width, height):
+        self.palette = palette
+        self.rgb_frame = np.empty((height, width, 3), dtype=np.uint8)
+        try:
+            self.process = subprocess.Popen(
+                ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo',
+                 '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height),
+                 '-r', str(fps), '-i', '-', '-pix_fmt', 'yuv420p', path],
+                stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError('Writing {} needs ffmpeg'.format(path))
+
+    def write(self, frame):
+        np.take(self.palette, frame, axis=0, out=self.rgb_frame)
+        self.process.stdin.write(self.rgb_frame.tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg failed')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_writer(path, renderer, fps):
+    """
+    Opens a streaming writer for the renderer's frames, a GifWriter for .gif
+    files and an FFmpegWriter for anything else
+    """
+    if path.endswith('.gif'):
+        return GifWriter(path, renderer.palette, fps)
+    return FFmpegWriter(path, renderer.palette, fps, renderer.width,
+                        renderer.height)
+
+
+def render_animation(frames, path, renderer, fps=4):
+    """
+    Renders the frames, an iterable of render arguments, and streams them to
+    the file at path
+    """
+    with open_writer(path, renderer, fps) as writer:
+        for frame in frames:
+            writer.write(renderer.render(*frame))
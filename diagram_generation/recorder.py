@@ -0,0 +1,289 @@
+import json
+import os
+
+import numpy as np
+
+from systolic import SystolicArray
+
+
+class TraceRecorder():
+    """
+    Records a run of a model to a directory of flat binary files, so it can be
+    replayed with TraceReader without simulating it again.
+
+    Every cycle stores the left and top vectors of particle indices entering
+    each array, O(N) rather than the N x N cells, which the reader rebuilds
+    from the last N * L of them, and the accumulator events: the particles
+    that received a partial sum and the particles that were flushed. The
+    trace starts with the vectors still in the arrays. The accumulators and
+    position state are stored once per chunk of cycles, and the cycles are
+    written out a chunk at a time. The indices are int16 when n allows it
+    and int32 otherwise.
+    """
+    def __init__(self, model, path, chunk=4096):
+        """
+        Starts a trace of the model's current state in the directory path
+        """
+        self.model = model
+        self.path = path
+        self.chunk = chunk
+
+        self.cycles = 0
+        self.index_dtype = np.int16 if model.n <= np.iinfo(np.int16).max \
+                           else np.int32
+        self.updates = 0
+        self.flushes = 0
+
+        os.makedirs(path, exist_ok=True)
+        for name in TraceReader.files:
+            open(os.path.join(path, name + '.bin'), 'wb').close()
+
+        self.start_chunk()
+        self.entries.extend(self.history())
+
+    def history(self):
+        """
+        The (N * L, arrays, 2, N) left and top vectors that entered the arrays
+        over the last N * L cycles, the oldest first. The last one entered on
+        the current cycle
+        """
+        depth = self.model.N * self.model.latency
+        history = np.empty((depth, len(self.model.arrays), 2, self.model.N),
+                           dtype=np.int64)
+        for a, array in enumerate(self.model.arrays):
+            h = array.head
+            history[:, a, 0] = array.cells_i[:, h:h + depth][:, ::-1].T
+            history[:, a, 1] = array.cells_j[h:h + depth][::-1]
+        return history
+
+    def entering(self):
+        """
+        The (arrays, 2, N) left and top vectors that entered the arrays on
+        the current cycle
+        """
+        return np.stack([(array.cells_i[:, array.head],
+                          array.cells_j[array.head])
+                         for array in self.model.arrays])
+
+    def start_chunk(self):
+        """
+        Stores the accumulators and position state the chunk starts from
+        """
+        self.entries = []
+        self.update_events = []
+        self.update_offsets = []
+        self.flush_events = []
+        self.flush_offsets = []
+        self.keyframes = [self.model.accumulator.accumulators.astype(np.int32),
+                          self.model.position_state.astype(np.int32)]
+
+    def write_chunk(self):
+        """
+        Appends the buffered cycles to the files
+        """
+        streams = {
+            'entries': self.entries,
+            'updates': self.update_events,
+            'update_offsets': [self.update_offsets],
+            'flushes': self.flush_events,
+            'flush_offsets': [self.flush_offsets],
+            'keyframes': [self.keyframes],
+        }
+        dtypes = dict(TraceReader.dtypes, entries=self.index_dtype,
+                      updates=self.index_dtype, flushes=self.index_dtype)
+        for name, data in streams.items():
+            with open(os.path.join(self.path, name + '.bin'), 'ab') as f:
+                for part in data:
+                    np.asarray(part, dtype=dtypes[name]).tofile(f)
+
+    def record(self, cycles):
+        """
+        Steps the model forward the given number of cycles, recording each
+        """
+        accumulator = self.model.accumulator
+        for _ in range(cycles):
+            self.model.forward()
+
+            updated = np.concatenate(accumulator.updated) \
+                      if accumulator.updated else accumulator.flushed[:0]
+            self.update_offsets.append(self.updates)
+            self.update_events.append(updated)
+            self.updates += len(updated)
+            self.flush_offsets.append(self.flushes)
+            self.flush_events.append(accumulator.flushed)
+            self.flushes += len(accumulator.flushed)
+            self.entries.append(self.entering())
+            self.cycles += 1
+
+            if self.cycles % self.chunk == 0:
+                self.write_chunk()
+                self.start_chunk()
+
+    def close(self):
+        """
+        Writes out the last chunk and the metadata
+        """
+        self.update_offsets.append(self.updates)
+        self.flush_offsets.append(self.flushes)
+        self.write_chunk()
+
+        meta = {
+            'n': self.model.n,
+            'N': self.model.N,
+            'arrays': len(self.model.arrays),
+            'latency': self.model.latency,
+            'fold': self.model.fold,
+            'start': self.model.iteration - self.cycles,
+            'cycles': self.cycles,
+            'chunk': self.chunk,
+            'index_dtype': np.dtype(self.index_dtype).name,
+        }
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TraceReader():
+    """
+    Replays a trace written by TraceRecorder. The files are memory mapped, and
+    the state after any cycle is rebuilt from the keyframe of its chunk, and
+    the cells from the vectors that entered the arrays, stepped into the
+    rings of a SystolicArray that works out the pairs. Cycles count from the start of the trace, cycle 0 being the state the
+    recording started from
+    """
+    files = ['entries', 'updates', 'update_offsets', 'flushes',
+             'flush_offsets', 'keyframes']
+    dtypes = {'update_offsets': np.int64, 'flush_offsets': np.int64,
+              'keyframes': np.int32}
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.n = self.meta['n']
+        self.N = self.meta['N']
+        self.arrays = self.meta['arrays']
+        self.cycles = self.meta['cycles']
+        self.chunk = self.meta['chunk']
+        self.latency = self.meta['latency']
+        self.depth = self.N * self.latency
+        self.array = SystolicArray(self.n, self.N, latency=self.latency,
+                                   fold=self.meta['fold'])
+
+        dtypes = dict(self.dtypes, entries=self.meta['index_dtype'],
+                      updates=self.meta['index_dtype'],
+                      flushes=self.meta['index_dtype'])
+        shapes = {'entries': (-1, self.arrays, 2, self.N),
+                  'keyframes': (-1, 2, self.n)}
+        for name in self.files:
+            filename = os.path.join(path, name + '.bin')
+            if os.path.getsize(filename) == 0:
+                data = np.zeros((0), dtype=dtypes[name])
+            else:
+                data = np.memmap(filename, dtype=dtypes[name], mode='r')
+            setattr(self, name, data.reshape(shapes.get(name, (-1,))))
+
+    def cells(self, cycle):
+        """
+        The (arrays, 2, N, N) i and j halves of the cells after the given cycle
+        """
+        if not 0 <= cycle <= self.cycles:
+            raise IndexError('cycle {} is not in the trace'.format(cycle))
+
+        # The newest first, like the rings from their head
+        window = np.asarray(self.entries[cycle:cycle + self.depth][::-1],
+                            dtype=np.int64)
+        array = self.array
+        array.head = 0
+        cells = np.empty((self.arrays, 2, self.N, self.N), dtype=np.int64)
+        for a in range(self.arrays):
+            array.cells_i[:, :self.depth] = window[:, a, 0].T
+            array.cells_j[:self.depth] = window[:, a, 1]
+            cells[a] = array.cells
+        return cells
+
+    def systolic_arrays(self, cycle):
+        """
+        The (arrays, N, N, 2) cells after the given cycle
+        """
+        return np.moveaxis(self.cells(cycle), 1, -1)
+
+    def force_coordinates(self, cycle):
+        """
+        The (k, 3) array of (i, j, array) interactions being calculated after
+        the given cycle, like SystolicModel.generate_force_coordinates
+        """
+        cells = self.cells(cycle)
+        coordinates = []
+        for a in range(self.arrays):
+            cells_i, cells_j = cells[a]
+            active = (cells_i != -1) & (cells_j != -1)
+            coordinates.append(np.column_stack((
+                cells_i[active], cells_j[active],
+                np.full((np.count_nonzero(active)), a + 1)
+            )))
+        return np.concatenate(coordinates)
+
+    def updated(self, cycle):
+        """
+        The particles that received a partial sum on the given cycle
+        """
+        start, end = self.update_offsets[cycle - 1:cycle + 1]
+        return np.asarray(self.updates[start:end], dtype=np.int64)
+
+    def flushed(self, cycle):
+        """
+        The particles that were flushed on the given cycle
+        """
+        start, end = self.flush_offsets[cycle - 1:cycle + 1]
+        return np.asarray(self.flushes[start:end], dtype=np.int64)
+
+    def state(self, cycle):
+        """
+        Returns the accumulators and position state after the given cycle,
+        replaying the events since the start of its chunk
+        """
+        if not 0 <= cycle <= self.cycles:
+            raise IndexError('cycle {} is not in the trace'.format(cycle))
+
+        start = min(cycle // self.chunk, len(self.keyframes) - 1)
+        accumulators = self.keyframes[start, 0].astype(np.int64)
+        position_state = self.keyframes[start, 1].astype(np.int64)
+        for c in range(start * self.chunk + 1, cycle + 1):
+            self.step(c, accumulators, position_state)
+
+        return accumulators, position_state
+
+    def step(self, cycle, accumulators, position_state):
+        """
+        Applies the events of the given cycle to the state after the cycle
+        before, in place
+        """
+        flushed = self.flushed(cycle)
+        accumulators[flushed] = 0
+        position_state[flushed] += 1
+        np.add.at(accumulators, self.updated(cycle), self.N)
+
+    def replay(self, start, count):
+        """
+        Yields the accumulators and position state after each of the count
+        cycles from start. Only the first is rebuilt from a keyframe, the
+        others step the events of one cycle, so the arrays yielded are
+        updated in place
+        """
+        accumulators, position_state = self.state(start)
+        for cycle in range(start, start + count):
+            if cycle > start:
+                self.step(cycle, accumulators, position_state)
+            yield accumulators, position_state
+
+    def fractions(self, cycle):
+        """
+        The accumulators after the given cycle in fractional form for plotting
+        """
+        return self.state(cycle)[0] / self.n
@@ -0,0 +1,149 @@
+# render.py
+#
+# Renders long animations of a model with raster.FrameRenderer, splitting
+# the cycles into chunks that are rendered (and for GIFs encoded) in
+# separate processes. The chunks are written to the output in order as they
+# finish, so only the chunks in flight are held in memory.
+#
+# Each chunk starts from the model fast-forwarded with advance, or from a
+# trace recorded with TraceRecorder.
+
+import argparse
+import os
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+
+from plotter import color_dict
+from raster import FFmpegWriter, FrameRenderer, GifWriter, encode_gif_frame
+from recorder import TraceReader
+from systolic import DoubleModel, MultiModel, SingleModel
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Renders an animation of a systolic model in parallel.')
+    parser.add_argument('output', type=str,
+                        help='The output .gif, or any format ffmpeg writes.')
+    parser.add_argument('n', type=int, nargs='?',
+                        help='The number of particles.')
+    parser.add_argument('N', type=int, nargs='?',
+                        help='The size of the systolic arrays.')
+    parser.add_argument('--arrays', type=int, default=1,
+                        help='The number of systolic arrays.')
+    parser.add_argument('--trace', type=str,
+                        help='Renders a recorded trace instead of a model.')
+    parser.add_argument('--start', type=int, default=0,
+                        help='The first cycle to render.')
+    parser.add_argument('--frames', type=int, required=True,
+                        help='The number of cycles to render.')
+    parser.add_argument('--chunk', type=int, default=64,
+                        help='The number of frames per chunk.')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='The number of processes.')
+    parser.add_argument('--fps', type=float, default=4,
+                        help='The frames per second.')
+    parser.add_argument('--size', type=int, default=256,
+                        help='The height of the panels in pixels.')
+    return parser.parse_args()
+
+
+def make_model(n, N, arrays):
+    if arrays == 1:
+        return SingleModel(n, N)
+    if arrays == 2:
+        return DoubleModel(n, N)
+    return MultiModel(n, N, arrays)
+
+
+def model_frames(n, N, arrays, start, count):
+    """
+    Yields the frames of the cycles from start, fast-forwarding the model
+    """
+    model = make_model(n, N, arrays)
+    model.advance(start)
+    for _ in range(count):
+        yield (model.generate_force_coordinates(),
+               [array.systolic_array for array in model.arrays],
+               model.accumulator.fractions)
+        model.forward()
+
+
+def trace_frames(path, start, count):
+    """
+    Yields the frames of the cycles from start of a recorded trace
+    """
+    trace = TraceReader(path)
+    states = trace.replay(start, count)
+    for cycle, (accumulators, _) in zip(range(start, start + count), states):
+        yield (trace.force_coordinates(cycle), trace.systolic_arrays(cycle),
+               accumulators / trace.n)
+
+
+def render_chunk(job):
+    """
+    Renders the frames of a chunk. GIF frames are encoded here, the frames
+    for ffmpeg are returned as compressed palette indices
+    """
+    config, start, count = job
+    renderer = FrameRenderer(config['n'], config['N'], config['arrays'],
+                             color_dict, config['size'])
+    if config['trace']:
+        frames = trace_frames(config['trace'], start, count)
+    else:
+        frames = model_frames(config['n'], config['N'], config['arrays'],
+                              start, count)
+
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[:len(renderer.palette)] = renderer.palette
+    encoded = []
+    for frame in frames:
+        frame = renderer.render(*frame)
+        if config['gif']:
+            encoded.append(encode_gif_frame(frame, palette))
+        else:
+            encoded.append(zlib.compress(frame.tobytes(), 1))
+
+    return encoded
+
+
+def main():
+    args = parse_args()
+    config = {'n': args.n, 'N': args.N, 'arrays': args.arrays,
+              'trace': args.trace, 'size': args.size,
+              'gif': args.output.endswith('.gif')}
+    if args.trace:
+        trace = TraceReader(args.trace)
+        config.update(n=trace.n, N=trace.N, arrays=trace.arrays)
+        if args.start + args.frames > trace.cycles + 1:
+            raise SystemExit('The trace only has {} cycles'.format(
+                trace.cycles))
+    elif args.n is None or args.N is None:
+        raise SystemExit('Give n and N, or a trace')
+
+    jobs = [(config, start, min(args.chunk, args.start + args.frames - start))
+            for start in range(args.start, args.start + args.frames,
+                               args.chunk)]
+
+    renderer = FrameRenderer(config['n'], config['N'], config['arrays'],
+                             color_dict, args.size)
+    if config['gif']:
+        writer = GifWriter(args.output, renderer.palette, args.fps)
+    else:
+        writer = FFmpegWriter(args.output, renderer.palette, args.fps,
+                              renderer.width, renderer.height)
+
+    with writer, Pool(args.jobs) as pool:
+        # imap hands back the chunks in order
+        for chunk in pool.imap(render_chunk, jobs):
+            for frame in chunk:
+                if config['gif']:
+                    writer.write_encoded(*frame)
+                else:
+                    writer.write(np.frombuffer(
+                        zlib.decompress(frame), dtype=np.uint8
+                    ).reshape(renderer.height, renderer.width))
+
+
+if __name__ == '__main__':
+    main()
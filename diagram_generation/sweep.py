@@ -0,0 +1,176 @@
+# sweep.py
+#
+# Runs the systolic models over a grid of (n, N, number of arrays) in
+# parallel and writes one table with the cycles per timestep, utilization and
+# stalls of every configuration.
+#
+# Every configuration's result is cached as a small JSON file, so running the
+# same sweep again (e.g. after it was interrupted) only runs the missing ones.
+
+import argparse
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from systolic import DataflowModel, MultiModel, SingleModel
+
+columns = ['model', 'n', 'N', 'arrays', 'hazard_policy', 'timesteps',
+           'cycles', 'cycles_per_timestep', 'utilization', 'stall_cycles',
+           'hazard_stalls', 'hazards']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Runs the systolic models over a grid of configurations '
+                    'and writes a CSV or Parquet table of the results.')
+    parser.add_argument('output', type=str,
+                        help='The output table, .csv or .parquet.')
+    parser.add_argument('--n', type=int, nargs='+', required=True,
+                        help='The numbers of particles.')
+    parser.add_argument('--N', type=int, nargs='+', required=True,
+                        help='The sizes of the systolic arrays.')
+    parser.add_argument('--arrays', type=int, nargs='+', default=[1],
+                        help='The numbers of systolic arrays.')
+    parser.add_argument('--model', choices=['fixed', 'dataflow'],
+                        nargs='+', default=['fixed'],
+                        help='fixed walks the SingleModel/MultiModel '
+                             'schedule, dataflow uses DataflowModel.')
+    parser.add_argument('--hazard-policy', choices=['count', 'stall'],
+                        default='stall',
+                        help='How the fixed schedule handles hazards.')
+    parser.add_argument('--timesteps', type=int, default=3,
+                        help='The number of timesteps to run each model.')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='The number of processes.')
+    parser.add_argument('--cache', type=str, default='sweep_cache',
+                        help='The directory of cached results.')
+    return parser.parse_args()
+
+
+def configurations(args):
+    """
+    The grid of configurations as dicts, skipping the ones where N does not
+    divide n
+    """
+    for model, n, N, arrays in itertools.product(args.model, args.n, args.N,
+                                                 args.arrays):
+        if n % N != 0:
+            continue
+        yield {
+            'model': model,
+            'n': n,
+            'N': N,
+            'arrays': arrays,
+            'hazard_policy': args.hazard_policy if model == 'fixed'
+                             else 'count',
+            'timesteps': args.timesteps,
+        }
+
+
+def cache_path(cache, config):
+    """
+    The file a configuration's result is cached in
+    """
+    name = '{model}_{n}_{N}_{arrays}_{hazard_policy}_{timesteps}.json'
+    return os.path.join(cache, name.format(**config))
+
+
+def run(config):
+    """
+    Runs a model until every particle has completed the given number of
+    timesteps and returns the row of the table
+    """
+    n, N, arrays = config['n'], config['N'], config['arrays']
+    if config['model'] == 'dataflow':
+        model = DataflowModel(n, N, arrays)
+    elif arrays == 1:
+        model = SingleModel(n, N, hazard_policy=config['hazard_policy'])
+    else:
+        model = MultiModel(n, N, arrays, hazard_policy=config['hazard_policy'])
+
+    # The first timestep includes filling the arrays, so the cycles per
+    # timestep are measured from the end of the first one
+    first = None
+    while np.min(model.position_state) < config['timesteps']:
+        model.forward()
+        if first is None and np.min(model.position_state) >= 1:
+            first = model.iteration
+
+    timesteps = config['timesteps'] - 1
+    return dict(
+        config,
+        cycles=model.iteration,
+        cycles_per_timestep=(model.iteration - first) / timesteps
+                            if timesteps else float(model.iteration),
+        utilization=model.utilization,
+        stall_cycles=model.iteration * arrays - model.blocks_issued,
+        hazard_stalls=model.hazard_stalls,
+        hazards=int(model.hazards.count),
+    )
+
+
+def run_cached(config, cache):
+    """
+    Runs a configuration unless its result is already cached
+    """
+    path = cache_path(cache, config)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+
+    row = run(config)
+    # Written to the side first so an interrupted write is not a result
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(row, f)
+        os.replace(path + '.tmp', path)
+    except BaseException:
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+    return row
+
+
+def write_table(rows, output):
+    """
+    Writes the rows to a CSV file, or a Parquet file if pandas is installed
+    """
+    if output.endswith('.parquet'):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise SystemExit('Writing Parquet needs pandas and pyarrow')
+        pd.DataFrame(rows, columns=columns).to_parquet(output, index=False)
+        return
+
+    with open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.cache, exist_ok=True)
+
+    configs = list(configurations(args))
+    rows = [None] * len(configs)
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(run_cached, config, args.cache): index
+                   for index, config in enumerate(configs)}
+        for done, future in enumerate(as_completed(futures), 1):
+            row = future.result()
+            rows[futures[future]] = row
+            print('{}/{} {model} n={n} N={N} arrays={arrays}: '
+                  '{cycles_per_timestep:.1f} cycles per timestep'.format(
+                      done, len(configs), **row))
+
+    write_table(rows, args.output)
+
+
+if __name__ == '__main__':
+    main()
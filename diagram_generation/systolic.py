@@ -1,130 +1,633 @@
 import numpy as np
 
+from forces import folded_tile, interaction_tile
+from traversal import fold_diagonals, row_major, traversal_table
 
-class DoubleModel():
-    def __init__(self, n, N):
-        self.N = N
+
+class SystolicModel():
+    """
+    The shared parts of the models: one or more systolic arrays feeding a
+    single set of accumulators. Subclasses pick the blocks each array starts
+    on every cycle through get_next_blocks
+
+    Given the (3, n) positions and the masses of the particles the model
+    also computes the forces, which are read from the accumulators' forces
+    as the particles complete
+
+    The arrays share a HazardDetector with the given policy. With the stall
+    policy the schedule only moves on when the blocks it starts are ready,
+    i.e. all their particles' positions are up to date for the timestep of
+    the schedule, and hazard_stalls counts the cycles it did not. This is
+    checked when a block starts rather than as its particles enter the array,
+    so it can stall schedules that had no hazards
+
+    With counters the model keeps PerformanceCounters of every cycle, which
+    report() summarizes
+
+    Given a memory.MemoryModel the positions come from off-chip memory, and
+    the schedule stalls until the rows of the blocks it starts are on chip,
+    counted in memory_stalls
+
+    The cells of the arrays are pipelined over latency stages, see
+    SystolicArray, so the partial sums of a block leave the arrays latency
+    times later than with single cycle cells
+
+    With fold the arrays fold diagonal blocks and the schedules pair up the
+    diagonal blocks of a timestep into folded blocks (a, c) with a > c, see
+    fold_diagonals, so a timestep takes about b / 2 fewer blocks
+    """
+    def __init__(self, n, N, num_arrays, positions=None, masses=None,
+                 hazard_policy='count', counters=False, memory=None,
+                 latency=1, fold=False):
+        """
+        Constructs a systolic model with given number of particles (n), width
+        of the systolic arrays (N) and number of arrays
+        """
         self.n = n
+        self.N = N
+        self.b = n // N
+        self.latency = latency
+        self.fold = fold
 
         self.iteration = 0
+        self.slot = 0
+        self.hazard_stalls = 0
+        self.memory_stalls = 0
+        self.blocks_issued = 0
+        self.issue_counts = None
         self.position_state = np.zeros((n))
 
-        self.systolic_one = SystolicArray(n, N)
-        self.systolic_two = SystolicArray(n, N)
-        self.accumulator = Accumulator(n, N)
+        self.positions = positions
+        self.masses = masses
+        if positions is not None and masses is None:
+            self.masses = np.ones((n), dtype=positions.dtype)
+
+        self.hazards = HazardDetector(hazard_policy)
+        self.memory = memory
+        self.arrays = [SystolicArray(n, N, self.positions, self.masses,
+                                     self.hazards, a, memory, latency, fold)
+                       for a in range(num_arrays)]
+        self.accumulator = Accumulator(
+            n, N, None if positions is None else positions.dtype
+        )
+        self.counters = PerformanceCounters(N, num_arrays) if counters \
+                        else None
+
+        self.arrivals = None
 
     def forward(self):
         """
         Steps the simulatioon forward
         """
-        i_one, j_one, i_two, j_two = self.get_next_block()
+        blocks = requested = self.get_next_blocks()
+        if self.hazards.policy == 'stall' and not self.ready(blocks):
+            blocks = [(-1, -1)] * len(self.arrays)
+            self.hazard_stalls += 1
+        elif self.memory is not None and \
+             not self.memory.ready(blocks, self.iteration):
+            blocks = [(-1, -1)] * len(self.arrays)
+            self.memory_stalls += 1
+        else:
+            self.slot += 1
+        if self.memory is not None and self.memory.lookahead:
+            waiting = {row for block in requested for row in block}
+            self.memory.prefetch(self.upcoming_blocks(self.memory.lookahead),
+                                 self.iteration, waiting)
+        self.blocks_issued += sum(1 for i, _ in blocks if i != -1)
 
-        top_one, left_one = self.systolic_one.update_position_buffer(i_one,
-                                                                     j_one)
-        top_two, left_two = self.systolic_two.update_position_buffer(i_two,
-                                                                     j_two)
+        outputs = []
+        for array, (i, j) in zip(self.arrays, blocks):
+            top, left = array.update_position_buffer(i, j)
+            outputs.append(array.update_systolic_array(
+                top, left, self.position_state
+            ))
 
-        bottom_one, right_one = self.systolic_one.update_systolic_array(
-            top_one, left_one, self.position_state
-        )
-        bottom_two, right_two = self.systolic_two.update_systolic_array(
-            top_two, left_two, self.position_state
-        )
+        flushed = self.accumulator.flush_accumulators()
+        for array, (bottom, right) in zip(self.arrays, outputs):
+            self.accumulator.update_accumulators(bottom, right,
+                                                 array.bottom_forces,
+                                                 array.right_forces)
 
-        position_state_update = self.accumulator.flush_accumulators()
-        self.accumulator.update_accumulators(bottom_one, right_one)
-        self.accumulator.update_accumulators(bottom_two, right_two)
-
-        self.position_state = self.position_state + position_state_update
+        self.position_state[flushed] += 1
+        if self.counters is not None:
+            self.counters.record(self.iteration, self.arrays, blocks,
+                                 self.accumulator)
         self.iteration += 1
 
-    def get_next_block(self):
+    def get_next_blocks(self):
         """
-        Returns the next block indexes to start execuing based on the iteration
+        Returns a list with the (i, j) block each array starts on this
+        iteration. This only differs from blocks_at(iteration) once the
+        model has stalled
+        """
+        return self.blocks_at(self.slot)
 
-        I gave up on the math and decided to just hard code it
+    def upcoming_blocks(self, cycles):
+        """
+        The blocks the schedule starts over the next given number of cycles,
+        in order
         """
-        i_values_one = [0] * 8 + [3] * 5 + [4] * 4 + [7] * 1 + [-1]
-        j_values_one = list(range(0,8)) + list(range(3,8)) + \
-                       list(range(4,8)) + list(range(7,8)) + [-1]
+        return [block for slot in range(self.slot, self.slot + cycles)
+                for block in self.blocks_at(slot)]
 
-        i_values_two = [1] * 7 + [2] * 6 + [5] * 3 + [6] * 2 + [-1]
-        j_values_two = list(range(1,8)) + list(range(2,8)) + \
-                       list(range(5,8)) + list(range(6,8)) + [-1]
+    def ready(self, blocks):
+        """
+        Checks whether the particles of the given blocks are up to date for
+        the timestep of the current slot of the schedule
+        """
+        timestep = self.slot // self.period
+        for block in blocks:
+            for row in block:
+                if row != -1 and np.min(self.position_state[
+                        row * self.N:(row + 1) * self.N]) < timestep:
+                    return False
+        return True
 
-        remain = self.iteration % (len(i_values_one))
+    def schedule_blocks(self):
+        """
+        Returns the blocks of a timestep in the order their partial sums reach
+        the accumulators, to pass to forces.direct_sum
+        """
+        return [(i, j) for slot in range(self.period)
+                for i, j in self.blocks_at(slot) if i != -1]
 
-        return i_values_one[remain], j_values_one[remain], i_values_two[remain], \
-               j_values_two[remain]
+    def blocks_at(self, iteration):
+        """
+        Returns a list with the (i, j) block each array starts on the given
+        iteration. The schedule repeats every self.period iterations
+        """
+        raise NotImplementedError
 
-    def generate_force_matrix_data(self):
+    def advance(self, k):
         """
-        Generates the force matrix for plotting based on the current systolic
-        state
+        Jumps the model forward k cycles, ending in the same state as k calls
+        to forward()
+
+        The state only depends on the iteration. The arrays and buffers hold
+        the last (2N - 1) * latency blocks, and every particle receives the
+        same partial sums each period of the schedule, so the accumulators and
+        position state follow from counting how many of them have arrived.
+        This costs O(N^2 L + n log b) whatever k is, after a one off pass over
+        a period of the schedule. The hazard detector is not replayed.
+
+        The partial force sums of a numerical model depend on every block of
+        the timestep so far, a model with the stall policy may stall at any
+        point, the counters record every cycle and the memory model depends on
+        the order of the fetches, so those are stepped.
         """
-        force_one = self.systolic_one.generate_force_matrix_data()
-        force_two = 2 * self.systolic_two.generate_force_matrix_data()
+        if k <= 0:
+            return
+
+        if self.arrivals is None:
+            self.arrivals = self.schedule_arrivals()
+        if self.arrivals is False or self.positions is not None or \
+           self.hazards.policy == 'stall' or self.counters is not None or \
+           self.memory is not None:
+            # The accumulators can overflow with this schedule, so there is
+            # no shortcut
+            for _ in range(k):
+                self.forward()
+            return
+
+        self.blocks_issued += self.issued_before(self.slot + k) - \
+                              self.issued_before(self.slot)
+        self.iteration += k
+        self.slot += k
+        self.restore_arrays()
+        self.restore_accumulators()
 
-        force_matrix = force_one + force_two
+    def issued_before(self, slot):
+        """
+        The number of blocks the schedule starts before the given slot
+        """
+        if self.issue_counts is None:
+            self.issue_counts = np.cumsum([0] + [
+                sum(i != -1 for i, _ in self.blocks_at(t))
+                for t in range(self.period)
+            ])
+        periods, into = divmod(slot, self.period)
+        return int(periods * self.issue_counts[-1] + self.issue_counts[into])
 
-        assert(not np.any(force_matrix == 3.0))
+    @property
+    def utilization(self):
+        """
+        The fraction of array cycles so far that started a block, i.e. the PE
+        utilization once the arrays are full
+        """
+        if self.iteration == 0:
+            return 0.0
+        return self.blocks_issued / (self.iteration * len(self.arrays))
+
+    @property
+    def blocks_per_timestep(self):
+        """
+        The blocks of a timestep, b (b + 1) / 2 or with folded diagonal blocks
+        b (b - 1) / 2 + ceil(b / 2)
+        """
+        if self.fold:
+            return self.b * (self.b - 1) // 2 + (self.b + 1) // 2
+        return self.b * (self.b + 1) // 2
+
+    @property
+    def interaction_utilization(self):
+        """
+        The fraction of cell cycles so far spent on distinct interactions, of
+        which a timestep has n (n - 1) / 2. Without folding the cells on and
+        below the diagonal of diagonal blocks are wasted, so this stays below
+        utilization
+        """
+        if self.iteration == 0:
+            return 0.0
+        timesteps = self.blocks_issued / self.blocks_per_timestep
+        return timesteps * self.n * (self.n - 1) / 2 / \
+               (self.iteration * len(self.arrays) * self.N * self.N)
+
+    @property
+    def bytes_per_timestep(self):
+        """
+        The bytes read from off-chip memory per timestep's worth of blocks
+        started so far
+        """
+        if self.memory is None or self.blocks_issued == 0:
+            return 0.0
+        timesteps = self.blocks_issued / self.blocks_per_timestep
+        return self.memory.bytes_moved / timesteps
+
+    def report(self):
+        """
+        Summarizes the performance counters, see PerformanceCounters.report
+        """
+        if self.counters is None:
+            raise ValueError('The model was constructed without counters')
+        return self.counters.report()
+
+    def generate_force_coordinates(self):
+        """
+        Returns a (k, 3) array of (i, j, array) for the interactions currently
+        being calculated, with the arrays numbered from 1. This only grows
+        with the size of the arrays, not with n
+        """
+        coordinates = np.concatenate([
+            np.column_stack((cells, np.full((len(cells)), a + 1)))
+            for a, cells in enumerate(array.generate_force_coordinates()
+                                      for array in self.arrays)
+        ])
+
+        # No interaction should be calculated by two arrays at once
+        keys = coordinates[:, 0] * self.n + coordinates[:, 1]
+        assert(len(np.unique(keys)) == len(keys))
+
+        return coordinates
+
+    def generate_block_occupancy(self):
+        """
+        Returns an (m, 4) array of (block i, block j, array, cells) for the
+        blocks currently being calculated, with the arrays numbered from 1
+        """
+        return np.concatenate([
+            np.column_stack((blocks[:, :2], np.full((len(blocks)), a + 1),
+                             blocks[:, 2]))
+            for a, blocks in enumerate(array.generate_block_occupancy()
+                                       for array in self.arrays)
+        ])
+
+    def generate_force_matrix_data(self):
+        """
+        Generates the dense n x n force matrix for plotting, holding the number
+        of the array calculating each interaction. Prefer
+        generate_force_coordinates for large n
+        """
+        coordinates = self.generate_force_coordinates()
+        force_matrix = np.zeros((self.n, self.n))
+        force_matrix[coordinates[:, 0], coordinates[:, 1]] = coordinates[:, 2]
 
         return force_matrix
 
+    def restore_arrays(self):
+        """
+        Sets the arrays and buffers from the last (2N - 1) * latency blocks
+        issued
+        """
+        depth = (2 * self.N - 1) * self.latency
+        idle = [(-1, -1)] * len(self.arrays)
+        history = [self.blocks_at(t) if t >= 0 else idle
+                   for t in range(self.iteration - depth, self.iteration)]
 
-class SingleModel():
-    def __init__(self, n, N):
+        for a, array in enumerate(self.arrays):
+            array.restore([blocks[a] for blocks in history], self.iteration)
+
+    def schedule_arrivals(self):
         """
-        Constructs a systolic model with given number of particles (n) and
-        width of systolic array (N)
+        Finds when each block row receives its partial sums over a period of
+        the schedule.
+
+        Returns a (b, b) matrix holding, for each block row, the sorted cycles
+        within a period at which its first particle receives a partial sum
+        (particle r of the row receives it r * latency cycles later). Returns
+        False if a row does not receive exactly one sum per block, or if a
+        row could receive the next period's sums before it has been flushed.
         """
-        self.n = n
-        self.N = N
-        self.b = n // N
+        arrivals = [[] for _ in range(self.b)]
+        for slot in range(self.period):
+            for i, j in self.blocks_at(slot):
+                if i == -1:
+                    continue
+                arrivals[i].append(slot + self.N * self.latency)
+                if i != j:
+                    arrivals[j].append(slot + self.N * self.latency)
 
-        self.iteration = 0
-        self.position_state = np.zeros((n))
+        if any(len(row) != self.b for row in arrivals):
+            return False
 
-        self.systolic_array = SystolicArray(n, N)
-        self.accumulator = Accumulator(n, N)
+        arrivals = np.sort(np.array(arrivals), axis=1)
+        if np.any(arrivals[:, -1] - arrivals[:, 0] > self.period - 1):
+            return False
 
-    def forward(self):
+        return arrivals
+
+    def restore_accumulators(self):
         """
-        Steps the simulatioon forward
+        Sets the accumulators and position state from the number of partial
+        sums each particle has received by the current iteration
         """
-        i, j = self.get_next_block()
+        N, b, period = self.N, self.b, self.period
+        arrivals = self.arrivals
 
-        top, left = self.systolic_array.update_position_buffer(i, j)
-        bottom, right = self.systolic_array.update_systolic_array(
-            top, left, self.position_state
-        )
+        particles = np.arange(self.n)
+        row = particles // N
+        last = self.iteration - 1 - particles % N * self.latency
 
-        position_state_update = self.accumulator.flush_accumulators()
-        self.accumulator.update_accumulators(bottom, right)
+        # Sums received from whole periods, then the ones from the current one
+        first = arrivals[row, 0]
+        started = last >= first
+        periods, into = np.divmod(last - first, period)
+        offsets = arrivals - arrivals[:, :1] + np.arange(b)[:, None] * period
+        partial = np.searchsorted(offsets.ravel(), into + row * period,
+                                  side='right') - row * b
+        received = np.where(started, b * periods + partial, 0)
 
-        self.position_state = self.position_state + position_state_update
-        self.iteration += 1
+        # A particle is flushed the cycle after its last sum of a period
+        flushed = last - 1 - arrivals[row, -1]
+        flushed = np.where(flushed >= 0, flushed // period + 1, 0)
+
+        self.accumulator.restore(N * received - self.n * flushed)
+        self.position_state = flushed.astype(self.position_state.dtype)
+
+
+class MultiModel(SystolicModel):
+    """
+    K systolic arrays working on the upper triangle of blocks together.
+
+    The block rows are split between the arrays longest first, each going to
+    the array with the least blocks so far, and every array walks its rows in
+    row major order. If a particle could be used for the next timestep
+    before its position has been updated, the schedule is padded with stall
+    cycles until it can't. Folding pairs up the diagonal blocks of each
+    array's rows.
+    """
+    def __init__(self, n, N, K, **kwargs):
+        """
+        Constructs a model with given number of particles (n), width of the
+        systolic arrays (N) and number of arrays (K)
+        """
+        super().__init__(n, N, K, **kwargs)
+        self.K = K
+
+        self.rows = self.balance_rows()
+        self.schedule = self.build_schedule()
+        self.period = len(self.schedule)
+
+    def balance_rows(self):
+        """
+        Splits the block rows between the arrays. Returns a list with the rows
+        of each array in ascending order
+        """
+        loads = [0] * self.K
+        rows = [[] for _ in range(self.K)]
+        # Row i has b - i blocks so the rows are already longest first
+        for i in range(self.b):
+            array = loads.index(min(loads))
+            rows[array].append(i)
+            loads[array] += self.b - i
+
+        return rows
+
+    def build_schedule(self):
+        """
+        Builds the (period, K, 2) table of the block each array starts on each
+        cycle of a timestep, with -1 for stall cycles
+        """
+        walks = [[(i, j) for i in rows for j in range(i, self.b)]
+                 for rows in self.rows]
+        if self.fold:
+            walks = [fold_diagonals(walk) for walk in walks]
+
+        # Every particle needs its last partial sum of the timestep to come
+        # out of the array (N * latency cycles), be flushed and update the
+        # position state before it is used again next timestep
+        first = np.full((self.b), np.iinfo(np.int64).max)
+        last = np.full((self.b), -1)
+        for walk in walks:
+            for slot, (i, j) in enumerate(walk):
+                for row in (i, j):
+                    first[row] = min(first[row], slot)
+                    last[row] = max(last[row], slot)
+        period = max(max(len(walk) for walk in walks),
+                     np.max(last - first) + self.N * self.latency + 2)
+
+        schedule = np.full((period, self.K, 2), -1)
+        for array, walk in enumerate(walks):
+            if walk:
+                schedule[:len(walk), array] = walk
+
+        return schedule
+
+    def blocks_at(self, iteration):
+        """
+        Returns the block indexes to start execuing on the given iteration
+        """
+        return [tuple(block) for block in
+                self.schedule[iteration % self.period]]
+
+    @property
+    def stall_cycles(self):
+        """
+        The number of stall cycles of each array per timestep
+        """
+        return [int(stalls) for stalls in
+                np.count_nonzero(self.schedule[:, :, 0] == -1, axis=0)]
+
+    @property
+    def makespan(self):
+        """
+        Cycles for a single timestep from an empty array, until the last
+        partial sum has left the arrays
+        """
+        busy = self.period - min(self.stall_cycles)
+        return busy + (2 * self.N - 1) * self.latency
+
+    @property
+    def blocks_per_timestep(self):
+        """
+        The blocks of a timestep. Each array folds the diagonal blocks of its
+        own rows, so with fold an array with an odd number of them has one
+        left over
+        """
+        return int(np.count_nonzero(self.schedule[:, :, 0] != -1))
+
+    @property
+    def speedup(self):
+        """
+        The speedup in cycles per timestep over SingleModel, folding the
+        same way
+        """
+        return super().blocks_per_timestep / self.period
+
+
+class DoubleModel(MultiModel):
+    def __init__(self, n, N, **kwargs):
+        super().__init__(n, N, 2, **kwargs)
+        self.systolic_one, self.systolic_two = self.arrays
 
     def get_next_block(self):
         """
         Returns the next block indexes to start execuing based on the iteration
+        """
+        (i_one, j_one), (i_two, j_two) = self.get_next_blocks()
+        return i_one, j_one, i_two, j_two
+
 
-        The math a pretty ugly, but this should just trace the upper triangle
-        of the matrix
+class SingleModel(SystolicModel):
+    def __init__(self, n, N, order='row_major', **kwargs):
+        """
+        Constructs a systolic model with given number of particles (n) and
+        width of systolic array (N), walking the upper triangle in the given
+        traversal order
         """
-        num_blocks = self.b * (self.b + 1) / 2
-        b = self.b - 1
+        super().__init__(n, N, 1, **kwargs)
+        self.systolic_array = self.arrays[0]
+        self.order = order
+        self.traversal = traversal_table(order, self.b, self.fold)
+        self.period = len(self.traversal)
 
-        remain = self.iteration % num_blocks
+    def get_next_block(self):
+        """
+        Returns the next block indexes to start execuing based on the iteration
+        """
+        return self.get_next_blocks()[0]
 
-        i = int(0.5 * (-1 * np.sqrt(4*b*b + 12*b - 8*remain + 9) + 2*b + 3))
-        j = remain - ((2*b + 1 - i) * i) // 2
-        j = int(j)
+    def blocks_at(self, iteration):
+        """
+        Returns the block indexes to start execuing on the given iteration,
+        looked up in the traversal table
+        """
+        i, j = self.traversal[iteration % self.period]
+        return [(int(i), int(j))]
 
-        return i, j
 
-    def generate_force_matrix_data(self):
-        return self.systolic_array.generate_force_matrix_data()
+class DataflowModel(SystolicModel):
+    """
+    K systolic arrays without a fixed schedule. Each cycle every array starts
+    a block whose particles are up to date, so the blocks of the next
+    timestep start as soon as their particles have been flushed instead of
+    waiting for the whole timestep.
+
+    A block of timestep t is ready once the position state of both its block
+    rows has reached t. Blocks of the oldest timestep go first, and among
+    those the blocks whose rows have the fewest blocks left to start, i.e.
+    whose accumulators will complete soonest and release the rows' blocks of
+    the next timestep. Only two timesteps can have blocks left at once,
+    since every block row shares a block with every other. An array with no
+    ready block stalls for the cycle, counted in stalls.
+    """
+    def __init__(self, n, N, K=1, **kwargs):
+        """
+        Constructs a model with given number of particles (n), width of the
+        systolic arrays (N) and number of arrays (K)
+        """
+        super().__init__(n, N, K, **kwargs)
+        self.K = K
+
+        # The blocks left to start of the current and next timestep
+        self.timestep = 0
+        self.remaining = [self.timestep_blocks(), self.timestep_blocks()]
+        self.stalls = 0
+
+    def timestep_blocks(self):
+        """
+        The (b, b) mask of the blocks of a timestep: the upper triangle, or
+        with folding its blocks off the diagonal and the folded blocks below
+        it
+        """
+        if not self.fold:
+            return np.triu(np.ones((self.b, self.b), dtype=bool))
+        mask = np.zeros((self.b, self.b), dtype=bool)
+        mask[tuple(np.array(fold_diagonals(row_major(self.b))).T)] = True
+        return mask
+
+    def get_next_blocks(self):
+        """
+        Picks the block each array starts on this iteration
+        """
+        timesteps = self.position_state.reshape(self.b, self.N).min(axis=1)
+
+        blocks = []
+        picked = []
+        for _ in range(self.K):
+            block = (-1, -1)
+            for t, remaining in enumerate(self.remaining):
+                up_to_date = timesteps >= self.timestep + t
+                ready = remaining & up_to_date[:, None] & up_to_date[None, :]
+                if not ready.any():
+                    continue
+
+                # A block row's blocks are its row and column of the triangle
+                left = remaining.sum(axis=0) + remaining.sum(axis=1) - \
+                       np.diagonal(remaining)
+                score = np.where(ready, left[:, None] + left[None, :],
+                                 np.iinfo(np.int64).max)
+                i, j = np.unravel_index(np.argmin(score), score.shape)
+                remaining[i, j] = False
+                block = (int(i), int(j))
+                picked.append((t, block))
+                break
+
+            if block == (-1, -1):
+                self.stalls += 1
+            blocks.append(block)
+
+        # The picked blocks go back if their rows are not on chip yet
+        if self.memory is not None and \
+           not self.memory.ready(blocks, self.iteration):
+            for t, (i, j) in picked:
+                self.remaining[t][i, j] = True
+            self.memory_stalls += 1
+            return [(-1, -1)] * self.K
+
+        if not self.remaining[0].any():
+            self.remaining = [self.remaining[1], self.timestep_blocks()]
+            self.timestep += 1
+
+        return blocks
+
+    def ready(self, blocks):
+        """
+        The blocks picked are always ready
+        """
+        return True
+
+    def upcoming_blocks(self, cycles):
+        """
+        The blocks are picked as the particles are ready, so nothing can be
+        fetched ahead
+        """
+        return []
+
+    def schedule_arrivals(self):
+        """
+        There is no periodic schedule, so advance always steps
+        """
+        return False
 
 
 class Accumulator():
@@ -136,38 +639,86 @@ class Accumulator():
     right elements.
 
     Given each output of the systolic array it updates the corresponding
-    accumulator.
-    If an accumulator is full it will return those and zero them out
-    The check should happen before the new vector is added because it
-    should stay full for an iteration. This new vector is returned and used
-    to update the state of each position
+    accumulator with a scatter add. Accumulators that become full are put in
+    a ready queue, and the next flush returns those and zeros them out. The
+    flush should happen before the new vectors are added because a full
+    accumulator should stay full for an iteration. The particles returned
+    are used to update the state of each position. Neither touches more than
+    the particles coming out of the arrays, so a cycle costs the same
+    whatever n is.
+
+    Given a dtype the accumulators also sum the (3, n) partial forces that
+    come out of a numerical systolic array. When a particle is flushed its
+    force is moved to forces, where it stays until the next timestep's force
+    replaces it
     """
-    def __init__(self, n, N):
+    def __init__(self, n, N, dtype=None):
         self.n = n
         self.N = N
-        self.accumulators = np.zeros((n))
+        self.accumulators = np.zeros((n), dtype=np.int64)
+
+        self.ready = []
+        self.updated = []
+        self.flushed = np.zeros((0), dtype=np.int64)
+        self.occupied = 0
+
+        self.partial_forces = None
+        self.forces = None
+        if dtype is not None:
+            self.partial_forces = np.zeros((3, n), dtype=dtype)
+            self.forces = np.zeros((3, n), dtype=dtype)
 
     def flush_accumulators(self):
-        position_state_update = np.zeros((self.n))
-        for i in range(self.n):
-            if self.accumulators[i] == self.n:
-                position_state_update[i] = 1
-                self.accumulators[i] = 0
+        """
+        Zeros out the full accumulators and returns their particles
+        """
+        if self.ready:
+            flushed = np.concatenate(self.ready)
+        else:
+            flushed = np.zeros((0), dtype=np.int64)
+        self.ready = []
+        self.updated = []
 
-        return position_state_update
+        self.accumulators[flushed] = 0
+        self.occupied -= len(flushed)
+        if self.forces is not None:
+            self.forces[:, flushed] = self.partial_forces[:, flushed]
+            self.partial_forces[:, flushed] = 0
 
-    def update_accumulators(self, bottom, right):
-        # Handle the right
-        for i in range(self.N):
-            if right[i,0] != -1:
-                self.accumulators[right[i,0]] += self.N
+        self.flushed = flushed
+        return flushed
 
-        # Handles the bottom
-        for j in range(self.N):
-            # For diagonal blocks we ignore the bottom
-            if bottom[j,1] != -1 and ((bottom[j,1] // self.N) != \
-                                      (bottom[j,0] // self.N)):
-                self.accumulators[bottom[j,1]] += self.N
+    def update_accumulators(self, bottom, right, bottom_forces=None,
+                            right_forces=None):
+        # For diagonal blocks we ignore the bottom
+        use_right = right[:, 0] != -1
+        use_bottom = (bottom[:, 1] != -1) & \
+                     (bottom[:, 1] // self.N != bottom[:, 0] // self.N)
+
+        # The same particle can come out of the right and the bottom, so
+        # this has to be an unbuffered add
+        particles = np.concatenate((right[use_right, 0],
+                                    bottom[use_bottom, 1]))
+        self.occupied += len(np.unique(
+            particles[self.accumulators[particles] == 0]))
+        np.add.at(self.accumulators, particles, self.N)
+        if right_forces is not None:
+            np.add.at(self.partial_forces, (slice(None), particles),
+                      np.concatenate((right_forces[:, use_right],
+                                      bottom_forces[:, use_bottom]), axis=1))
+
+        full = np.unique(particles[self.accumulators[particles] == self.n])
+        if len(full):
+            self.ready.append(full)
+        self.updated.append(particles)
+
+    def restore(self, accumulators):
+        """
+        Sets the accumulators, queueing the full ones to be flushed
+        """
+        self.accumulators[:] = accumulators
+        self.ready = [np.flatnonzero(self.accumulators == self.n)]
+        self.occupied = np.count_nonzero(self.accumulators)
 
     @property
     def fractions(self):
@@ -177,7 +728,595 @@ class Accumulator():
         return self.accumulators / self.n
 
 
+class HazardError(RuntimeError):
+    """
+    Raised by a HazardDetector with the raise policy
+    """
+
+
+class HazardDetector():
+    """
+    Checks that every cell pairs particles from the same timestep.
+
+    A cell whose two particles have different position states is a read
+    after write hazard: one of the positions has already been updated for
+    the next timestep (or the other has not been yet). Each event's cycle,
+    array, cell, particles and their timesteps are stored in a preallocated
+    buffer, and once it is full the rest are only counted.
+
+    The policy decides what else happens:
+        'count': nothing, the events are just recorded
+        'raise': a HazardError is raised
+        'stall': the model checks the particles of the next blocks before
+                 starting them, and stalls the arrays for a cycle instead of
+                 starting blocks that are not ready
+    """
+    policies = ('count', 'raise', 'stall')
+    event_dtype = np.dtype([('cycle', np.int64), ('array', np.int64),
+                            ('row', np.int64), ('col', np.int64),
+                            ('i', np.int64), ('j', np.int64),
+                            ('time_i', np.int64), ('time_j', np.int64)])
+
+    def __init__(self, policy='count', capacity=1024):
+        if policy not in self.policies:
+            raise ValueError('Unknown hazard policy {}'.format(policy))
+
+        self.policy = policy
+        self.buffer = np.zeros((capacity), dtype=self.event_dtype)
+        self.count = 0
+
+        self.time_i = None
+        self.time_j = None
+        self.mismatch = None
+        self.valid = None
+
+    @property
+    def events(self):
+        """
+        The recorded events, oldest first
+        """
+        return self.buffer[:min(self.count, len(self.buffer))]
+
+    @property
+    def dropped(self):
+        """
+        The number of events that did not fit in the buffer
+        """
+        return max(0, self.count - len(self.buffer))
+
+    def check(self, cycle, array, cells_i, cells_j, position_state):
+        """
+        Checks the (N, N) i and j halves of the cells of an array against the
+        position state. This does not allocate unless there are hazards
+        """
+        if self.mismatch is None or self.mismatch.shape != cells_i.shape or \
+           self.time_i.dtype != position_state.dtype:
+            self.time_i = np.empty(cells_i.shape, dtype=position_state.dtype)
+            self.time_j = np.empty(cells_i.shape, dtype=position_state.dtype)
+            self.mismatch = np.empty(cells_i.shape, dtype=bool)
+            self.valid = np.empty(cells_i.shape, dtype=bool)
+
+        np.take(position_state, cells_i, out=self.time_i, mode='wrap')
+        np.take(position_state, cells_j, out=self.time_j, mode='wrap')
+        np.not_equal(self.time_i, self.time_j, out=self.mismatch)
+        # Empty cells can't be hazards
+        np.not_equal(cells_i, -1, out=self.valid)
+        np.logical_and(self.mismatch, self.valid, out=self.mismatch)
+        np.not_equal(cells_j, -1, out=self.valid)
+        np.logical_and(self.mismatch, self.valid, out=self.mismatch)
+
+        hazards = int(np.count_nonzero(self.mismatch))
+        if hazards == 0:
+            return 0
+
+        rows, cols = np.nonzero(self.mismatch)
+        start = min(self.count, len(self.buffer))
+        stored = min(hazards, len(self.buffer) - start)
+        events = self.buffer[start:start + stored]
+        rows, cols = rows[:stored], cols[:stored]
+        events['cycle'] = cycle
+        events['array'] = array
+        events['row'] = rows
+        events['col'] = cols
+        events['i'] = cells_i[rows, cols]
+        events['j'] = cells_j[rows, cols]
+        events['time_i'] = self.time_i[rows, cols]
+        events['time_j'] = self.time_j[rows, cols]
+        self.count += hazards
+
+        if self.policy == 'raise':
+            raise HazardError(
+                'Cycle {}: cell ({}, {}) of array {} pairs particle {} at '
+                'timestep {} with particle {} at timestep {}'.format(
+                    cycle, rows[0], cols[0], array, cells_i[rows[0], cols[0]],
+                    int(self.time_i[rows[0], cols[0]]),
+                    cells_j[rows[0], cols[0]],
+                    int(self.time_j[rows[0], cols[0]])))
+
+        return hazards
+
+
+class PerformanceCounters():
+    """
+    Counts what the arrays and accumulators do on every cycle of a model:
+        active: cells holding an interaction
+        idle: cells holding nothing
+        diagonal_wasted: cells of diagonal blocks on or below the diagonal,
+                         which repeat an interaction (or pair a particle with
+                         itself) since the accumulators ignore their bottom,
+                         see SystolicArray.wasted_cells
+        occupancy: particles with a partial sum in their accumulator
+        completed: particles flushed
+        stalls: arrays that started no block
+
+    The counts are kept per cycle in a structured array, which grows as
+    needed, and report() summarizes them
+    """
+    fields = ('active', 'idle', 'diagonal_wasted', 'occupancy', 'completed',
+              'stalls')
+    cycle_dtype = np.dtype([('cycle', np.int64)] +
+                           [(field, np.int64) for field in fields])
+
+    def __init__(self, N, num_arrays, capacity=4096):
+        self.N = N
+        self.num_arrays = num_arrays
+        self.buffer = np.zeros((capacity), dtype=self.cycle_dtype)
+        self.count = 0
+
+    @property
+    def cycles(self):
+        """
+        The counts of every cycle recorded, oldest first
+        """
+        return self.buffer[:self.count]
+
+    @property
+    def totals(self):
+        """
+        A dict with the total of each count
+        """
+        return {field: int(np.sum(self.cycles[field]))
+                for field in self.fields}
+
+    def record(self, cycle, arrays, blocks, accumulator):
+        """
+        Counts the cells of the arrays after the given cycle, the blocks they
+        started and the state of the accumulator
+        """
+        N = self.N
+        active = 0
+        wasted = 0
+        for array in arrays:
+            cells_i, cells_j = array.cells
+            active += np.count_nonzero((cells_i != -1) & (cells_j != -1))
+            wasted += array.wasted_cells
+
+        if self.count == len(self.buffer):
+            self.buffer = np.concatenate((self.buffer,
+                                          np.zeros_like(self.buffer)))
+        counts = self.buffer[self.count]
+        counts['cycle'] = cycle
+        counts['active'] = active
+        counts['idle'] = len(arrays) * N * N - active
+        counts['diagonal_wasted'] = wasted
+        counts['occupancy'] = accumulator.occupied
+        counts['completed'] = len(accumulator.flushed)
+        counts['stalls'] = sum(1 for i, _ in blocks if i == -1)
+        self.count += 1
+
+    def report(self):
+        """
+        Returns a dict summarizing the cycles recorded:
+            cycles: the number of cycles
+            utilization: the fraction of cells holding an interaction
+            interactions_per_cycle: distinct interactions calculated per
+                                    cycle, leaving out the diagonal waste
+            time_to_first_completion: cycles until the first particle was
+                                      flushed, or None if none was
+            completed_per_cycle: particles flushed per cycle
+            mean_occupancy: the mean number of accumulators in use
+            stall_cycles: array cycles that started no block
+            diagonal_wasted: cells spent on diagonal waste
+        """
+        cycles = self.cycles
+        totals = self.totals
+        if self.count == 0:
+            raise ValueError('No cycles have been recorded')
+
+        completions = np.flatnonzero(cycles['completed'])
+        first = None
+        if len(completions):
+            first = int(cycles['cycle'][completions[0]] -
+                        cycles['cycle'][0] + 1)
+
+        cells = self.count * self.num_arrays * self.N * self.N
+        return {
+            'cycles': self.count,
+            'utilization': totals['active'] / cells,
+            'interactions_per_cycle': (totals['active'] -
+                                       totals['diagonal_wasted']) / self.count,
+            'time_to_first_completion': first,
+            'completed_per_cycle': totals['completed'] / self.count,
+            'mean_occupancy': totals['occupancy'] / self.count,
+            'stall_cycles': totals['stalls'],
+            'diagonal_wasted': totals['diagonal_wasted'],
+        }
+
+
 class SystolicArray():
+    """
+    The systolic array stepped with preallocated ring buffers.
+
+    Rather than rolling the cells every cycle, the row moving (i) and column
+    moving (j) halves of the array are stored twice over in (N, 2N) and
+    (2N, N) arrays. A head offset moves back by one each cycle and only the
+    newly entering column/row is written (to both copies), so the logical
+    array is always the contiguous slice starting at the head. The staggered
+    position buffers work the same way with a head that moves down a row
+    each cycle.
+
+    The top/left/bottom/right vectors handed out are preallocated and reused,
+    so they are only valid until the next cycle.
+
+    Given the (3, n) positions and the masses the array also computes the
+    forces. When a block enters the buffers its positions and masses are
+    read and the whole N x N block is evaluated at once with
+    interaction_tile. The partial sums then wait in delay lines and leave
+    the array in bottom_forces/right_forces ((3, N) each) on the same cycles
+    as their particles leave in bottom/right.
+
+    Given a memory.MemoryModel the blocks' positions are read from its
+    on-chip buffer, which the model has to have checked is ready.
+
+    With a latency of L the cells are pipelined over L stages like the cells
+    generated with --latency L: a cell's outputs leave L cycles after its
+    inputs came in, so element k of a block enters k * L cycles after the
+    block and takes N * L cycles to cross the array. The rings then keep the
+    last N * L columns/rows that entered, and the cells are every L-th of
+    them, the pairs starting the pipeline of each cell this cycle.
+
+    With fold the diagonal cells fold blocks (i, j) with i >= j: rather than
+    computing, they swap the row's and the column's particles and partial
+    sums. Since element u of a block enters row u and column u together, they
+    meet at cell (u, u), so the cells above the diagonal pair the column's
+    particles with each other and the cells below it the row's. The folded
+    block (a, c), a > c, then computes the upper triangle of diagonal block c
+    and the lower triangle of diagonal block a in one pass, every interaction
+    once, and the forces on c leave on the right and those on a at the bottom.
+    A diagonal block (i, i) is folded with itself, repeating its lower
+    triangle. The rings still hold the particles fed to the rows and columns,
+    and cells works out the pairs.
+    """
+    def __init__(self, n, N, positions=None, masses=None, hazards=None,
+                 index=0, memory=None, latency=1, fold=False):
+        self.n = n
+        self.N = N
+        self.latency = latency
+        self.fold = fold
+        # The cycles a particle takes to cross the array, and the rows the
+        # staggered buffers need
+        self.depth = N * latency
+        self.buffer_depth = (N - 1) * latency + 1
+        self.head = 0
+        self.buffer_head = 0
+        self.cycle = 0
+
+        # Arrays of a model share a detector, and are told apart by index
+        self.hazards = HazardDetector() if hazards is None else hazards
+        self.index = index
+        self.memory = memory
+
+        self.positions = positions
+        self.masses = masses
+        self.bottom_forces = None
+        self.right_forces = None
+        if positions is not None:
+            self.bottom_delay = np.zeros((2 * self.depth, N, 3),
+                                         dtype=positions.dtype)
+            self.right_delay = np.zeros((2 * self.depth, N, 3),
+                                        dtype=positions.dtype)
+            self.bottom_forces = np.zeros((3, N), dtype=positions.dtype)
+            self.right_forces = np.zeros((3, N), dtype=positions.dtype)
+
+        self.cells_i = np.full((N, 2 * self.depth), -1)
+        self.cells_j = np.full((2 * self.depth, N), -1)
+        self.buffers = np.full((2, self.buffer_depth, N), -1)
+
+        self.lanes = np.arange(N)
+        # stagger[h] holds the buffer rows of the diagonal for buffer head h
+        self.stagger = (np.arange(self.buffer_depth)[:, None] +
+                        self.lanes[None, :] * latency) % self.buffer_depth
+        self.new_positions = np.empty((N), dtype=self.cells_i.dtype)
+
+        self.top = np.full((N), -1)
+        self.left = np.full((N), -1)
+        self.bottom = np.full((N, 2), -1)
+        self.right = np.full((N, 2), -1)
+
+        if fold:
+            self.upper = self.lanes[:, None] < self.lanes[None, :]
+            self.lower = self.upper.T
+            self.diagonal = np.eye(N, dtype=bool)
+            self.blocks_i = np.empty((N, N), dtype=self.cells_i.dtype)
+            self.blocks_j = np.empty((N, N), dtype=self.cells_i.dtype)
+            self.folding = np.empty((N, N), dtype=bool)
+            self.swapped = np.empty((N, N), dtype=bool)
+            self.folded_i = np.empty((N, N), dtype=self.cells_i.dtype)
+            self.folded_j = np.empty((N, N), dtype=self.cells_i.dtype)
+            self.fold_lanes = np.empty((N), dtype=bool)
+
+    @property
+    def fed(self):
+        """
+        Views of the particles fed to each cell along its row (i) and its
+        column (j). No copy is made
+        """
+        h = self.head
+        return (self.cells_i[:, h:h + self.depth:self.latency],
+                self.cells_j[h:h + self.depth:self.latency, :])
+
+    @property
+    def cells(self):
+        """
+        The logical (i, j) halves of the array. These are the views of fed,
+        unless the array folds diagonal blocks: then the pairs are worked out
+        into preallocated arrays, which are only valid until the next call,
+        and the diagonal cells of folded blocks are empty
+        """
+        fed_i, fed_j = self.fed
+        if not self.fold:
+            return fed_i, fed_j
+
+        # Cell (u, v) above the diagonal of a folded block holds the particle
+        # fed to column u along with its own column's, and below the diagonal
+        # the particle fed to row v along with its own row's
+        self.fold_mask(fed_i, fed_j)
+        np.copyto(self.folded_i, fed_i)
+        np.logical_and(self.folding, self.upper, out=self.swapped)
+        np.copyto(self.folded_i, fed_j.T, where=self.swapped)
+        np.copyto(self.folded_j, fed_j)
+        np.logical_and(self.folding, self.lower, out=self.swapped)
+        np.copyto(self.folded_j, fed_i.T, where=self.swapped)
+        np.logical_and(self.folding, self.diagonal, out=self.swapped)
+        self.folded_i[self.swapped] = -1
+        self.folded_j[self.swapped] = -1
+
+        return self.folded_i, self.folded_j
+
+    def fold_mask(self, fed_i, fed_j):
+        """
+        Sets folding to the cells holding a block (i, j) with i >= j
+        """
+        np.floor_divide(fed_i, self.N, out=self.blocks_i)
+        np.floor_divide(fed_j, self.N, out=self.blocks_j)
+        np.greater_equal(self.blocks_i, self.blocks_j, out=self.folding)
+        np.logical_and(self.folding, fed_j != -1, out=self.folding)
+
+    @property
+    def wasted_cells(self):
+        """
+        The number of cells of diagonal blocks on or below the diagonal, which
+        repeat an interaction or pair a particle with itself. Folding, only a
+        diagonal block folded with itself wastes its cells below the diagonal
+        """
+        fed_i, fed_j = self.fed
+        used = (fed_i != -1) & (fed_j != -1)
+        same = fed_i // self.N == fed_j // self.N
+        if not self.fold:
+            return np.count_nonzero(used & same & (fed_i >= fed_j))
+        return np.count_nonzero(used & same & self.lower)
+
+    @property
+    def systolic_array(self):
+        """
+        The array as an (N, N, 2) matrix of (i, j) pairs, like
+        ReferenceSystolicArray.systolic_array. This makes a copy
+        """
+        return np.stack(self.cells, axis=-1)
+
+    @property
+    def position_buffer(self):
+        """
+        The staggered buffers in the (2, N, N) layout of
+        ReferenceSystolicArray.position_buffer, with (N - 1) * L + 1 rows for
+        a latency of L. This makes a copy
+        """
+        return np.roll(self.buffers, -self.buffer_head, axis=1)
+
+    def restore(self, blocks, cycle):
+        """
+        Sets the array and buffers to the state reached on the given cycle
+        after issuing the given blocks, a list of (i, j) for the last
+        (2N - 1) * L cycles with the oldest first. Older blocks have all left
+        the array
+        """
+        N, L = self.N, self.latency
+        self.cycle = cycle
+        blocks = np.array(blocks).reshape((2 * N - 1) * L, 2)
+        newest = (2 * N - 1) * L - 1
+
+        # The top and left vectors popped d cycles ago hold element k of the
+        # block issued d + k * L cycles ago
+        d = np.arange(self.depth)[:, None]
+        k = self.lanes[None, :]
+        i = blocks[newest - d - k * L, 0]
+        j = blocks[newest - d - k * L, 1]
+        tops = np.where(i != -1, j * N + k, -1)
+        lefts = np.where(j != -1, i * N + k, -1)
+
+        self.head = 0
+        self.cells_i[:, :self.depth] = lefts.T
+        self.cells_i[:, self.depth:] = lefts.T
+        self.cells_j[:self.depth, :] = tops
+        self.cells_j[self.depth:, :] = tops
+
+        # Row r of the buffers pops element k of the block issued k * L - r
+        # cycles ago, if it has been issued yet
+        r = np.arange(self.buffer_depth)[:, None]
+        pending = k * L > r
+        issued = np.where(pending, newest + 1 + r - k * L, newest)
+        i = blocks[issued, 0]
+        j = blocks[issued, 1]
+        self.buffer_head = 0
+        self.buffers[1] = np.where(pending & (i != -1), j * N + k, -1)
+        self.buffers[0] = np.where(pending & (j != -1), i * N + k, -1)
+
+    def update_position_buffer(self, i, j):
+        """
+        Updates the position buffers based on the block which is being executed
+
+        The given (i,j) will correspond to the elements entering the first cell
+        of the systolic array, and element k of the block is popped k * L
+        cycles later. Inserting the block writes the diagonal (relative to the
+        buffer head), then the row at the head is popped and the head moves on
+        """
+        h = self.buffer_head
+        rows = self.stagger[h]
+
+        top_buffer = self.buffers[1]
+        if i != -1:
+            np.add(self.lanes, j * self.N, out=self.new_positions)
+            top_buffer[rows, self.lanes] = self.new_positions
+        np.copyto(self.top, top_buffer[h])
+        top_buffer[h] = -1
+
+        left_buffer = self.buffers[0]
+        if j != -1:
+            np.add(self.lanes, i * self.N, out=self.new_positions)
+            left_buffer[rows, self.lanes] = self.new_positions
+        np.copyto(self.left, left_buffer[h])
+        left_buffer[h] = -1
+
+        self.buffer_head = (h + 1) % self.buffer_depth
+
+        if self.memory is not None and i != -1:
+            self.memory.use(i, j)
+        if self.positions is not None and i != -1 and j != -1:
+            self.evaluate_block(i, j)
+
+        return self.top, self.left
+
+    def evaluate_block(self, i, j):
+        """
+        Computes the partial sums of block (i, j) and queues them to leave the
+        array. Element k of a block enters k * L cycles after the block and
+        takes N * L cycles to cross the array
+        """
+        N = self.N
+        rows = slice(i * N, (i + 1) * N)
+        cols = slice(j * N, (j + 1) * N)
+        tile = folded_tile if self.fold and i >= j else interaction_tile
+        right, down = tile(self.positions[:, rows], self.masses[rows],
+                           self.positions[:, cols], self.masses[cols])
+
+        slots = (self.cycle + (N + self.lanes) * self.latency) % \
+                (2 * self.depth)
+        self.right_delay[slots, self.lanes] = right.T
+        self.bottom_delay[slots, self.lanes] = down.T
+
+    def update_systolic_array(self, top, left, position_state):
+        """
+        Updates the systolic array.
+
+        Takes in the new atom indexes from the top and left of the array.
+        it then shifts the is to the right and the js down
+        Finally it returns the bottom and right of the array
+        """
+        N, L, D = self.N, self.latency, self.depth
+        h = self.head
+
+        # The last row and column leave the array, along with the other half
+        # of the pairs the last cells started L cycles ago
+        np.copyto(self.bottom[:, 0], self.cells_i[N - 1, h + L - 1:h + D:L])
+        np.copyto(self.bottom[:, 1], self.cells_j[h + D - 1, :])
+        np.copyto(self.right[:, 0], self.cells_i[:, h + D - 1])
+        np.copyto(self.right[:, 1], self.cells_j[h + L - 1:h + D:L, N - 1])
+        if self.fold:
+            # The sums of folded blocks leave on the other side, right for the
+            # particles fed to the columns and bottom for the rows
+            np.greater_equal(self.right[:, 0] // N, self.right[:, 1] // N,
+                             out=self.fold_lanes)
+            np.logical_and(self.fold_lanes, self.right[:, 0] != -1,
+                           out=self.fold_lanes)
+            lanes = self.fold_lanes
+            if lanes.any():
+                right = self.right[lanes]
+                self.right[lanes] = self.bottom[lanes, ::-1]
+                self.bottom[lanes] = right[:, ::-1]
+        if self.positions is not None:
+            slot = self.cycle % (2 * D)
+            np.copyto(self.bottom_forces, self.bottom_delay[slot].T)
+            np.copyto(self.right_forces, self.right_delay[slot].T)
+            self.bottom_delay[slot] = 0
+            self.right_delay[slot] = 0
+        self.cycle += 1
+
+        # Moving the head back shifts the i's right and the j's down, so only
+        # the new left column and top row have to be written
+        h = (h - 1) % D
+        self.cells_i[:, h] = left
+        self.cells_i[:, h + D] = left
+        self.cells_j[h, :] = top
+        self.cells_j[h + D, :] = top
+        self.head = h
+
+        # Checks to make sure positions are from the same timestep
+        cells_i, cells_j = self.cells
+        self.hazards.check(self.cycle - 1, self.index, cells_i, cells_j,
+                           position_state)
+
+        return self.bottom, self.right
+
+    def generate_force_coordinates(self):
+        """
+        Returns a (k, 2) array of the (i, j) interactions currently being
+        calculated
+        """
+        cells_i, cells_j = self.cells
+        active = (cells_i != -1) & (cells_j != -1)
+
+        return np.column_stack((cells_i[active], cells_j[active]))
+
+    def generate_block_occupancy(self):
+        """
+        Returns an (m, 3) array of (block i, block j, cells) for the blocks
+        currently being calculated
+        """
+        blocks = self.generate_force_coordinates() // self.N
+        blocks, cells = np.unique(blocks, axis=0, return_counts=True)
+
+        return np.column_stack((blocks, cells))
+
+    def generate_force_matrix_data(self):
+        """
+        Generates the force matrix for plotting based on the current systolic
+        state
+        """
+        force_matrix = np.zeros((self.n, self.n))
+        coordinates = self.generate_force_coordinates()
+        force_matrix[coordinates[:, 0], coordinates[:, 1]] = 1
+
+        return force_matrix
+
+    def print_systolic_array(self):
+        """
+        prints the state of the systolic array in a more human readable format
+        """
+        systolic_array = self.systolic_array
+        for i in range(self.N):
+            line = ""
+            for j in range(self.N):
+                line += str(systolic_array[i,j,:])
+            print(line)
+
+
+class ReferenceSystolicArray():
+    """
+    The original np.roll based systolic array. Every cycle copies the whole
+    array and buffers and checks the timesteps cell by cell, so it is slow,
+    but it is kept around as the reference the ring buffer engine in
+    SystolicArray is checked and benchmarked against
+    """
     def __init__(self, n, N):
         self.n = n
         self.N = N
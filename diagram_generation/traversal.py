@@ -0,0 +1,126 @@
+import argparse
+
+import numpy as np
+
+from memory import MemoryModel
+
+
+def row_major(b):
+    """
+    Walks the upper triangle a row at a time, left to right
+    """
+    return [(i, j) for i in range(b) for j in range(i, b)]
+
+
+def serpentine(b):
+    """
+    Walks the rows like row_major but every other row right to left, so
+    consecutive rows share the block at the turn
+    """
+    return [(i, j) for i in range(b)
+            for j in (range(i, b) if i % 2 == 0 else range(b - 1, i - 1, -1))]
+
+
+def column_major(b):
+    """
+    Walks the upper triangle a column at a time, top to bottom
+    """
+    return [(i, j) for j in range(b) for i in range(j + 1)]
+
+
+def morton(b):
+    """
+    Walks the upper triangle in Z-order, interleaving the bits of i and j,
+    so nearby blocks in both directions are walked close together
+    """
+    def spread(x):
+        code = 0
+        for bit in range(x.bit_length()):
+            code |= ((x >> bit) & 1) << (2 * bit)
+        return code
+
+    return sorted(row_major(b), key=lambda block: (spread(block[0]) << 1) |
+                                                  spread(block[1]))
+
+
+orders = {
+    'row_major': row_major,
+    'serpentine': serpentine,
+    'column_major': column_major,
+    'morton': morton,
+}
+
+
+def fold_diagonals(blocks):
+    """
+    Pairs up the diagonal blocks of a walk in the order it reaches them. The
+    first of a pair is replaced by the folded block (a, c) of the pair's
+    block rows, a > c, which computes both diagonal blocks in one pass (see
+    SystolicArray), and the second is dropped. An odd one out stays
+    """
+    folded = []
+    unpaired = None
+    for i, j in blocks:
+        if i != j:
+            folded.append((i, j))
+        elif unpaired is None:
+            unpaired = len(folded)
+            folded.append((i, j))
+        else:
+            c = folded[unpaired][0]
+            folded[unpaired] = (max(i, c), min(i, c))
+            unpaired = None
+
+    return folded
+
+
+def traversal_table(order, b, fold=False):
+    """
+    Returns the (b (b + 1) / 2, 2) table of the (i, j) blocks of a timestep
+    in the given order, one of orders. With fold the diagonal blocks are
+    folded in pairs, leaving b (b - 1) / 2 + ceil(b / 2) blocks
+    """
+    if order not in orders:
+        raise ValueError('Unknown traversal order {}'.format(order))
+    blocks = orders[order](b)
+    if fold:
+        blocks = fold_diagonals(blocks)
+    return np.array(blocks, dtype=np.int64).reshape(-1, 2)
+
+
+def block_loads(table, capacity):
+    """
+    Counts the block rows loaded into an on-chip buffer of the given
+    capacity (in block rows, at least 2) walking the table for a timestep,
+    with the least recently used row evicted. A block row holds the
+    particles of both a row and a column of blocks
+    """
+    memory = MemoryModel(1, 1, 0, capacity)
+    for cycle, (i, j) in enumerate(table):
+        memory.ready([(i, j)], cycle)
+    return memory.fetches
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Counts the block row loads of each traversal order.')
+    parser.add_argument('b', type=int,
+                        help='The number of block rows, n / N.')
+    parser.add_argument('capacity', type=int, nargs='+',
+                        help='The on-chip buffer sizes in block rows.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print('{:>14}'.format('capacity') +
+          ''.join('{:>8}'.format(c) for c in args.capacity))
+    for order in orders:
+        table = traversal_table(order, args.b)
+        print('{:>14}'.format(order) +
+              ''.join('{:>8}'.format(block_loads(table, c))
+                      for c in args.capacity))
+
+
+if __name__ == '__main__':
+    main()
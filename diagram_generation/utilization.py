@@ -0,0 +1,43 @@
+import numpy as np
+
+from systolic import DataflowModel, MultiModel, SingleModel
+
+
+def fixed_model(n, N, K, **kwargs):
+    """
+    The model walking the fixed schedule with K arrays
+    """
+    if K == 1:
+        return SingleModel(n, N, **kwargs)
+    return MultiModel(n, N, K, **kwargs)
+
+
+def run(model, cycles):
+    """
+    Steps the model, returning its utilization and the timesteps completed
+    """
+    for _ in range(cycles):
+        model.forward()
+    return model.utilization, int(np.min(model.position_state))
+
+
+# The fixed schedule is only correct if it has no hazards, otherwise it has
+# to stall until the blocks it starts are ready
+print("{:>6} {:>4} {:>2} {:>12} {:>14} {:>8}".format(
+    "n", "N", "K", "fixed util", "dataflow util", "steps"))
+for n, N, K in [(64, 16, 1), (128, 16, 1), (32, 4, 2), (256, 16, 2),
+                (128, 8, 3), (64, 4, 4), (1024, 32, 4)]:
+    cycles = 20 * (n // N) ** 2
+    fixed = fixed_model(n, N, K)
+    fixed_util, fixed_steps = run(fixed, cycles)
+    policy = ""
+    if fixed.hazards.count:
+        fixed_util, fixed_steps = run(
+            fixed_model(n, N, K, hazard_policy="stall"), cycles)
+        policy = "*"
+
+    dataflow_util, dataflow_steps = run(DataflowModel(n, N, K), cycles)
+    print("{:>6} {:>4} {:>2} {:>11.3f}{:1} {:>14.3f} {:>3} / {}".format(
+        n, N, K, fixed_util, policy, dataflow_util, fixed_steps,
+        dataflow_steps))
+print("* the fixed schedule has hazards, so it stalls")